@@ -0,0 +1,102 @@
+import re
+import typing
+
+from astropy.io.fits import Card
+
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.util import FITS_CARD_SIZE
+
+# fast path for the cards capture software actually writes: plain keywords with a string, logical, integer or
+# floating point value. Anything else (HIERARCH, CONTINUE, complex values, missing values, bad keywords) is left to
+# astropy, so the results are the same as FitsFileFormat.safe_dict on a full Header.
+
+_KEYWORD = re.compile(r'^[A-Z0-9_-]*$')
+_INT = re.compile(r'^[+-]?\d+$')
+_FLOAT = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$')
+_COMMENTARY = ('COMMENT', 'HISTORY', '')
+_TAB_TOLERANT = ('OBJECT',)  # tabs, even if non-printable, are common in my FITS files
+
+
+def parse_cards(data: bytes) -> typing.List[typing.Tuple[str, typing.Any]]:
+    """ parses raw 80 column header cards, as read by util.read_header_blocks, into (keyword, value) pairs """
+    text = data.decode('ascii', errors='replace')
+    images = [text[offset:offset + FITS_CARD_SIZE] for offset in range(0, len(text), FITS_CARD_SIZE)]
+    result = []
+    index = 0
+    while index < len(images):
+        image = images[index]
+        index += 1
+        keyword = image[:8].rstrip()
+        if keyword == 'END':
+            break
+        value = _parse_value(keyword, image)
+        if value is _STRING_CONTINUES:
+            # long string, astropy puts the CONTINUE cards back together
+            start = index - 1
+            while index < len(images) and images[index].startswith('CONTINUE'):
+                index += 1
+            (keyword, value) = _astropy_card(''.join(images[start:index]))
+        elif value is _UNKNOWN:
+            (keyword, value) = _astropy_card(image)
+        result.append((keyword, value))
+    return result
+
+
+def parse_dict(data: bytes) -> typing.Dict[str, typing.Any]:
+    """ the same as FitsFileFormat.safe_dict, duplicate keywords keep their last value """
+    return dict(parse_cards(data))
+
+
+_UNKNOWN = object()
+_STRING_CONTINUES = object()
+
+
+def _parse_value(keyword: str, image: str):
+    if not _KEYWORD.match(keyword):
+        return _UNKNOWN
+    if keyword in _COMMENTARY or image[8:10] != '= ':
+        if keyword in _COMMENTARY:
+            return image[8:].rstrip()
+        return _UNKNOWN
+    if '\t' in image and keyword not in _TAB_TOLERANT:
+        return _UNKNOWN
+    rest = image[10:].replace('\t', ' ').lstrip()
+    if rest.startswith("'"):
+        return _parse_string(rest)
+    token = rest.split('/', 1)[0].strip()
+    if token == 'T':
+        return True
+    if token == 'F':
+        return False
+    if _INT.match(token):
+        return int(token)
+    if _FLOAT.match(token):
+        return float(token.replace('D', 'E').replace('d', 'e'))
+    return _UNKNOWN
+
+
+def _parse_string(rest: str):
+    chars = []
+    position = 1
+    while True:
+        quote = rest.find("'", position)
+        if quote < 0:
+            return _UNKNOWN  # unterminated
+        chars.append(rest[position:quote])
+        if rest[quote + 1:quote + 2] == "'":  # escaped quote
+            chars.append("'")
+            position = quote + 2
+        else:
+            break
+    remainder = rest[quote + 1:].strip()
+    if remainder and not remainder.startswith('/'):
+        return _UNKNOWN
+    value = ''.join(chars).rstrip()
+    if value.endswith('&'):
+        return _STRING_CONTINUES
+    return value
+
+
+def _astropy_card(image: str) -> typing.Tuple[str, typing.Any]:
+    card = Card.fromstring(image)
+    return card.keyword, FitsFileFormat.safe_value(card)
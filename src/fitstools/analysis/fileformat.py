@@ -16,20 +16,58 @@ class FileFormat:
     def import_file(self, file: File):
         raise NotImplementedError()
 
+    def read_header_dicts(self, fd) -> typing.List[typing.Dict[str, typing.Any]]:
+        raise NotImplementedError()
+
 
 class FitsFileFormat(FileFormat):
+    # keywords describing the primary HDU itself, not inherited by its extensions
+    PRIMARY_STRUCTURE = {"SIMPLE", "BITPIX", "NAXIS", "EXTEND", "INHERIT", "CHECKSUM", "DATASUM"}
+
     def import_file(self, file, fd) -> [typing.List[Image], typing.List[Image]]:
         images = []
         metadata = []
+        for header_dict in self.read_header_dicts(fd):
+            (file_images, file_metadata) = self.import_header_dict(file, header_dict)
+            images.extend(file_images)
+            metadata.extend(file_metadata)
+        return images, metadata
+
+    def read_header_dicts(self, fd) -> typing.List[typing.Dict[str, typing.Any]]:
+        """ the header of each image in the file, as plain keyword/value dicts. A primary HDU without data keeps its
+            images in the extensions, their headers are returned instead, on top of the primary keywords if the
+            extension sets INHERIT
+        """
         with fits.open(fd) as hdul:
             primary = hdul[0]
-            header = primary.header
-            image = Image(file=file)
-            header_dict = self.safe_dict(header)
-            for (key, value) in header_dict.items():
-                meta = ImageMeta(image=image, key=key, value=value)
-                metadata.append(meta)
-            images.append(image)
+            if primary.header.get("NAXIS", 0) > 0 or len(hdul) == 1:
+                return [self.safe_dict(primary.header)]
+            inherited = {key: value for (key, value) in self.safe_dict(primary.header).items()
+                         if key not in self.PRIMARY_STRUCTURE and not key.startswith("NAXIS")}
+            header_dicts = []
+            for hdu in hdul[1:]:
+                if not hdu.is_image or hdu.header.get("NAXIS", 0) == 0:
+                    continue  # tables
+                header_dict = self.safe_dict(hdu.header)
+                if header_dict.get("INHERIT", False) is True:
+                    header_dict = {**inherited, **header_dict}
+                header_dicts.append(header_dict)
+            return header_dicts or [self.safe_dict(primary.header)]
+
+    def import_header(self, file, header: Header) -> [typing.List[Image], typing.List[Image]]:
+        """ same as import_file, for a primary header that was read on its own """
+        return self.import_header_dict(file, self.safe_dict(header))
+
+    @staticmethod
+    def import_header_dict(file, header_dict: typing.Dict[str, typing.Any]) -> [typing.List[Image], typing.List[Image]]:
+        """ same as import_header, for keywords and values parsed by cardparser.parse_dict or safe_dict """
+        images = []
+        metadata = []
+        image = Image(file=file)
+        for (key, value) in header_dict.items():
+            meta = ImageMeta(image=image, key=key, value=value)
+            metadata.append(meta)
+        images.append(image)
         return images, metadata
 
     def accept(self, file: File) -> bool:
@@ -1,24 +1,75 @@
+import functools
+import re
+from datetime import datetime
 from pathlib import Path
 
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Set, Tuple, Union
+
+import numpy as np
+import pandas
 from dateutil import parser
+from dateutil.tz import tzutc
 from astropy.io.fits import Header, VerifyError
 from logzero import logger
 
+from fitstools.config import Config
 from fitstools.model import ImageType, NormalizedImageMeta
 
 
 class MetadataAnalyser:
 
     @classmethod
-    def normalize(cls, metadata: Header, file: Path) -> NormalizedImageMeta:
+    def normalize(cls, metadata: Union[Header, Mapping[str, Any]], file: Path) -> NormalizedImageMeta:
         support = Support.find(metadata, file)
         try:
             return support.normalize(metadata)
         except Exception as ex:
             logger.error("error mapping metadata from file %s:%s" % (file, ex))
 
+    @classmethod
+    def normalize_dict(cls, header_dict: Dict[str, Any], file: Path) -> NormalizedImageMeta:
+        """ normalize for a plain keyword/value dict, as parsed by cardparser or read by headerstore """
+        return cls.normalize(header_dict, file)
+
+    @classmethod
+    def normalize_many(cls, header_dicts: Iterable[Mapping[str, Any]]) -> pandas.DataFrame:
+        """ normalize for many keyword/value dicts at once: a DataFrame with a row per header and a column per
+            NormalizedImageMeta field, plus session_date. The conversions run per column, a value that does not convert
+            is missing instead of failing its whole header. img_type holds ImageType names, the datetimes are naive
+            (UTC for datetime_utc, like ImageInfo) and session_date is the datetime64 of midnight.
+        """
+        header_dicts = list(header_dicts)
+        supports = [Support.find(header_dict, None) for header_dict in header_dicts]
+        values = [_header_values(header_dict, support._mapped_keys())
+                  for (header_dict, support) in zip(header_dicts, supports)]
+        img_types = [support._map_meta(header_values, support._fits_image_type_header,
+                                       support._fits_image_type_map, ImageType.UNKNOWN).name
+                     for (header_values, support) in zip(values, supports)]
+        frame = pandas.DataFrame({"img_type": pandas.Series(img_types, dtype=object)})
+        for (attribute, column) in _STD_FIELDS.columns(values).items():
+            frame[attribute] = column
+        reference = frame.datetime_local.where(frame.datetime_local.notna(),
+                                               frame.datetime_utc - pandas.Timedelta(hours=Config.TZ_OFFSET))
+        # before noon belongs to the night that started the day before, see NormalizedImageMeta.session_date
+        frame["session_date"] = (reference - pandas.Timedelta(hours=12)).dt.normalize()
+        return frame
+
+    @classmethod
+    def header_keys(cls) -> Set[str]:
+        """ every header keyword normalize may look at, other keywords can be left out of the header """
+        return {key for support in Support._support_types for key in support.header_keys()}
+
+
+@functools.lru_cache(maxsize=256)
+def _resolve_support(accept_values: Tuple[Tuple[str, Any], ...]) -> "Support":
+    headers = dict(accept_values)
+    for support in Support._support_types:
+        if support._accept(headers, None):
+            if isinstance(support, GenericSupport):  # once per creator, the files are only logged at debug level
+                logger.info("Cannot determine creator software %s, falling back to generic support." % (headers,))
+            return support
+
 
 class Support(ABC):
     DEFAULT_PRIO = 1000
@@ -26,16 +77,24 @@ class Support(ABC):
     fits_image_type_map: Dict[str, ImageType]
     _support_types: List["Support"] = []
 
+    _accept_keys: Tuple[str, ...] = ()  # the keywords _accept looks at
+    _all_accept_keys: Tuple[str, ...] = ()
+
     def __init_subclass__(cls) -> None:
         super().__init_subclass__()
         Support._support_types.append(cls())
         Support._support_types.sort(key=lambda f: f._prio(), reverse=True)
+        Support._all_accept_keys = tuple(sorted({key for support in Support._support_types
+                                                 for key in support._accept_keys}))
+        _resolve_support.cache_clear()
 
     @classmethod
     def find(cls, headers, path) -> "Support":
-        for support in cls._support_types:
-            if support._accept(headers, path):
-                return support
+        # the support only depends on a few keywords (the creator software), which hardly vary within an archive
+        support = _resolve_support(tuple((key, headers[key]) for key in Support._all_accept_keys if key in headers))
+        if isinstance(support, GenericSupport):
+            logger.debug("Cannot determine creator software of FITS file %s, falling back to generic support.", path)
+        return support
 
     @abstractmethod
     def normalize(self, metadata: Header) -> NormalizedImageMeta:
@@ -45,6 +104,10 @@ class Support(ABC):
     def _accept(self, headers, path) -> bool:
         pass
 
+    def header_keys(self) -> Tuple[str, ...]:
+        """ the keywords read by _accept and normalize """
+        return self._accept_keys + self._mapped_keys()  # _mapped_keys comes with the mapping, e.g. _DefaultMapping
+
     def _prio(self) -> int:
         return Support.DEFAULT_PRIO
 
@@ -74,25 +137,16 @@ class _DefaultMapping:
                 return value_map[header_value]
         return missing_value
 
-    def _std_mapping(self, metadata: Header) -> NormalizedImageMeta:
-        meta = NormalizedImageMeta()
-        meta.img_type = self._map_meta(metadata, self._fits_image_type_header, self._fits_image_type_map,
+    def _std_mapping(self, metadata: Union[Header, Mapping[str, Any]]) -> NormalizedImageMeta:
+        values = _header_values(metadata, self._mapped_keys())
+        meta = _STD_FIELDS.extract(values)
+        meta.img_type = self._map_meta(values, self._fits_image_type_header, self._fits_image_type_map,
                                        ImageType.UNKNOWN)
-        meta.camera_name = _header(metadata, "INSTRUME")
-        meta.exposure = _float(_header(metadata, "EXPOSURE", "EXPTIME"))
-        meta.actual_temperature = _float(_header(metadata, "CCD-TEMP"))
-        meta.set_temperature = _float(_header(metadata, "SET-TEMP"))
-        meta.object_name = _header(metadata, "OBJECT")
-        meta.filter = _header(metadata, "FILTER")
-        meta.xbin = _round(_float(_header(metadata, "XBINNING")))
-        meta.ybin = _round(_float(_header(metadata, "YBINNING")))
-        meta.gain = _round(_float(_header(metadata, "GAIN")))
-        meta.offset = _round(_float(_header(metadata, "OFFSET")))
-        meta.telescope = _header(metadata, "TELESCOP")
-        meta.datetime_utc = _datetime(_header(metadata, "DATE-OBS"))
-        meta.datetime_local = _datetime(_header(metadata, "DATE-LOC"))
         return meta
 
+    def _mapped_keys(self) -> Tuple[str, ...]:
+        return (self._fits_image_type_header,) + _STD_FIELDS.keys
+
 
 class GenericSupport(Support, _DefaultMapping):
 
@@ -100,7 +154,6 @@ class GenericSupport(Support, _DefaultMapping):
         return self._std_mapping(metadata)
 
     def _accept(self, headers, path) -> bool:
-        logger.info("Cannot determine creator software of FITS file %s, falling back to generic support." % path)
         return True
 
     def _prio(self) -> int:
@@ -108,6 +161,7 @@ class GenericSupport(Support, _DefaultMapping):
 
 
 class SGPSupport(Support, _DefaultMapping):
+    _accept_keys = ("CREATOR",)
 
     def normalize(self, metadata: Header):
         return self._std_mapping(metadata)
@@ -117,6 +171,7 @@ class SGPSupport(Support, _DefaultMapping):
 
 
 class APTSupport(Support, _DefaultMapping):
+    _accept_keys = ("SWCREATE",)
 
     def normalize(self, metadata: Header):
         return self._std_mapping(metadata)
@@ -126,6 +181,7 @@ class APTSupport(Support, _DefaultMapping):
 
 
 class NinaSupport(Support, _DefaultMapping):
+    _accept_keys = ("SWCREATE",)
 
     def normalize(self, metadata: Header):
         return self._std_mapping(metadata)
@@ -142,36 +198,146 @@ def _option(function):
     return wrapper
 
 
-def _try(function):
-    def wrapper(*args, **kwargs):
-        try:
-            return function(*args, **kwargs)
-        except Exception as ex:
-            logger.error(ex)
-            return None
+_ISO_DATETIME = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z?)$')
+_UTC = tzutc()
 
-    return wrapper
+
+def _parse_datetime(value: str) -> datetime:
+    # what capture software writes is nearly always plain ISO 8601, dateutil is only needed for anything else
+    match = _ISO_DATETIME.match(value) if isinstance(value, str) else None
+    if match is None:
+        return parser.parse(value)
+    (year, month, day, hour, minute, second, fraction, utc) = match.groups()
+    microsecond = int((fraction or '')[:6].ljust(6, '0'))  # dateutil also drops digits beyond microseconds
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond,
+                    tzinfo=_UTC if utc else None)
 
 
 _int = _option(int)
 _round = _option(round)
 _float = _option(float)
-_datetime = _option(parser.parse)
+_datetime = _option(_parse_datetime)
 
 
-def _find_header_card(headers: Header, *fieldnames):
-    for fieldname in fieldnames:
-        if fieldname in headers:
-            return headers.cards[fieldname]
-    return None
+def _header_values(headers: Union[Header, Mapping[str, Any]], keys: Tuple[str, ...]) -> Dict[str, Any]:
+    """ the values of the keywords that are in the header, in one pass over the cards of a Header """
+    if not isinstance(headers, Header):
+        return {key: headers[key] for key in keys if key in headers}
+    wanted = frozenset(keys)
+    values = dict()
+    for card in headers.cards:
+        keyword = card.keyword
+        if keyword in wanted and keyword not in values:  # the first card counts, like headers.cards[keyword]
+            values[keyword] = _card_value(card)
+    return values
 
 
-def _header(headers: Header, *fieldnames):
-    card = _find_header_card(headers, *fieldnames)
-    if card is None:
-        return None
+def _card_value(card):
     try:
         return card.value
     except VerifyError:
         card._image = card._image.replace('\t', ' ')  # tabs, even if non-printable, are common in my FITS files
         return card.value
+
+
+class _FieldExtractor:
+    """ the NormalizedImageMeta fields with the keywords they come from, in order of preference, and the conversion
+        of the value. Set up once, normalizing is then a dict lookup and a conversion per field.
+    """
+
+    def __init__(self, *fields: Tuple[str, Tuple[str, ...], Callable]):
+        self.fields = fields
+        self.keys = tuple(dict.fromkeys(key for (_, keys, _) in fields for key in keys))
+
+    def extract(self, values: Dict[str, Any]) -> NormalizedImageMeta:
+        meta = NormalizedImageMeta()
+        for (attribute, keys, convert) in self.fields:
+            setattr(meta, attribute, convert(self._first(values, keys)))
+        return meta
+
+    def columns(self, values_list: List[Dict[str, Any]]) -> Dict[str, pandas.Series]:
+        """ extract for many headers, each field converted as a whole column """
+        columns = dict()
+        for (attribute, keys, convert) in self.fields:
+            raw = pandas.Series([self._first(values, keys) for values in values_list], dtype=object)
+            columns[attribute] = _COLUMN_CONVERSIONS[convert](raw, attribute)
+        return columns
+
+    @staticmethod
+    def _first(values: Dict[str, Any], keys: Tuple[str, ...]):
+        for key in keys:
+            if key in values:
+                return values[key]
+        return None
+
+
+def _as_is(value):
+    return value
+
+
+def _rounded(value):
+    return _round(_float(value))
+
+
+def _float_column(raw: pandas.Series, attribute: str) -> pandas.Series:
+    return pandas.to_numeric(raw, errors='coerce').astype('float64')
+
+
+def _rounded_column(raw: pandas.Series, attribute: str) -> pandas.Series:
+    return np.round(_float_column(raw, attribute)).astype('Int64')  # numpy rounds half to even, like round()
+
+
+_TZ_SUFFIX = r'(Z|[+-]\d\d:?\d\d)$'
+
+
+def _datetime_column(raw: pandas.Series, attribute: str) -> pandas.Series:
+    utc = attribute == "datetime_utc"  # in UTC, the others are in local time and keep their wall clock time
+    strings = raw.where(raw.map(lambda value: isinstance(value, str)))
+    if not utc:
+        strings = strings.str.replace(_TZ_SUFFIX, '', regex=True)
+    # ISO 8601 in one go, anything else through dateutil one by one
+    parsed = pandas.to_datetime(strings, errors='coerce', utc=utc, **_ISO_FORMAT)
+    fallback = parsed.isna() & strings.notna()
+    if fallback.any():
+        parsed = parsed.astype(object)
+        parsed[fallback] = [_fallback_datetime(value, utc) for value in strings[fallback]]
+        parsed = pandas.to_datetime(parsed, utc=utc)
+    if utc:
+        parsed = parsed.dt.tz_convert(None)
+    return parsed.dt.floor('us')  # dateutil drops digits beyond microseconds
+
+
+def _fallback_datetime(value: str, utc: bool):
+    try:
+        parsed = _parse_datetime(value)
+    except (ValueError, OverflowError):
+        return pandas.NaT
+    if parsed.tzinfo is not None and not utc:
+        return parsed.replace(tzinfo=None)
+    return parsed
+
+
+_ISO_FORMAT = {"format": "ISO8601"} if int(pandas.__version__.split('.')[0]) >= 2 else {}
+
+_COLUMN_CONVERSIONS = {
+    _as_is: lambda raw, attribute: raw,
+    _float: _float_column,
+    _rounded: _rounded_column,
+    _datetime: _datetime_column,
+}
+
+_STD_FIELDS = _FieldExtractor(
+    ("camera_name", ("INSTRUME",), _as_is),
+    ("exposure", ("EXPOSURE", "EXPTIME"), _float),
+    ("actual_temperature", ("CCD-TEMP",), _float),
+    ("set_temperature", ("SET-TEMP",), _float),
+    ("object_name", ("OBJECT",), _as_is),
+    ("filter", ("FILTER",), _as_is),
+    ("xbin", ("XBINNING",), _rounded),
+    ("ybin", ("YBINNING",), _rounded),
+    ("gain", ("GAIN",), _rounded),
+    ("offset", ("OFFSET",), _rounded),
+    ("telescope", ("TELESCOP",), _as_is),
+    ("datetime_utc", ("DATE-OBS",), _datetime),
+    ("datetime_local", ("DATE-LOC",), _datetime),
+)
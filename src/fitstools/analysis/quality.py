@@ -0,0 +1,238 @@
+import math
+import typing
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.stats import gaussian_sigma_to_fwhm, SigmaClip
+from peewee import chunked, JOIN
+from photutils.background import Background2D, MedianBackground
+from photutils.segmentation import detect_sources, SourceCatalog
+
+from fitstools.db.database_peewee import Image, ImageInfo, ImageQuality, File, Root
+from fitstools.model import ImageType
+from fitstools.util import FileRef, bin_image
+
+
+class FrameQuality:
+    """ how good a frame is: median FWHM (pixels) and eccentricity of its stars, the number of stars found, and the
+        sky background and noise (ADU)
+    """
+    median_fwhm: float = None
+    eccentricity: float = None
+    star_count: int = 0
+    background: float = None
+    noise: float = None
+
+    def __init__(self, median_fwhm=None, eccentricity=None, star_count=0, background=None, noise=None):
+        self.median_fwhm = median_fwhm
+        self.eccentricity = eccentricity
+        self.star_count = star_count
+        self.background = background
+        self.noise = noise
+
+    def __repr__(self):
+        return "FrameQuality(fwhm=%s, ecc=%s, stars=%d, background=%s, noise=%s)" % (
+            self.median_fwhm, self.eccentricity, self.star_count, self.background, self.noise)
+
+
+class QualityAnalyser:
+    """ the photutils pipeline of scripts/fwhm2.py: a Background2D map, detect_sources above DETECT_SIGMA times its
+        rms and the second moments of the sources from a SourceCatalog. Fast mode fits the background mesh on a
+        subsample of the pixels (a SAMPLES-sized grid) with coarse boxes and measures MAX_STARS sources spread over
+        the catalog. The sigma clipping goes through astropy, which uses bottleneck for it.
+    """
+    CLIP_SIGMA = 3.0
+    CLIP_ITERATIONS = 5
+    SAMPLES = 1_000_000  # pixels the background mesh is fitted on in fast mode
+    BOX_SIZE = 64  # of the background mesh, in pixels of the frame
+    FAST_BOX_SIZE = 256
+    DETECT_SIGMA = 5.0
+    MIN_PIXELS = 5  # connected pixels above the threshold, fewer is a hot pixel or noise
+    MAX_STARS = 500  # measured in fast mode
+
+    @classmethod
+    def measure(cls, data: np.ndarray, fast: bool = True, saturation: float = None) -> FrameQuality:
+        """ saturation defaults to 95% of the range of integer data, saturated stars are counted but not measured.
+            Pixels that are not finite are masked, a frame without finite pixels raises ValueError
+        """
+        if data.ndim == 3:
+            data = data.mean(axis=0, dtype=np.float32)  # color: the average of the channels
+        if saturation is None and np.issubdtype(data.dtype, np.integer):
+            saturation = 0.95 * np.iinfo(data.dtype).max
+        data = np.asarray(data, dtype=np.float32)
+        mask = ~np.isfinite(data)
+        if mask.all():
+            raise ValueError("no finite pixels")
+        mask = mask if mask.any() else None
+        (background, rms, quality) = cls._background(data, mask, fast)
+        if quality.noise == 0:
+            return quality
+        subtracted = data - background
+        threshold = cls.DETECT_SIGMA * rms
+        segments = detect_sources(subtracted, threshold, cls.MIN_PIXELS, mask=mask)
+        if segments is None:
+            return quality
+        labels = segments.labels
+        quality.star_count = len(labels)
+        if saturation is not None:
+            labels = np.setdiff1d(labels, segments.data[data >= saturation])
+        if fast and len(labels) > cls.MAX_STARS:
+            labels = labels[np.linspace(0, len(labels) - 1, cls.MAX_STARS).astype(int)]
+        if len(labels) == 0:
+            return quality
+        catalog = SourceCatalog(subtracted, segments, mask=mask)
+        stars = catalog[segments.get_indices(labels)]
+        (fwhm, eccentricity) = measure_stars(stars, threshold)
+        if len(fwhm):
+            quality.median_fwhm = float(np.median(fwhm))
+            quality.eccentricity = float(np.median(eccentricity))
+        return quality
+
+    @classmethod
+    def _background(cls, data: np.ndarray, mask: typing.Optional[np.ndarray],
+                    fast: bool) -> typing.Tuple[np.ndarray, np.ndarray, FrameQuality]:
+        """ the background and rms maps, and a FrameQuality holding their medians """
+        sigma_clip = SigmaClip(sigma=cls.CLIP_SIGMA, maxiters=cls.CLIP_ITERATIONS)
+        if not fast:
+            box = min(cls.BOX_SIZE, *data.shape)
+            background = Background2D(data, box, mask=mask, sigma_clip=sigma_clip, bkg_estimator=MedianBackground())
+            quality = FrameQuality(background=float(background.background_median),
+                                   noise=float(background.background_rms_median))
+            return background.background, background.background_rms, quality
+        step = max(1, int(math.sqrt(data.size / cls.SAMPLES)))
+        box = max(1, min(cls.FAST_BOX_SIZE // step, *(n // step for n in data.shape)))
+        # whole boxes only, so the mesh cells line up with the frame. The edges are filled in by the interpolation
+        (rows, columns) = ((n // step) // box * box for n in data.shape)
+        sample = data[::step, ::step][:rows, :columns]
+        sample_mask = mask[::step, ::step][:rows, :columns] if mask is not None else None
+        # the boxes are large enough not to need the median filter, which would flatten a mesh of a few cells
+        background = Background2D(sample, box, mask=sample_mask, sigma_clip=sigma_clip,
+                                  bkg_estimator=MedianBackground(), filter_size=1)
+        # the rms of boxes this large would include the gradient over them, it comes from the residual instead
+        residual = sample - interpolate_mesh(background.background_mesh, box, sample.shape)
+        rms = Background2D(residual, box, mask=sample_mask, sigma_clip=sigma_clip, bkg_estimator=MedianBackground(),
+                           filter_size=1)
+        quality = FrameQuality(background=float(background.background_median),
+                               noise=float(rms.background_rms_median))
+        return (interpolate_mesh(background.background_mesh, box * step, data.shape),
+                interpolate_mesh(rms.background_rms_mesh, box * step, data.shape), quality)
+
+    @classmethod
+    def measure_file(cls, image_file: typing.Union[Path, typing.BinaryIO], fast: bool = True) -> FrameQuality:
+        """ the primary image of a FITS file. Bayer mosaics are measured on 2x2 superpixels, the FWHM is given in
+            pixels of the mosaic
+        """
+        with fits.open(image_file, memmap=False) as hdul:
+            data = hdul[0].data
+            bayer = "BAYERPAT" in hdul[0].header
+        if data is None:
+            raise ValueError("no image in %s" % image_file)
+        if bayer and data.ndim == 2:
+            quality = cls.measure(bin_image(data, 2), fast, 0.95 * np.iinfo(data.dtype).max
+                                  if np.issubdtype(data.dtype, np.integer) else None)
+            if quality.median_fwhm is not None:
+                quality.median_fwhm *= 2
+            return quality
+        return cls.measure(data, fast)
+
+
+def interpolate_mesh(mesh: np.ndarray, box: int, shape: typing.Tuple[int, int]) -> np.ndarray:
+    """ bilinear interpolation of a mesh of box-sized cells, starting at the corner of the frame, to the full frame.
+        Beyond the outer cell centers it extrapolates linearly, vignetting is steepest there
+    """
+    def weights(cells: int, size: int) -> np.ndarray:
+        result = np.zeros((size, cells), dtype=np.float32)
+        if cells == 1:
+            result[:, 0] = 1
+            return result
+        position = (np.arange(size) + 0.5) / box - 0.5  # in cells, 0 is the center of the first
+        first = np.clip(np.floor(position).astype(int), 0, cells - 2)
+        fraction = position - first
+        result[np.arange(size), first] = 1 - fraction
+        result[np.arange(size), first + 1] = fraction
+        return result
+
+    mesh = np.asarray(mesh, dtype=np.float32)
+    return (weights(mesh.shape[0], shape[0]) @ mesh) @ weights(mesh.shape[1], shape[1]).T
+
+
+def measure_stars(stars: SourceCatalog, threshold: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """ FWHM and eccentricity of the sources in a catalog, from the second moments of their segments. Those moments
+        miss the wings below the detection threshold; for a gaussian star the missing part only depends on
+        threshold / peak, which the FWHM is corrected for
+    """
+    eigenvalues = _values(stars.covariance_eigvals).reshape(-1, 2)
+    peaks = _values(stars.max_value).reshape(-1)
+    centroids = np.rint(np.nan_to_num(_values(stars.centroid).reshape(-1, 2))).astype(int)  # (x, y)
+    rows = np.clip(centroids[:, 1], 0, threshold.shape[0] - 1)
+    columns = np.clip(centroids[:, 0], 0, threshold.shape[1] - 1)
+    variance = eigenvalues.mean(axis=1) / _truncation(threshold[rows, columns] / peaks)
+    eccentricity = _values(stars.eccentricity).reshape(-1)
+    ok = np.isfinite(variance) & (variance > 0) & np.isfinite(eccentricity)
+    return gaussian_sigma_to_fwhm * np.sqrt(variance[ok]), eccentricity[ok]
+
+
+def _values(quantity) -> np.ndarray:
+    return np.asarray(getattr(quantity, "value", quantity), dtype=np.float64)
+
+
+def _truncation(fraction: np.ndarray) -> np.ndarray:
+    """ second moment of a gaussian cut off at fraction of its peak, over that of the whole gaussian """
+    fraction = np.clip(fraction, 1e-6, 0.99)
+    return (1 - fraction * (1 - np.log(fraction))) / (1 - fraction)
+
+
+class QualityStore:
+    """ the measurements in the ImageQuality table. Images that could not be measured have a row with the error, so
+        they are not read again every run
+    """
+    PAGE_SIZE = 500
+    INSERT_BATCH = 100
+
+    @staticmethod
+    def unmeasured(img_types: typing.Iterable[ImageType] = (ImageType.LIGHT,), retry_failed: bool = False,
+                   page_size: int = None) -> typing.Iterator[typing.Tuple[int, FileRef]]:
+        """ the images without ImageQuality (or with a failed one, to retry them), of the given types (as normalized
+            in ImageInfo), with a FileRef of their file, in rowid-ordered pages
+        """
+        missing = ImageQuality.error.is_null(False) if retry_failed else ImageQuality.image.is_null()
+        query = Image.select(Image.rowid, File.rowid, Root.last_path, File.path, File.name) \
+            .join(File).join(Root) \
+            .switch(Image).join(ImageInfo) \
+            .switch(Image).join(ImageQuality, JOIN.LEFT_OUTER) \
+            .where(missing, ImageInfo.img_type.in_([img_type.name for img_type in img_types]))
+        last_rowid = 0
+        while True:
+            rows = list(query.where(Image.rowid > last_rowid).order_by(Image.rowid)
+                        .limit(page_size or QualityStore.PAGE_SIZE).tuples())
+            if len(rows) == 0:
+                return
+            last_rowid = rows[-1][0]
+            for row in rows:
+                yield row[0], row[1:]
+
+    @staticmethod
+    def store(results: typing.Iterable[typing.Tuple[int, FrameQuality]], fast: bool = True):
+        fields = [ImageQuality.image, ImageQuality.median_fwhm, ImageQuality.eccentricity, ImageQuality.star_count,
+                  ImageQuality.background, ImageQuality.noise, ImageQuality.fast]
+        rows = [(image_id, quality.median_fwhm, quality.eccentricity, quality.star_count, quality.background,
+                 quality.noise, fast) for (image_id, quality) in results]
+        for batch in chunked(rows, QualityStore.INSERT_BATCH):
+            ImageQuality.insert_many(batch, fields=fields).on_conflict_replace().execute()
+
+    @staticmethod
+    def store_failures(failures: typing.Iterable[typing.Tuple[int, str]], fast: bool = True):
+        """ (image rowid, error message) of the images that could not be measured """
+        fields = [ImageQuality.image, ImageQuality.fast, ImageQuality.error]
+        rows = [(image_id, fast, error) for (image_id, error) in failures]
+        for batch in chunked(rows, QualityStore.INSERT_BATCH):
+            ImageQuality.insert_many(batch, fields=fields).on_conflict_replace().execute()
+
+    @staticmethod
+    def get(image_id: int) -> typing.Optional[FrameQuality]:
+        """ None if the image has not been measured, or could not be """
+        row = ImageQuality.get_or_none(ImageQuality.image == image_id)
+        if row is None or row.error is not None:
+            return None
+        return FrameQuality(row.median_fwhm, row.eccentricity, row.star_count, row.background, row.noise)
@@ -1,34 +1,106 @@
+import math
+import typing
 from typing import Iterable
 
+from peewee import chunked
+
 from fitstools.analysis.metadata import MetadataAnalyser
 from fitstools.config import Config
 from fitstools.db.database_peewee import *
+from fitstools.db.headerstore import KeyIds, read_header_dicts
+from fitstools.db.writer import insert_image_info
 from fitstools.model import NormalizedImageMeta, ImageType
 
 import logzero
 from logzero import logger
 
+SetKey = typing.Tuple
+
+
+class SetIndex:
+    """ in-memory lookup of image sets, matching the same way find_matching_set does: equal on every grouping
+        column, set temperature within Config.TEMP_DELTA. Temperatures are bucketed so a lookup only checks
+        the neighbouring buckets.
+    """
+
+    def __init__(self):
+        self._sets: typing.Dict[SetKey, typing.Dict[typing.Optional[int], typing.List[typing.Tuple]]] = dict()
+
+    @staticmethod
+    def key(image_meta: NormalizedImageMeta, path: str, root_id: int) -> SetKey:
+        return (root_id, path, image_meta.img_type.name, image_meta.session_date(), image_meta.object_name,
+                image_meta.filter, image_meta.exposure, image_meta.camera_name, image_meta.xbin, image_meta.ybin,
+                image_meta.offset, image_meta.telescope, image_meta.gain)
+
+    @staticmethod
+    def _bucket(temperature: typing.Optional[float]) -> typing.Optional[int]:
+        if temperature is None:
+            return None
+        return math.floor(temperature / (2 * Config.TEMP_DELTA))
+
+    @classmethod
+    def load(cls) -> "SetIndex":
+        index = cls()
+        query = ImageSet.select(ImageSet.id, ImageSet.root, ImageSet.path, ImageSet.img_type, ImageSet.capture_date,
+                                ImageSet.object_name, ImageSet.filter, ImageSet.exposure, ImageSet.camera_name,
+                                ImageSet.xbin, ImageSet.ybin, ImageSet.offset, ImageSet.telescope, ImageSet.gain,
+                                ImageSet.set_temperature)
+        for row in query.tuples().iterator():
+            index.add(row[1:-1], row[-1], row[0])
+        return index
+
+    def add(self, key: SetKey, set_temperature: typing.Optional[int], set_id: int):
+        buckets = self._sets.setdefault(key, dict())
+        buckets.setdefault(self._bucket(set_temperature), list()).append((set_temperature, set_id))
+
+    def find(self, key: SetKey, set_temperature: typing.Optional[float]) -> typing.Optional[int]:
+        buckets = self._sets.get(key)
+        if buckets is None:
+            return None
+        if set_temperature is None:
+            candidates = buckets.get(None)
+            return candidates[0][1] if candidates else None
+        bucket = self._bucket(set_temperature)
+        for neighbour in (bucket - 1, bucket, bucket + 1):
+            for (temperature, set_id) in buckets.get(neighbour, ()):
+                if set_temperature - Config.TEMP_DELTA <= temperature <= set_temperature + Config.TEMP_DELTA:
+                    return set_id
+        return None
+
 
 class SetBuilder:
+    PAGE_SIZE = 500  # images per query, also the number of ids in the IN clause of their header query
+    UPDATE_BATCH = 500
 
     @staticmethod
     def combine():
         images = 0
         sets = 0
         combinable = [ImageType.LIGHT, ImageType.DARK, ImageType.BIAS, ImageType.FLAT]
-        images_with_meta = SetBuilder.find_unmatched_images()
-        for image in images_with_meta:
-            image_meta = MetadataAnalyser.normalize(image.get_header(), image.file.full_filename())
-            if image_meta is not None and image_meta.img_type in combinable:
-                matching_set = SetBuilder.find_matching_set(image_meta, image.file.path, image.file.root.get_id())
-                if matching_set is None:
-                    matching_set = SetBuilder.create_set(image_meta, image.file.path, image.file.root.get_id())
+        SetBuilder.normalize_missing()
+        index = SetIndex.load()
+        assignments: typing.Dict[int, typing.List[int]] = dict()  # set id -> image rowids
+        for (image, image_meta) in SetBuilder.find_unmatched_infos():
+            if image_meta.img_type in combinable:
+                key = SetIndex.key(image_meta, image.file.path, image.file.root_id)
+                set_id = index.find(key, image_meta.set_temperature)
+                if set_id is None:
+                    matching_set = SetBuilder.create_set(image_meta, image.file.path, image.file.root_id)
+                    set_id = matching_set.get_id()
+                    # index the temperature the way the database stores it
+                    index.add(key, ImageSet.set_temperature.db_value(image_meta.set_temperature), set_id)
                     sets += 1
-                image.image_set = matching_set.get_id()
-                image.save()
+                assignments.setdefault(set_id, list()).append(image.rowid)
                 images += 1
+        SetBuilder.assign_sets(assignments)
         return images, sets
 
+    @staticmethod
+    def assign_sets(assignments: typing.Dict[int, typing.List[int]]):
+        for (set_id, image_ids) in assignments.items():
+            for batch in chunked(image_ids, SetBuilder.UPDATE_BATCH):
+                Image.update(image_set=set_id).where(Image.rowid.in_(batch)).execute()
+
     @staticmethod
     def find_matching_set(image_meta: NormalizedImageMeta, path: str, root_id: int):
         where_clauses = [ImageSet.path == path,
@@ -55,11 +127,78 @@ class SetBuilder:
         return matching_set
 
     @staticmethod
-    def find_unmatched_images() -> Iterable[Image]:
-        images = Image.select(Image, File).join(File).where(Image.image_set.is_null())
-        meta = ImageMeta.select()
-        images_with_meta = prefetch(images, meta)
-        return images_with_meta
+    def normalize_missing() -> int:
+        """ fills in the ImageInfo of images that were extracted before it was stored """
+        count = 0
+        rows = []
+        for (image, header) in SetBuilder.find_unnormalized_images():
+            image_meta = MetadataAnalyser.normalize(header, image.file.full_filename())
+            if image_meta is None:
+                image_meta = NormalizedImageMeta()  # stored as UNKNOWN, so it is not normalized again every run
+            rows.append((image.rowid,) + ImageInfo.to_row(image_meta))
+            if len(rows) >= SetBuilder.UPDATE_BATCH:
+                count += SetBuilder._insert_info(rows)
+        count += SetBuilder._insert_info(rows)
+        if count > 0:
+            logger.info("normalized the metadata of %d images" % count)
+        return count
+
+    @staticmethod
+    def _insert_info(rows) -> int:
+        count = len(rows)
+        insert_image_info(rows)
+        rows.clear()
+        return count
+
+    @staticmethod
+    def find_unmatched_infos(page_size: int = None) -> Iterable[typing.Tuple[Image, NormalizedImageMeta]]:
+        """ images that are not in a set yet, with their stored ImageInfo, in rowid-ordered pages """
+        page_size = page_size or SetBuilder.PAGE_SIZE
+        query = ImageInfo.select(ImageInfo, Image.rowid, File.rowid, File.path, File.name, Root.rowid, Root.last_path) \
+            .join(Image).join(File).join(Root) \
+            .where(Image.image_set.is_null())
+        last_rowid = 0
+        while True:
+            infos = list(query.where(ImageInfo.image > last_rowid).order_by(ImageInfo.image).limit(page_size))
+            if len(infos) == 0:
+                return
+            last_rowid = infos[-1].image.rowid
+            for info in infos:
+                yield info.image, info.to_meta()
+
+    @staticmethod
+    def find_unmatched_images(page_size: int = None) -> Iterable[typing.Tuple[Image, typing.Dict[str, typing.Any]]]:
+        """ images that are not in a set yet, with a header of only the keywords normalization looks at """
+        query = SetBuilder._images().where(Image.image_set.is_null())
+        return SetBuilder._with_headers(query, page_size or SetBuilder.PAGE_SIZE)
+
+    @staticmethod
+    def find_unnormalized_images(page_size: int = None) -> Iterable[typing.Tuple[Image, typing.Dict[str, typing.Any]]]:
+        """ images without an ImageInfo, with a header of only the keywords normalization looks at """
+        query = SetBuilder._images().switch(Image).join(ImageInfo, JOIN.LEFT_OUTER).where(ImageInfo.image.is_null())
+        return SetBuilder._with_headers(query, page_size or SetBuilder.PAGE_SIZE)
+
+    @staticmethod
+    def _images():
+        return Image.select(Image.rowid, File.rowid, File.path, File.name, Root.rowid, Root.last_path) \
+            .join(File).join(Root)
+
+    @staticmethod
+    def _with_headers(query, page_size: int) -> Iterable[typing.Tuple[Image, typing.Dict[str, typing.Any]]]:
+        """ runs an image query in rowid-ordered pages, so memory stays bounded and the caller can write between
+            pages (as long as what it writes keeps the images it has seen out of the query)
+        """
+        keys = sorted(MetadataAnalyser.header_keys())
+        key_ids = KeyIds()
+        last_rowid = 0
+        while True:
+            images = list(query.where(Image.rowid > last_rowid).order_by(Image.rowid).limit(page_size))
+            if len(images) == 0:
+                return
+            last_rowid = images[-1].rowid
+            headers = read_header_dicts([image.rowid for image in images], keys, key_ids)
+            for image in images:
+                yield image, headers.get(image.rowid, dict())
 
     @classmethod
     def create_set(cls, image_meta: NormalizedImageMeta, path: str, root_id: int) -> ImageSet:
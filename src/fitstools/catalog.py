@@ -1,16 +1,20 @@
+import json
 import os
+import re
+import threading
+import typing
 
 import astropy.units as u
 import astropy.wcs as wcs
 import numpy as np
 import pandas
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, ICRS
 from astropy.io.fits import Header
-from astropy.wcs.utils import pixel_to_skycoord
+from astropy.wcs.utils import pixel_to_skycoord, wcs_to_celestial_frame
 from astropy_healpix import HEALPix
 from logzero import logger
-from pandas.core.groupby import DataFrameGroupBy
 
+from .config import Config
 from .image import ImageMeta
 
 
@@ -27,13 +31,134 @@ class Entry:
         return str(self)
 
 
+class CatalogIndex:
+    """ all catalog entries as flat arrays sorted by HEALPix pixel, the entries of pixel p are the slice
+        offsets[p]:offsets[p + 1]. Built once from the CSVs and saved as .npy files, which are memory-mapped when
+        opened so a lookup only pages in the pixels it reads. The index is rebuilt when the CSVs change.
+    """
+    VERSION = 1
+    ARRAYS = ("ra", "dec", "name", "offsets")
+    STAMP = "index.json"
+
+    def __init__(self, ra: np.ndarray, dec: np.ndarray, name: np.ndarray, offsets: np.ndarray):
+        self.ra = ra  # degrees
+        self.dec = dec  # degrees
+        self.name = name  # utf-8 bytes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.ra)
+
+    def pixel(self, pix: int) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ the ra, dec and name of the entries in a pixel, as views on the mapped arrays """
+        start, end = self.offsets[pix], self.offsets[pix + 1]
+        return self.ra[start:end], self.dec[start:end], self.name[start:end]
+
+    @classmethod
+    def open(cls, sources: typing.List[str], directory: str, nside: int) -> "CatalogIndex":
+        stamp = cls._stamp(sources, nside)
+        if cls._read_stamp(directory) != stamp:
+            logger.info("building catalog index in %s", directory)
+            cls.build(sources, directory, nside)
+            cls._write_stamp(directory, stamp)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "CatalogIndex":
+        arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in cls.ARRAYS]
+        return cls(*arrays)
+
+    @classmethod
+    def build(cls, sources: typing.List[str], directory: str, nside: int):
+        frames = [load_csv(source) for source in sources]
+        if frames:
+            entries = pandas.concat(frames, ignore_index=True)
+        else:
+            entries = pandas.DataFrame(columns=['ra', 'dec', 'name'])
+        ra = entries.ra.to_numpy(dtype=np.float64) / (864000 / 360)
+        dec = entries.dec.to_numpy(dtype=np.float64) / (324000 / 90)
+        hp = HEALPix(nside=nside, frame='icrs')
+        pixels = hp.lonlat_to_healpix(ra * u.deg, dec * u.deg)
+        order = np.argsort(pixels, kind="stable")  # keeps the catalog order within a pixel
+        names = np.array(entries.name.fillna("").str.encode("utf-8").to_numpy(), dtype=np.bytes_)
+        offsets = np.searchsorted(pixels[order], np.arange(hp.npix + 1)).astype(np.int64)
+        os.makedirs(directory, exist_ok=True)
+        for (name, array) in zip(cls.ARRAYS, (ra[order], dec[order], names[order], offsets)):
+            # write aside and swap in, a reader never maps a half written file
+            tmp_file = os.path.join(directory, "%s.%d.tmp.npy" % (name, os.getpid()))
+            np.save(tmp_file, array)
+            os.replace(tmp_file, os.path.join(directory, name + ".npy"))
+
+    @classmethod
+    def _stamp(cls, sources: typing.List[str], nside: int) -> typing.Dict[str, typing.Any]:
+        files = []
+        for source in sources:
+            stat = os.stat(source)
+            files.append([os.path.abspath(source), stat.st_size, stat.st_mtime_ns])
+        return {"version": cls.VERSION, "nside": nside, "files": files}
+
+    @classmethod
+    def _read_stamp(cls, directory: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        try:
+            with open(os.path.join(directory, cls.STAMP), encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def _write_stamp(cls, directory: str, stamp: typing.Dict[str, typing.Any]):
+        # written last: an interrupted build leaves a missing or stale stamp, and gets rebuilt next time
+        tmp_file = os.path.join(directory, "%s.%d.tmp" % (cls.STAMP, os.getpid()))
+        with open(tmp_file, "w", encoding="utf-8") as fh:
+            json.dump(stamp, fh)
+        os.replace(tmp_file, os.path.join(directory, cls.STAMP))
+
+
+# the keywords WCS reads: parsing only these is several times faster than building it from a full header
+_WCS_KEYWORD = re.compile(r"^(NAXIS\d*|WCSAXES\w?|CTYPE|CRVAL|CRPIX|CDELT|CUNIT|CROTA|CD\d+_|PC\d+_|PV\d+_|PS\d+_|"
+                          r"LONPOLE|LATPOLE|RADESYS|RADECSYS|EQUINOX|EPOCH|DATE-OBS|MJD-OBS|[AB]P?_|D[PQ]\d)")
+
+
+def _wcs_cards(header: Header) -> Header:
+    return Header([card for card in header.cards if _WCS_KEYWORD.match(card.keyword)])
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """ the concatenation of arange(start, start + count) for each start and count """
+    nonempty = counts > 0
+    (starts, counts) = (starts[nonempty], counts[nonempty])
+    if len(counts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.cumsum(counts)
+    steps = np.ones(ends[-1], dtype=np.int64)
+    steps[0] = starts[0]
+    steps[ends[:-1]] = starts[1:] - (starts[:-1] + counts[:-1] - 1)  # from the last of a range to the next start
+    return np.cumsum(steps)
+
+
+def _separation(lon1, lat1, lon2, lat2) -> np.ndarray:
+    """ angular distance in degrees (Vincenty, like astropy's angular_separation) """
+    (lon1, lat1, lon2, lat2) = map(np.radians, (lon1, lat1, lon2, lat2))
+    dlon = lon2 - lon1
+    num1 = np.cos(lat2) * np.sin(dlon)
+    num2 = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    denominator = np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(np.hypot(num1, num2), denominator))
+
+
+def load_csv(file) -> pandas.DataFrame:
+    """ an ASTAP/HNSKY catalog: ra in [0..864000], dec in [-324000..324000], names """
+    return pandas.read_csv(file, skiprows=1, engine='c', usecols=[0, 1, 2], header=0,
+                           names=['ra', 'dec', 'name'], dtype={'ra': np.int32, 'dec': np.int32, 'name': object})
+
+
 class Catalogs:
-    _catalog: DataFrameGroupBy
+    _index: CatalogIndex
 
-    def __init__(self) -> None:
+    def __init__(self, index_dir: str = None) -> None:
         super().__init__()
         self.hp = HEALPix(nside=16, frame='icrs')
-        self._load_data()
+        self._load_data(index_dir or Config.CATALOG_INDEX_DIR)
 
     def find_objects(self, header: Header):
         logger.info("searching catalog")
@@ -47,37 +172,114 @@ class Catalogs:
         radius = max(dist_corners)
         hp_pix = self.hp.cone_search_skycoord(center_coord, radius=radius)
         for pix in hp_pix:
-            group = self._catalog.get_group(pix)
-            group_res = world.footprint_contains(SkyCoord(group.ra * u.deg, group.dec * u.deg))
-            matches = list(group[group_res].itertuples(index=False, name=None))
-            result.extend(matches)
+            (ra, dec, name) = self._index.pixel(pix)
+            if len(ra) == 0:
+                continue
+            group_res = world.footprint_contains(SkyCoord(ra * u.deg, dec * u.deg))
+            result.extend(zip(ra[group_res].tolist(), dec[group_res].tolist(),
+                              (n.decode("utf-8") for n in name[group_res])))
         return result
 
-    def _load_csv(self, file):
-        df = pandas.read_csv(file, skiprows=1, engine='c', usecols=[0, 1, 2], header=0,
-                             names=['ra', 'dec', 'name'], dtype={'ra': np.int, 'dec': np.int, 'name': np.object})
-        return df
+    def find_objects_many(self, headers: typing.Iterable[Header]) -> typing.List[typing.List[typing.Tuple]]:
+        """ find_objects for a batch of solved images, e.g. all subs of a night. The catalog entries of the union of
+            the cone search pixels are read once, overlapping images share them, and the containment test is one
+            vectorized world to pixel transformation per image
+        """
+        fields = [self._field(header) for header in headers]
+        logger.info("searching catalog for %d images", len(fields))
+        pixels = np.unique(np.concatenate([field[-1] for field in fields if field is not None] + [np.zeros(0, int)]))
+        starts = self._index.offsets[pixels]
+        counts = self._index.offsets[pixels + 1] - starts
+        rows = _ranges(starts, counts)  # the entries of all pixels, the slice of pixels[i] starts at firsts[i]
+        firsts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        ra = self._index.ra[rows]
+        dec = self._index.dec[rows]
+        in_frame = dict()  # the entries transformed to each WCS frame in use, usually just ICRS
+        names = dict()  # decoded names by position in rows
+        results = []
+        for field in fields:
+            if field is None:
+                results.append([])
+                continue
+            (world, frame, (xmax, ymax), image_pixels) = field
+            frame_key = repr(frame)
+            if frame_key not in in_frame:
+                in_frame[frame_key] = (ra, dec) if isinstance(frame, ICRS) else self._transform(ra, dec, frame)
+            (lon, lat) = in_frame[frame_key]
+            at = np.searchsorted(pixels, image_pixels)
+            candidates = _ranges(firsts[at], counts[at])
+            (x, y) = world.all_world2pix(lon[candidates], lat[candidates], 0, quiet=True)
+            # same bounds as SkyCoord.contained_by
+            matches = candidates[(x < xmax) & (x > 0) & (y < ymax) & (y > 0)]
+            for i in matches.tolist():
+                if i not in names:
+                    names[i] = self._index.name[rows[i]].decode("utf-8")
+            results.append(list(zip(ra[matches].tolist(), dec[matches].tolist(), map(names.get, matches.tolist()))))
+        return results
+
+    def _field(self, header: Header):
+        """ the celestial WCS, its frame, image size and the HEALPix pixels covering an image """
+        world = wcs.WCS(_wcs_cards(header))
+        if not world.is_celestial:
+            world = world.celestial
+            if not world.has_celestial:
+                return None
+        image = ImageMeta.from_fits(header)
+        corners = world.calc_footprint(axes=(image.x, image.y))
+        (cx, cy) = image.center()
+        center = world.all_pix2world([[cx, cy]], 1)[0]
+        radius = _separation(center[0], center[1], corners[:, 0], corners[:, 1]).max()
+        frame = wcs_to_celestial_frame(world)
+        if not isinstance(frame, ICRS):
+            icrs = SkyCoord(center[0] * u.deg, center[1] * u.deg, frame=frame).icrs
+            center = (icrs.ra.deg, icrs.dec.deg)
+        image_pixels = self.hp.cone_search_lonlat(center[0] * u.deg, center[1] * u.deg, radius=radius * u.deg)
+        return world, frame, (image.x, image.y), image_pixels
 
-    def _load_data(self):
+    @staticmethod
+    def _transform(ra: np.ndarray, dec: np.ndarray, frame) -> typing.Tuple[np.ndarray, np.ndarray]:
+        coords = SkyCoord(ra * u.deg, dec * u.deg, frame='icrs').transform_to(frame).spherical
+        return coords.lon.deg, coords.lat.deg
+
+    def _load_data(self, index_dir: str):
         logger.info("loading catalogs")
+        self._index = CatalogIndex.open(self._sources(), index_dir, self.hp.nside)
+        logger.info("done loading catalogs, %d entries", len(self._index))
+
+    @staticmethod
+    def _sources() -> typing.List[str]:
         our_path = os.path.dirname(__file__)
-        ds = self._load_deep_sky(our_path)
-        leda = self._load_hyperleda(our_path)
-        all = pandas.concat([ds, leda])
-        all.ra = all.ra / np.float(864000 / 360)
-        all.dec = all.dec / np.float(324000 / 90)
-        ra = all.ra.to_numpy() * u.deg
-        dec = all.dec.to_numpy() * u.deg
-        all['hp'] = self.hp.lonlat_to_healpix(ra, dec)
-        self._catalog = all.groupby('hp')
-        logger.info("done loading catalogs")
-
-    def _load_hyperleda(self, our_path):
-        logger.info("loading hyperleda catalog")
-        hyperleda_file = os.path.join(our_path, "data/hyperleda.csv")
-        return self._load_csv(hyperleda_file)
-
-    def _load_deep_sky(self, our_path, ):
-        logger.info("loading deep sky catalog")
-        deep_sky_file = os.path.join(our_path, "data/deep_sky.csv")
-        return self._load_csv(deep_sky_file)
+        sources = []
+        for name in ("deep_sky.csv", "hyperleda.csv"):
+            file = os.path.join(our_path, "data", name)
+            if os.path.exists(file):
+                sources.append(file)
+            else:
+                logger.warning("catalog %s not found, skipped", file)
+        return sources
+
+
+_shared: typing.Optional[Catalogs] = None
+_shared_lock = threading.Lock()
+
+
+def shared_catalogs() -> Catalogs:
+    """ the Catalogs of this process, loaded on first use. Its arrays are read-only maps of the index files: workers
+        forked after it was loaded inherit the maps, and any other process opening the same index maps the same
+        page cache pages, so no process holds a private copy of the catalog
+    """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = Catalogs()
+    return _shared
+
+
+def _after_fork_in_child():
+    global _shared_lock
+    _shared_lock = threading.Lock()  # another thread of the parent may have held it while loading
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,3 +1,8 @@
+import os
+
+
 class Config:
     TZ_OFFSET = -1
     TEMP_DELTA = 0.5
+    COMPACT_HEADERS = False  # store extracted headers as ImageHeader blobs instead of ImageMeta rows
+    CATALOG_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".fitstools", "catalog_index")  # see CatalogIndex
@@ -1,11 +1,18 @@
+import datetime
 import gzip
+import json
 import lzma
 import os.path
 import typing
+import zlib
 
 from astropy.io.fits import Header
+from astropy.io.fits.card import Undefined
 from playhouse.sqlite_ext import *
 
+from fitstools.model import NormalizedImageMeta, ImageType
+from fitstools.util import read_primary_header
+
 
 def auto_str(cls):
     def __str__(self):
@@ -86,6 +93,25 @@ class File(Model):
         else:
             return open(self.full_filename(), mode='rb')
 
+    def read_header(self) -> Header:
+        """ reads the primary header only, without reading or decompressing the data """
+        with self.fopen() as fd:
+            return read_primary_header(fd)
+
+
+@auto_str
+class DirStamp(Model):
+    """ modification time and entry count of a directory when it was last listed """
+    root = ForeignKeyField(Root, on_delete='CASCADE')
+    path = CharField()
+    mtime_millis = IntegerField()
+    entries = IntegerField()
+
+    class Meta:
+        indexes = (
+            (('root', 'path'), True),
+        )
+
 
 # @auto_str
 # class FileMeta(Model):
@@ -115,28 +141,229 @@ class ImageSet(Model):
     telescope = CharField(null=True)
     capture_date = DateField()
 
+    class Meta:
+        indexes = (
+            # equality columns of SetBuilder.find_matching_set, the temperature range last
+            (('root', 'path', 'capture_date', 'img_type', 'exposure', 'set_temperature'), False),
+        )
+
 
 @auto_str
 class Image(Model):
     rowid = RowIDField()
     file = ForeignKeyField(File, on_delete='CASCADE', backref='images', null=False)
-    image_set = ForeignKeyField(File, on_delete='SET NULL', backref='images', null=True)
+    image_set = ForeignKeyField(ImageSet, on_delete='SET NULL', backref='images', null=True)
 
     def get_header(self) -> Header:
+        compact = ImageHeader.get_or_none(ImageHeader.image == self.rowid)
+        if compact is not None:
+            cards = compact.cards()
+            return Header(list(compact.to_dict(HeaderKey.names(compact.key_ids(cards)), cards=cards).items()))
         meta_dict = {meta.key: meta.value for meta in self.metadata}
         return Header(meta_dict)
 
 
 @auto_str
 class ImageMeta(Model):
-    image = ForeignKeyField(Image, on_delete='CASCADE', backref='metadata')
+    image = ForeignKeyField(Image, on_delete='CASCADE', backref='metadata', index=False)  # see (image, key)
     key = CharField()
     value = CharField()
 
     class Meta:
         indexes = (
             (('key', 'value'), False),  # Note the trailing comma!
+            (('image', 'key'), True),
         )
 
 
-CORE_MODELS = [Root, File, Image, ImageMeta, ImageSet]
+@auto_str
+class HeaderKey(Model):
+    """ the header keywords of the compact header store, an ImageHeader refers to them by id """
+    key = CharField(unique=True)
+
+    @staticmethod
+    def names(key_ids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        return dict(HeaderKey.select(HeaderKey.id, HeaderKey.key).where(HeaderKey.id.in_(list(key_ids))).tuples())
+
+
+@auto_str
+class ImageHeader(Model):
+    """ compact alternative to the ImageMeta rows: the header of an image as one compressed list of (key id, value)
+        cards, in header order, with the values as typed as JSON allows. The HOT_KEYS are promoted to columns of
+        their own so they can be queried, their cards only hold the key id.
+    """
+    HOT_KEYS = {"IMAGETYP": "imagetyp", "OBJECT": "object", "FILTER": "filter", "EXPOSURE": "exposure",
+                "EXPTIME": "exptime", "DATE-OBS": "date_obs", "INSTRUME": "instrume"}
+
+    image = ForeignKeyField(Image, on_delete='CASCADE', primary_key=True, backref='compact_header')
+    data = BlobField()
+    # untyped columns, SQLite keeps the type of each value
+    imagetyp = BareField(null=True, index=True)
+    object = BareField(null=True, index=True)
+    filter = BareField(null=True)
+    exposure = BareField(null=True)
+    exptime = BareField(null=True)
+    date_obs = BareField(null=True)
+    instrume = BareField(null=True)
+
+    @classmethod
+    def encode(cls, keys: typing.Sequence[str], values: typing.Sequence[typing.Any],
+               key_ids: typing.Dict[str, int]) -> typing.Dict[str, typing.Any]:
+        """ the column values of a row, key_ids has to have an id for each of the keys """
+        row = dict.fromkeys(cls.HOT_KEYS.values())
+        cards = []
+        for (key, value) in zip(keys, values):
+            value = _plain_value(value)
+            column = cls.HOT_KEYS.get(key)
+            if column is None or isinstance(value, bool):  # SQLite would turn a bool into an int
+                cards.append((key_ids[key], value))
+            else:
+                row[column] = value
+                cards.append((key_ids[key],))
+        row['data'] = zlib.compress(json.dumps(cards, separators=(',', ':')).encode('utf-8'))
+        return row
+
+    def cards(self) -> typing.List[typing.List]:
+        return json.loads(zlib.decompress(self.data))
+
+    def key_ids(self, cards: typing.List[typing.List] = None) -> typing.List[int]:
+        """ pass the cards if they were decoded already """
+        return [card[0] for card in (cards if cards is not None else self.cards())]
+
+    def to_dict(self, key_names: typing.Dict[int, str], keys: typing.Container[str] = None,
+                cards: typing.List[typing.List] = None) -> typing.Dict[str, typing.Any]:
+        """ the header as a keyword/value dict, only the given keys if any. Pass the cards if they were decoded
+            already
+        """
+        result = dict()
+        for card in (cards if cards is not None else self.cards()):
+            key = key_names[card[0]]
+            if keys is None or key in keys:
+                result[key] = card[1] if len(card) > 1 else getattr(self, self.HOT_KEYS[key])
+        return result
+
+
+def _plain_value(value):
+    if isinstance(value, (str, bool, int, float)) or value is None:
+        return value
+    if isinstance(value, Undefined):
+        return None
+    return str(value)
+
+
+@auto_str
+class ImageInfo(Model):
+    """ the normalized metadata of an image, see NormalizedImageMeta. Written when the metadata is extracted, so
+        grouping and reporting don't have to parse the ImageMeta strings again
+    """
+    image = ForeignKeyField(Image, on_delete='CASCADE', primary_key=True, backref='info')
+    img_type = CharField()
+    exposure = FloatField(null=True)
+    actual_temperature = FloatField(null=True)
+    set_temperature = FloatField(null=True)
+    camera_name = CharField(null=True)
+    object_name = CharField(null=True)
+    filter = CharField(null=True)
+    xbin = IntegerField(null=True)
+    ybin = IntegerField(null=True)
+    gain = IntegerField(null=True)
+    offset = IntegerField(null=True)
+    telescope = CharField(null=True)
+    datetime_utc = DateTimeField(null=True)  # naive, in UTC
+    datetime_local = DateTimeField(null=True)  # naive, local time
+    session_date = DateField(null=True)
+
+    class Meta:
+        indexes = (
+            (('session_date', 'img_type'), False),
+            (('object_name',), False),
+        )
+
+    @classmethod
+    def columns(cls) -> typing.List[Field]:
+        """ the columns of to_row, in order """
+        return [cls.img_type, cls.exposure, cls.actual_temperature, cls.set_temperature, cls.camera_name,
+                cls.object_name, cls.filter, cls.xbin, cls.ybin, cls.gain, cls.offset, cls.telescope,
+                cls.datetime_utc, cls.datetime_local, cls.session_date]
+
+    @staticmethod
+    def to_row(meta: NormalizedImageMeta) -> typing.Tuple:
+        datetime_utc = meta.datetime_utc
+        if datetime_utc is not None and datetime_utc.tzinfo is not None:
+            datetime_utc = datetime_utc.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        datetime_local = meta.datetime_local
+        if datetime_local is not None and datetime_local.tzinfo is not None:
+            datetime_local = datetime_local.replace(tzinfo=None)
+        return (meta.img_type.name, meta.exposure, meta.actual_temperature, meta.set_temperature, meta.camera_name,
+                meta.object_name, meta.filter, meta.xbin, meta.ybin, meta.gain, meta.offset, meta.telescope,
+                datetime_utc, datetime_local, meta.session_date())
+
+    def to_meta(self) -> NormalizedImageMeta:
+        meta = NormalizedImageMeta()
+        meta.img_type = ImageType[self.img_type]
+        meta.exposure = self.exposure
+        meta.actual_temperature = self.actual_temperature
+        meta.set_temperature = self.set_temperature
+        meta.camera_name = self.camera_name
+        meta.object_name = self.object_name
+        meta.filter = self.filter
+        meta.xbin = self.xbin
+        meta.ybin = self.ybin
+        meta.gain = self.gain
+        meta.offset = self.offset
+        meta.telescope = self.telescope
+        meta.datetime_utc = self.datetime_utc
+        meta.datetime_local = self.datetime_local
+        return meta
+
+
+@auto_str
+class ExtractJob(Model):
+    """ metadata extraction state of a file, so an interrupted run can resume and failures are not retried forever """
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    file = ForeignKeyField(File, on_delete='CASCADE', primary_key=True)
+    state = CharField(index=True)
+    attempts = IntegerField(default=0)
+    error = TextField(null=True)
+
+
+@auto_str
+class Solution(Model):
+    """ the plate solve result of a file: the WCS header, or why it did not solve. Valid while the size and mtime of
+        the File are the ones it was solved with
+    """
+    SOLVED = "solved"
+    FAILED = "failed"  # no solution, SolverFailure
+    ERROR = "error"  # the solver could not handle the file, SolverError
+
+    file = ForeignKeyField(File, on_delete='CASCADE', primary_key=True, backref='solution')
+    size = IntegerField()
+    mtime_millis = IntegerField()
+    state = CharField()
+    header = TextField(null=True)  # the cards, newline separated
+    error = TextField(null=True)
+    solved_at = DateTimeField(default=datetime.datetime.now)
+
+    def to_header(self) -> Header:
+        return Header.fromstring(self.header, sep="\n")
+
+
+@auto_str
+class ImageQuality(Model):
+    """ star and background statistics of an image, see analysis.quality """
+    image = ForeignKeyField(Image, on_delete='CASCADE', primary_key=True, backref='quality')
+    median_fwhm = FloatField(null=True)  # pixels
+    eccentricity = FloatField(null=True)
+    star_count = IntegerField(null=True)  # null if it could not be measured, see error
+    background = FloatField(null=True)  # ADU
+    noise = FloatField(null=True)  # ADU
+    fast = BooleanField()  # measured in fast mode
+    error = TextField(null=True)
+    measured_at = DateTimeField(default=datetime.datetime.now)
+
+
+CORE_MODELS = [Root, File, DirStamp, Image, ImageMeta, HeaderKey, ImageHeader, ImageInfo, ImageSet, ExtractJob,
+               Solution, ImageQuality]
@@ -0,0 +1,98 @@
+import itertools
+import typing
+
+from logzero import logger
+from peewee import chunked, JOIN
+
+from fitstools.db.database_peewee import Image, ImageMeta, HeaderKey, ImageHeader
+
+# the two layouts of the extracted headers: ImageMeta, a (image, key, value) row per card with the values as strings,
+# and ImageHeader, a compressed blob per image with typed values and the keys by id. Readers go through
+# read_header_dicts and get either one, so a database can be migrated while it is in use.
+
+
+class KeyIds:
+    """ the HeaderKey ids, cached for as long as a writer or reader lives """
+
+    def __init__(self):
+        self._ids: typing.Dict[str, int] = dict()
+        self._names: typing.Dict[int, str] = dict()
+
+    def ids(self, keys: typing.Iterable[str]) -> typing.Dict[str, int]:
+        """ adds the keys that are new, the cache knows all keys afterwards """
+        missing = {key for key in keys if key not in self._ids}
+        if missing:
+            for batch in chunked(missing, 500):
+                HeaderKey.insert_many([(key,) for key in batch], fields=[HeaderKey.key]).on_conflict_ignore().execute()
+                self._add(HeaderKey.select(HeaderKey.id, HeaderKey.key).where(HeaderKey.key.in_(batch)).tuples())
+        return self._ids
+
+    def names(self, key_ids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        missing = {key_id for key_id in key_ids if key_id not in self._names}
+        if missing:
+            for batch in chunked(missing, 500):
+                self._add(HeaderKey.select(HeaderKey.id, HeaderKey.key).where(HeaderKey.id.in_(batch)).tuples())
+        return self._names
+
+    def _add(self, rows):
+        for (key_id, key) in rows:
+            self._ids[key] = key_id
+            self._names[key_id] = key
+
+
+def write_compact(rows: typing.List[typing.Tuple[int, typing.Sequence[str], typing.Sequence[typing.Any]]],
+                  key_ids: KeyIds, batch_size: int = 100):
+    """ rows of (image rowid, keys, values) """
+    ids = key_ids.ids(itertools.chain.from_iterable(keys for (_, keys, _) in rows))
+    for batch in chunked(rows, batch_size):
+        ImageHeader.insert_many([dict(image=image_id, **ImageHeader.encode(keys, values, ids))
+                                 for (image_id, keys, values) in batch]).execute()
+
+
+def read_header_dicts(image_ids: typing.List[int], keys: typing.Collection[str] = None,
+                      key_ids: KeyIds = None) -> typing.Dict[int, typing.Dict[str, typing.Any]]:
+    """ the headers of the images, as keyword/value dicts, from whichever layout they are in. With keys, only those
+        keywords are read. Images without a header are left out.
+    """
+    key_ids = key_ids or KeyIds()
+    result = dict()
+    for batch in chunked(image_ids, 500):
+        headers = [(header, header.cards()) for header in ImageHeader.select().where(ImageHeader.image.in_(batch))]
+        names = key_ids.names(itertools.chain.from_iterable(header.key_ids(cards) for (header, cards) in headers))
+        for (header, cards) in headers:
+            result[header.image_id] = header.to_dict(names, keys, cards)
+        rest = [image_id for image_id in batch if image_id not in result]
+        if rest:
+            query = ImageMeta.select(ImageMeta.image, ImageMeta.key, ImageMeta.value).where(ImageMeta.image.in_(rest))
+            if keys is not None:
+                query = query.where(ImageMeta.key.in_(list(keys)))
+            for (image_id, key, value) in query.order_by(ImageMeta.id).tuples().iterator():
+                result.setdefault(image_id, dict())[key] = value
+    return result
+
+
+def migrate(page_size: int = 500, keep_rows: bool = False) -> int:
+    """ moves the headers stored as ImageMeta rows into ImageHeader, a transaction per page of images. The values
+        stay the strings ImageMeta holds, only headers extracted into ImageHeader have typed values.
+    """
+    key_ids = KeyIds()
+    database = Image._meta.database
+    count = 0
+    last_rowid = 0
+    while True:
+        with database.atomic():
+            page = [rowid for (rowid,) in Image.select(Image.rowid)
+                    .join(ImageHeader, JOIN.LEFT_OUTER, on=(ImageHeader.image == Image.rowid))
+                    .where(ImageHeader.image.is_null(), Image.rowid > last_rowid)
+                    .order_by(Image.rowid).limit(page_size).tuples()]
+            if len(page) == 0:
+                break
+            last_rowid = page[-1]
+            headers = read_header_dicts(page, key_ids=key_ids)
+            write_compact([(image_id, tuple(header.keys()), tuple(header.values()))
+                           for (image_id, header) in headers.items()], key_ids)
+            if not keep_rows:
+                ImageMeta.delete().where(ImageMeta.image.in_(page)).execute()
+            count += len(headers)
+        logger.info("migrated the headers of %d images" % count)
+    return count
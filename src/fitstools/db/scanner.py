@@ -1,22 +1,37 @@
 import os
+import re
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import List
 
+import fs.errors
 import fs.path
 from fs.base import FS
 from fs.info import Info
 from logzero import logger
-from peewee import Database, SqliteDatabase, Query
+from peewee import Database, SqliteDatabase, Query, chunked, EXCLUDED
 
-from fitstools.db.database_peewee import Root, File, CORE_MODELS
+from fitstools.db.database_peewee import Root, File, DirStamp, Image, ExtractJob, CORE_MODELS
 
 
-def explain_query_plan(query: Query):
+def explain_query_plan(query: Query) -> typing.List[str]:
+    """ the steps of the SQLite query plan, e.g. 'SEARCH file USING INDEX file_root_id_path_name (root_id=?)' """
     sql, params = query.sql()
+    return explain_sql(Root._meta.database, sql, params)
 
-    # To get the query plan:
-    curs = Root._meta.database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
-    print(curs.fetchall())  # prints query plan
+
+def explain_sql(database: Database, sql: str, params) -> typing.List[str]:
+    curs = database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+    return [row[-1] for row in curs.fetchall()]
+
+
+_FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?!CONSTANT ROW)\w')
+
+
+def full_scans(plan: typing.List[str]) -> typing.List[str]:
+    """ the steps of a query plan that read a whole table or index, subqueries and constants don't count """
+    return [step for step in plan if _FULL_SCAN.match(step)]
 
 
 class DataStorage:
@@ -51,23 +66,273 @@ class DataStorage:
         self.db.rollback()
 
 
-class ChangeList:
+class ScanStats:
     def __init__(self):
+        self.dirs = 0
+        self.entries = 0
+        self.skipped_dirs = 0
+        self.seconds = 0.0
+
+    def dirs_per_sec(self) -> float:
+        return self.dirs / self.seconds if self.seconds > 0 else 0.0
+
+    def entries_per_sec(self) -> float:
+        return self.entries / self.seconds if self.seconds > 0 else 0.0
+
+
+class ChangeList:
+    INSERT_BATCH = 100  # 5 columns per row, stays below the default SQLite limit of 999 variables
+    DELETE_BATCH = 500
+    FILE_FIELDS = [File.root, File.path, File.name, File.size, File.mtime_millis]
+
+    def __init__(self, flush_size: typing.Optional[int] = None):
+        """ flush_size: write the pending changes to the database as soon as this many have been collected, which
+            bounds memory while a huge root is walked. None keeps all changes in memory until apply_all().
+        """
+        self.flush_size = flush_size
         self.new_files = list()
         self.removed_files = list()
         self.changed_ids = list()
         self.changed_files = list()
+        self.dir_stamps = list()
+        self.removed_stamp_ids = list()
+        # totals, these keep counting when pending changes are flushed
+        self.new_count = 0
+        self.changed_count = 0
+        self.removed_count = 0
+        self.apply_seconds = 0.0
+        self.scan_stats = ScanStats()
+
+    def add_new(self, file: File):
+        self.new_files.append(file)
+        self.new_count += 1
+        self._check_flush()
+
+    def add_changed(self, rowid: int, file: File):
+        self.changed_ids.append(rowid)
+        self.changed_files.append(file)
+        self.changed_count += 1
+        self._check_flush()
+
+    def add_removed(self, file: File):
+        self.removed_files.append(file)
+        self.removed_count += 1
+        self._check_flush()
+
+    def add_dir_stamp(self, stamp: DirStamp):
+        self.dir_stamps.append(stamp)
+        self._check_flush()
+
+    def pending(self) -> int:
+        return len(self.new_files) + len(self.changed_files) + len(self.removed_files) + len(self.dir_stamps)
+
+    def _check_flush(self):
+        if self.flush_size is not None and self.pending() >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """ writes and forgets the pending changes """
+        start = time.perf_counter()
+        self._delete_files([file.rowid for file in self.removed_files])
+        self._insert_files(self.new_files)
+        self._upsert_files(self.changed_files)
+        # the file rows keep their rowid, but whatever was extracted from the old contents is stale. Their jobs
+        # go back to pending rather than away, JobQueue.enqueue_new only looks for files after the last job
+        for batch in chunked(self.changed_ids, ChangeList.DELETE_BATCH):
+            Image.delete().where(Image.file.in_(batch)).execute()
+            ExtractJob.update(state=ExtractJob.PENDING, attempts=0, error=None) \
+                .where(ExtractJob.file.in_(batch)).execute()
+        self._apply_dir_stamps()
+        for pending in (self.new_files, self.removed_files, self.changed_ids, self.changed_files, self.dir_stamps,
+                        self.removed_stamp_ids):
+            pending.clear()
+        self.apply_seconds += time.perf_counter() - start
 
     def apply_all(self):
-        File.bulk_create(self.new_files, batch_size=100)
-        for file in self.removed_files:
-            File.delete_by_id(file.rowid)
-        for id in self.changed_ids:  # delete and re-create
-            File.delete_by_id(id)
-        File.bulk_create(self.changed_files, batch_size=100)
+        self.flush()
+        rows = self.new_count + self.changed_count + self.removed_count
+        logger.info("applied %d new, %d changed, %d deleted files in %.2fs (%.0f rows/s)",
+                    self.new_count, self.changed_count, self.removed_count, self.apply_seconds,
+                    rows / self.apply_seconds if self.apply_seconds > 0 else 0.0)
+
+    @staticmethod
+    def _file_rows(files: typing.List[File]):
+        return [(file.root, file.path, file.name, file.size, file.mtime_millis) for file in files]
+
+    @staticmethod
+    def _insert_files(files: typing.List[File]):
+        for batch in chunked(files, ChangeList.INSERT_BATCH):
+            File.insert_many(ChangeList._file_rows(batch), fields=ChangeList.FILE_FIELDS).execute()
+
+    @staticmethod
+    def _upsert_files(files: typing.List[File]):
+        for batch in chunked(files, ChangeList.INSERT_BATCH):
+            File.insert_many(ChangeList._file_rows(batch), fields=ChangeList.FILE_FIELDS) \
+                .on_conflict(conflict_target=[File.root, File.path, File.name],
+                             update={File.size: EXCLUDED.size, File.mtime_millis: EXCLUDED.mtime_millis}) \
+                .execute()
+
+    @staticmethod
+    def _delete_files(rowids: typing.List[int]):
+        for batch in chunked(rowids, ChangeList.DELETE_BATCH):
+            File.delete().where(File.rowid.in_(batch)).execute()
+
+    def _apply_dir_stamps(self):
+        fields = [DirStamp.root, DirStamp.path, DirStamp.mtime_millis, DirStamp.entries]
+        for batch in chunked(self.dir_stamps, ChangeList.INSERT_BATCH):
+            rows = [(stamp.root, stamp.path, stamp.mtime_millis, stamp.entries) for stamp in batch]
+            DirStamp.insert_many(rows, fields=fields).on_conflict_replace().execute()
+        for batch in chunked(self.removed_stamp_ids, ChangeList.DELETE_BATCH):
+            DirStamp.delete().where(DirStamp.id.in_(batch)).execute()
+
+
+class _SerialLister:
+    """ lists a directory when it is taken off the queue """
+
+    def __init__(self, root_fs: FS):
+        self.root_fs = root_fs
+
+    def queue(self, path: str):
+        pass
+
+    def listing(self, path: str) -> List[Info]:
+        return list(self.root_fs.scandir(path, namespaces=['details']))
+
+    def close(self):
+        pass
+
+
+class _ParallelLister(_SerialLister):
+    """ lists directories on a thread pool ahead of the walker, so listings are ready when it gets to them. The walk
+        order itself (and all database access) stays on the calling thread. No more than LOOKAHEAD listings per
+        worker are outstanding at a time, the rest of the queue waits until the walker catches up.
+    """
+    LOOKAHEAD = 4
+
+    def __init__(self, root_fs: FS, workers: int):
+        super().__init__(root_fs)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scandir")
+        self.lookahead = workers * _ParallelLister.LOOKAHEAD
+        self.waiting: List[str] = []  # same order as the walker's stack, the top is listed next
+        self.pending: typing.Dict[str, Future] = dict()
+
+    def queue(self, path: str):
+        self.waiting.append(path)
+
+    def listing(self, path: str) -> List[Info]:
+        self._fill()
+        future = self.pending.pop(path, None)
+        if future is None:
+            # the lookahead is taken by directories further down the walker's stack
+            if self.waiting and self.waiting[-1] == path:
+                self.waiting.pop()
+            else:
+                self.waiting.remove(path)
+            result = super().listing(path)
+        else:
+            result = future.result()
+        self._fill()
+        return result
+
+    def _fill(self):
+        while self.waiting and len(self.pending) < self.lookahead:
+            path = self.waiting.pop()
+            self.pending[path] = self.pool.submit(super().listing, path)
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.waiting.clear()
+        self.pool.shutdown(wait=True)
+
+
+# (size, mtime_millis, rowid) of a file already in the database, keyed by name
+KnownFiles = typing.Dict[str, typing.Tuple[int, int, int]]
+
+
+class _DirectorySnapshot:
+    """ existing file rows of a root, loaded with one query per directory """
+
+    def __init__(self, root: Root):
+        self.root = root
+
+    def take(self, path: str) -> KnownFiles:
+        query = File.select(File.name, File.size, File.mtime_millis, File.rowid) \
+            .where(File.root == self.root, File.path == path)
+        return {name: (size, mtime_millis, rowid) for (name, size, mtime_millis, rowid) in query.tuples().iterator()}
+
+    def skip(self, path: str):
+        """ the directory is unchanged, its known files stay as they are """
+        pass
+
+    def leftovers(self, visited_dirs: typing.Set[str]) -> typing.Iterable[typing.Tuple[str, KnownFiles]]:
+        """ files in directories that were not visited by the walk, i.e. that have been deleted """
+        query = File.select(File.path).distinct().where(File.root == self.root)
+        old_paths = [old_path for (old_path,) in query.tuples().iterator() if old_path not in visited_dirs]
+        for old_path in old_paths:
+            yield old_path, self.take(old_path)
+
+
+class _RootSnapshot(_DirectorySnapshot):
+    """ existing file rows of a root, loaded up front with a single streamed query """
+
+    def __init__(self, root: Root):
+        super().__init__(root)
+        self.dirs: typing.Dict[str, KnownFiles] = dict()
+        query = File.select(File.path, File.name, File.size, File.mtime_millis, File.rowid) \
+            .where(File.root == root).order_by(File.path, File.name)
+        for (path, name, size, mtime_millis, rowid) in query.tuples().iterator():
+            self.dirs.setdefault(path, dict())[name] = (size, mtime_millis, rowid)
+
+    def take(self, path: str) -> KnownFiles:
+        return self.dirs.pop(path, dict())
+
+    def skip(self, path: str):
+        self.dirs.pop(path, None)
+
+    def leftovers(self, visited_dirs: typing.Set[str]) -> typing.Iterable[typing.Tuple[str, KnownFiles]]:
+        return list(self.dirs.items())
+
+
+class _DirStamps:
+    """ directory stamps of a root as recorded by the previous import """
+
+    def __init__(self, root: Root):
+        self.stamps: typing.Dict[str, typing.Tuple[int, int, int]] = dict()
+        self.children: typing.Dict[str, typing.List[str]] = dict()
+        query = DirStamp.select(DirStamp.path, DirStamp.mtime_millis, DirStamp.entries, DirStamp.id) \
+            .where(DirStamp.root == root).order_by(DirStamp.path)
+        for (path, mtime_millis, entries, stamp_id) in query.tuples().iterator():
+            self.stamps[path] = (mtime_millis, entries, stamp_id)
+            if path != '.':
+                self.children.setdefault(fs.path.dirname(path) or '.', list()).append(path)
+
+    def unchanged(self, path: str, mtime_millis: typing.Optional[int]) -> bool:
+        stamp = self.stamps.get(path)
+        return stamp is not None and mtime_millis is not None and stamp[0] == mtime_millis
+
+    def changed(self, path: str, mtime_millis: int, entries: int) -> bool:
+        return self.stamps.get(path, (None, None, None))[0:2] != (mtime_millis, entries)
+
+    def removed_ids(self, visited_dirs: typing.Set[str]) -> typing.List[int]:
+        return [stamp_id for (path, (_, _, stamp_id)) in self.stamps.items() if path not in visited_dirs]
 
 
 class Importer:
+    def __init__(self, workers: int = 1, preload_root: bool = False, incremental: bool = False,
+                 flush_size: typing.Optional[int] = None):
+        """ workers: number of threads listing directories concurrently, 1 means a plain serial walk
+            preload_root: load the known files of a whole root in one query instead of one query per directory
+            incremental: skip listing directories whose modification time did not change since the last import.
+                Note that this misses files that were modified in place, as that does not touch the directory.
+            flush_size: stream changes to the database in batches of this size during the walk, see ChangeList
+        """
+        self.workers = workers
+        self.preload_root = preload_root
+        self.incremental = incremental
+        self.flush_size = flush_size
+
     @staticmethod
     def marked_bad(f: Info) -> bool:
         """" skips over files that are marked bad """
@@ -108,56 +373,109 @@ class Importer:
 
     # TODO: check root exists and is non-empty
     def import_files_from(self, root_fs: FS, root: Root) -> ChangeList:
-        dir_queue: List[str] = ['.']
-        all_dirs = set(dir_queue)
-        result = ChangeList()
+        lister = self._create_lister(root_fs)
+        try:
+            return self._walk(lister, root)
+        finally:
+            lister.close()
+
+    def _create_lister(self, root_fs: FS) -> _SerialLister:
+        if self.workers > 1:
+            return _ParallelLister(root_fs, self.workers)
+        return _SerialLister(root_fs)
+
+    def _walk(self, lister: _SerialLister, root: Root) -> ChangeList:
+        # queue of (path, mtime_millis, skip) so the listing of skipped directories is never requested
+        dir_queue: List[typing.Tuple[str, typing.Optional[int], bool]] = []
+        all_dirs = set()
+        result = ChangeList(self.flush_size)
+        stats = result.scan_stats
+        start = time.perf_counter()
+        snapshot = _RootSnapshot(root) if self.preload_root else _DirectorySnapshot(root)
+        stamps = _DirStamps(root)
+        new_stamps: List[DirStamp] = []
+
+        def enqueue(path: str, mtime_millis: typing.Optional[int]):
+            skip = self.incremental and stamps.unchanged(path, mtime_millis)
+            if not skip:
+                lister.queue(path)
+            dir_queue.append((path, mtime_millis, skip))
+            all_dirs.add(path)
+
+        enqueue('.', self._mtime_millis(lister.root_fs.getinfo('.', ['details'])))
         while len(dir_queue) > 0:
-            current_dir: str = dir_queue.pop()
-            filtered_files = set()
+            (current_dir, dir_mtime_millis, skip) = dir_queue.pop()
+            if skip:
+                snapshot.skip(current_dir)
+                stats.skipped_dirs += 1
+                # the listing is unchanged, so are the subdirectories recorded last time
+                for dir_path in stamps.children.get(current_dir, []):
+                    try:
+                        enqueue(dir_path, self._mtime_millis(lister.root_fs.getinfo(dir_path, ['details'])))
+                    except fs.errors.ResourceNotFound:
+                        pass  # gone, its files are evicted below
+                continue
+
+            known_files = snapshot.take(current_dir)
             entry: Info
-            for entry in root_fs.scandir(current_dir, namespaces=['details']):
+            entries = lister.listing(current_dir)
+            stats.dirs += 1
+            stats.entries += len(entries)
+            if dir_mtime_millis is not None and stamps.changed(current_dir, dir_mtime_millis, len(entries)):
+                new_stamps.append(
+                    DirStamp(root=root, path=current_dir, mtime_millis=dir_mtime_millis, entries=len(entries)))
+            for entry in entries:
                 if entry.is_dir:
                     if self._dir_filter(entry):
-                        dir_path = fs.path.join(current_dir, entry.name)
-                        dir_queue.append(dir_path)
-                        all_dirs.add(dir_path)
+                        enqueue(fs.path.join(current_dir, entry.name), self._mtime_millis(entry))
                     else:
                         pass  # TODO: log skipping
                 if entry.is_file:
                     if self._file_filter(entry):
-                        self._import_file(entry, current_dir, root, result)
-                        filtered_files.add(entry.name)
+                        self._import_file(entry, current_dir, root, result, known_files)
                     else:
                         pass  # TODO: log skipping
 
             # evict deleted files
-            query = File.select(File.rowid, File.name).where(File.root == root, File.path == current_dir)
-            for file in query.execute():
-                if file.name not in filtered_files:
-                    result.removed_files.append(file)
+            self._remove_files(current_dir, root, result, known_files)
 
         # clean up deleted dirs
-        query = File.select(File.path).distinct().where(File.root == root)
-        for (old_path,) in query.tuples().iterator():
-            if old_path not in all_dirs:
-                files = File.select().where(File.root == root, File.path == old_path).execute()
-                for file in files:
-                    result.removed_files.append(file)
+        for (old_path, old_files) in snapshot.leftovers(all_dirs):
+            self._remove_files(old_path, root, result, old_files)
+        result.removed_stamp_ids.extend(stamps.removed_ids(all_dirs))
+        # only now: a stamp lets the next incremental run skip the directory and everything below it, so it may not
+        # be flushed before all of their files are
+        for stamp in new_stamps:
+            result.add_dir_stamp(stamp)
 
+        stats.seconds = time.perf_counter() - start
+        logger.info("[root %s] scanned %d dirs, %d entries in %.2fs (%.1f dirs/s, %.1f entries/s), "
+                    "%d unchanged dirs skipped", root.name, stats.dirs, stats.entries, stats.seconds,
+                    stats.dirs_per_sec(), stats.entries_per_sec(), stats.skipped_dirs)
         return result
 
-    def _import_file(self, file: Info, rel_path, root, changelist):
+    @staticmethod
+    def _mtime_millis(info: Info) -> typing.Optional[int]:
+        modified = info.modified
+        return int(modified.timestamp() * 1000) if modified is not None else None
+
+    @staticmethod
+    def _remove_files(rel_path, root, changelist, known_files: KnownFiles):
+        """ known files that were not claimed by _import_file are gone from the file system """
+        for (name, (_, _, rowid)) in known_files.items():
+            changelist.add_removed(File(rowid=rowid, root=root, path=rel_path, name=name))
+
+    def _import_file(self, file: Info, rel_path, root, changelist, known_files: KnownFiles):
         logger.debug("[root %s] record file stats: %s/%s", root.name, rel_path, file.name)
 
-        mtime_millis = int(file.modified.timestamp() * 1000)
+        mtime_millis = self._mtime_millis(file)
 
-        db_file = File.select(File.rowid, File.size, File.mtime_millis) \
-            .where(File.root == root, File.path == rel_path, File.name == file.name).get_or_none()
+        db_file = known_files.pop(file.name, None)
         if db_file is None:
             model = File(name=file.name, path=rel_path, root=root, size=file.size, mtime_millis=mtime_millis)
-            changelist.new_files.append(model)
+            changelist.add_new(model)
         else:
-            if db_file.mtime_millis != mtime_millis or db_file.size != file.size:
+            (db_size, db_mtime_millis, db_rowid) = db_file
+            if db_mtime_millis != mtime_millis or db_size != file.size:
                 model = File(name=file.name, path=rel_path, root=root, size=file.size, mtime_millis=mtime_millis)
-                changelist.changed_ids.append(db_file.rowid)
-                changelist.changed_files.append(model)
+                changelist.add_changed(db_rowid, model)
@@ -0,0 +1,95 @@
+import typing
+from pathlib import Path
+
+from astropy.io.fits import Header
+from peewee import chunked
+
+from fitstools.db.database_peewee import File, Solution
+from fitstools.platesolve import ASTAPSolver, SolveJob, SolveScheduler, SolverError, SolverFailure, SolverTimeout
+
+SolveResult = typing.Tuple[File, typing.Optional[Header], typing.Optional[Exception]]
+
+
+class SolutionCache:
+    """ plate solve results in the Solution table, so a file is only solved again when it changed. Failures are
+        kept too, known unsolvable files are skipped unless retry_failed is set. Timeouts and cancellations are
+        not stored, a next run may well solve those
+    """
+    LOOKUP_BATCH = 500
+
+    @staticmethod
+    def lookup(files: typing.Iterable[File], retry_failed=False) -> typing.Dict[int, Solution]:
+        """ the valid solutions of the files, by file rowid """
+        result = dict()
+        for batch in chunked((file.rowid for file in files), SolutionCache.LOOKUP_BATCH):
+            query = Solution.select(Solution).join(File) \
+                .where(Solution.file.in_(batch), Solution.size == File.size, Solution.mtime_millis == File.mtime_millis)
+            if retry_failed:
+                query = query.where(Solution.state == Solution.SOLVED)
+            for solution in query:
+                result[solution.file_id] = solution
+        return result
+
+    @staticmethod
+    def store(file: File, header: Header = None, error: Exception = None) -> typing.Optional[Solution]:
+        """ stores a result, returns None for a result that is not worth keeping """
+        if header is not None:
+            state = Solution.SOLVED
+            text = header.tostring(sep="\n", endcard=False, padding=False)
+        elif isinstance(error, SolverError):
+            state = Solution.ERROR
+            text = None
+        elif isinstance(error, SolverFailure) and not isinstance(error, SolverTimeout):
+            state = Solution.FAILED
+            text = None
+        else:
+            return None
+        row = dict(file=file.rowid, size=file.size, mtime_millis=file.mtime_millis, state=state, header=text,
+                   error=None if error is None else str(error))
+        Solution.insert(**row).on_conflict_replace().execute()
+        return Solution(**row)
+
+    @staticmethod
+    def result(solution: Solution) -> typing.Tuple[typing.Optional[Header], typing.Optional[Exception]]:
+        if solution.state == Solution.SOLVED:
+            return solution.to_header(), None
+        if solution.state == Solution.ERROR:
+            return None, SolverError(solution.error)
+        return None, SolverFailure(solution.error, None)
+
+    @staticmethod
+    def solve(solver: ASTAPSolver, file: File, hint: typing.Dict[str, str] = None, retry_failed=False) -> Header:
+        """ ASTAPSolver.solve with the cache in front, raises the stored error of a file that did not solve """
+        solution = SolutionCache.lookup([file], retry_failed).get(file.rowid)
+        if solution is None:
+            try:
+                header = solver.solve(Path(file.full_filename()), hint)
+            except Exception as ex:
+                SolutionCache.store(file, error=ex)
+                raise
+            SolutionCache.store(file, header)
+            return header
+        (header, error) = SolutionCache.result(solution)
+        if error is not None:
+            raise error
+        return header
+
+    @staticmethod
+    def solve_all(scheduler: SolveScheduler, files: typing.Iterable[File],
+                  retry_failed=False) -> typing.Iterator[SolveResult]:
+        """ the cached results first, then the others as the scheduler solves them. Frames in the same directory
+            share hints
+        """
+        files = list(files)
+        cached = SolutionCache.lookup(files, retry_failed)
+        jobs = dict()
+        for file in files:
+            solution = cached.get(file.rowid)
+            if solution is not None:
+                yield (file,) + SolutionCache.result(solution)
+            else:
+                jobs[SolveJob(Path(file.full_filename()), set_key=(file.root_id, file.path))] = file
+        for job in scheduler.run(list(jobs.keys())):
+            file = jobs[job]
+            SolutionCache.store(file, job.header, job.error)
+            yield file, job.header, job.error
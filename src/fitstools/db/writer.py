@@ -0,0 +1,244 @@
+import itertools
+import sys
+import threading
+import time
+import traceback
+import typing
+
+from logzero import logger
+from peewee import chunked, EXCLUDED, Case, Value, JOIN, fn
+
+from fitstools.config import Config
+from fitstools.db.database_peewee import Root, File, Image, ImageMeta, ImageInfo, ExtractJob
+from fitstools.db.headerstore import KeyIds, write_compact
+from fitstools.util import FileRef
+
+# wire format between the analysis workers and the writer, kept to tuples of builtins to keep pickling cheap:
+# the file goes out as a FileRef, (rowid, root path, path, name), and comes back as the rowid with, for each image in
+# the file, a tuple of header keywords, a tuple of values and the normalized metadata as an ImageInfo.to_row tuple (or
+# None).
+# The last element is the error message if the analysis failed.
+InfoRow = typing.Tuple
+HeaderColumns = typing.Tuple[typing.Tuple[str, ...], typing.Tuple[typing.Any, ...], typing.Optional[InfoRow]]
+AnalysisResult = typing.Tuple[int, typing.List[HeaderColumns], typing.Optional[str]]
+
+
+def to_file_ref(file: File) -> FileRef:
+    return file.rowid, file.root.last_path, file.path, file.name
+
+
+def from_file_ref(file_ref: FileRef) -> File:
+    (rowid, root_path, path, name) = file_ref
+    return File(rowid=rowid, root=Root(last_path=root_path), path=path, name=name)
+
+
+def to_columns(header_dict: typing.Dict[str, typing.Any], info_row: InfoRow = None) -> HeaderColumns:
+    # interned keywords are the same objects in every header, so pickle writes them once per chunk
+    return tuple(sys.intern(key) for key in header_dict.keys()), tuple(header_dict.values()), info_row
+
+
+def insert_image_info(rows: typing.List[typing.Tuple]):
+    """ rows of the image rowid followed by an ImageInfo.to_row tuple """
+    fields = [ImageInfo.image] + ImageInfo.columns()
+    for batch in chunked(rows, 999 // len(fields)):
+        ImageInfo.insert_many(batch, fields=fields).execute()
+
+
+class JobQueue:
+    """ the ExtractJob table as a work queue """
+
+    @staticmethod
+    def enqueue_new(all_files: bool = False) -> int:
+        """ adds a pending job for every file that has none yet, files that already have images count as done.
+            Jobs are never deleted while their file exists (changed files are reset to pending), so only the files
+            added after the last job need to be looked at. all_files checks every file instead, with a full scan
+        """
+        state = Case(None, [(File.rowid.in_(Image.select(Image.file)), ExtractJob.DONE)], ExtractJob.PENDING)
+        query = File.select(File.rowid, state, Value(0)).join(ExtractJob, JOIN.LEFT_OUTER) \
+            .where(ExtractJob.file.is_null())
+        if not all_files:
+            last_job = ExtractJob.select(fn.MAX(ExtractJob.file)).scalar()
+            query = query.where(File.rowid > (last_job or 0))
+        ExtractJob.insert_from(query, fields=[ExtractJob.file, ExtractJob.state, ExtractJob.attempts]).execute()
+        return JobQueue.count(ExtractJob.PENDING)
+
+    @staticmethod
+    def count(state: str) -> int:
+        return ExtractJob.select().where(ExtractJob.state == state).count()
+
+    @staticmethod
+    def file_refs(state: str) -> typing.Iterator[FileRef]:
+        # a generator, so the query runs in the thread that consumes it (the pool's task handler)
+        query = ExtractJob.select(File.rowid, Root.last_path, File.path, File.name) \
+            .join(File).join(Root).where(ExtractJob.state == state).order_by(File.rowid)
+        yield from query.tuples().iterator()
+
+
+class PipelineStats:
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.transactions = 0
+        self.write_seconds = 0.0  # writer stage, inside transactions
+        self.starved_seconds = 0.0  # writer waiting for the workers
+        self.blocked_seconds = 0.0  # backpressure: producer waiting for the writer to catch up
+        self.start = time.perf_counter()
+
+    def log(self):
+        elapsed = time.perf_counter() - self.start
+        logger.info("%d files (%d failed) in %.1fs, %.1f files/s. writer: %d transactions in %.1fs, "
+                    "waited %.1fs for workers. producer blocked %.1fs on the writer",
+                    self.files, self.failed, elapsed, self.files / elapsed if elapsed > 0 else 0.0,
+                    self.transactions, self.write_seconds, self.starved_seconds, self.blocked_seconds)
+
+
+class MetadataWriter:
+    """ writer stage of the extraction pipeline: stores analysed files in transactions of batch_size files. The
+        ExtractJob state of each file is updated in the same transaction, which makes every batch a checkpoint.
+    """
+    META_BATCH = 300  # 3 columns per row, stays below the default SQLite limit of 999 variables
+    JOB_BATCH = 200
+
+    def __init__(self, batch_size: int = 50, stats: PipelineStats = None, compact_headers: bool = None):
+        self.batch_size = batch_size
+        self.stats = stats if stats is not None else PipelineStats()
+        self.pending: typing.List[AnalysisResult] = list()
+        # ImageHeader blobs instead of ImageMeta rows, see headerstore
+        self.key_ids = KeyIds() if (Config.COMPACT_HEADERS if compact_headers is None else compact_headers) else None
+
+    def add(self, result: AnalysisResult):
+        self.pending.append(result)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        start = time.perf_counter()
+        try:
+            with Image._meta.database.atomic():
+                failed = self._write(self.pending, self.key_ids)
+        except Exception:
+            # find the culprit, store the rest
+            self._forget_key_ids()
+            failed = 0
+            for result in self.pending:
+                try:
+                    with Image._meta.database.atomic():
+                        failed += self._write([result], self.key_ids)
+                except Exception as ex:
+                    traceback.print_exc()
+                    self._forget_key_ids()
+                    failed += 1
+                    self._record_failure(result[0], "write failed: %s" % ex)
+                self.stats.transactions += 1
+        self.stats.files += len(self.pending) - failed
+        self.stats.failed += failed
+        self.stats.transactions += 1
+        self.stats.write_seconds += time.perf_counter() - start
+        self.pending.clear()
+
+    def _forget_key_ids(self):
+        """ the HeaderKey rows a rolled back transaction inserted are gone, so are the ids cached for them """
+        if self.key_ids is not None:
+            self.key_ids = KeyIds()
+
+    @staticmethod
+    def _write(results: typing.List[AnalysisResult], key_ids: KeyIds = None) -> int:
+        """ returns the number of files the workers failed to analyse """
+        meta_rows = []
+        compact_rows = []
+        info_rows = []
+        jobs = []
+        for (file_rowid, images, error) in results:
+            if error is not None:
+                jobs.append((file_rowid, ExtractJob.FAILED, error, 1))
+                continue
+            for (keys, values, info_row) in images:
+                image_id = Image.insert(file=file_rowid).execute()
+                if key_ids is not None:
+                    compact_rows.append((image_id, keys, values))
+                else:
+                    meta_rows.extend(zip(itertools.repeat(image_id), keys, values))
+                if info_row is not None:
+                    info_rows.append((image_id,) + info_row)
+            jobs.append((file_rowid, ExtractJob.DONE, None, 1))
+        for batch in chunked(meta_rows, MetadataWriter.META_BATCH):
+            ImageMeta.insert_many(batch, fields=[ImageMeta.image, ImageMeta.key, ImageMeta.value]).execute()
+        if compact_rows:
+            write_compact(compact_rows, key_ids)
+        insert_image_info(info_rows)
+        MetadataWriter._record_jobs(jobs)
+        return sum(1 for job in jobs if job[1] == ExtractJob.FAILED)
+
+    @staticmethod
+    def _record_jobs(jobs: typing.List[typing.Tuple[int, str, typing.Optional[str], int]]):
+        fields = [ExtractJob.file, ExtractJob.state, ExtractJob.error, ExtractJob.attempts]
+        for batch in chunked(jobs, MetadataWriter.JOB_BATCH):
+            ExtractJob.insert_many(batch, fields=fields) \
+                .on_conflict(conflict_target=[ExtractJob.file],
+                             update={ExtractJob.state: EXCLUDED.state, ExtractJob.error: EXCLUDED.error,
+                                     ExtractJob.attempts: ExtractJob.attempts + 1}) \
+                .execute()
+
+    @staticmethod
+    def _record_failure(file_rowid: int, error: str):
+        try:
+            with Image._meta.database.atomic():
+                MetadataWriter._record_jobs([(file_rowid, ExtractJob.FAILED, error, 1)])
+        except Exception:
+            traceback.print_exc()  # the file itself is gone
+
+
+class BoundedFeed:
+    """ wraps the producer side of a pool, so no more than max_in_flight items are queued or being analysed at
+        a time. The consumer calls done() for every result it takes off the pool, and close() when it stops taking
+        them: that ends the feed, so the pool's task handler does not wait for a slot forever.
+    """
+    POLL_SECONDS = 0.1
+
+    def __init__(self, items: typing.Iterable, max_in_flight: int, stats: PipelineStats):
+        self.items = items
+        self.stats = stats
+        self._slots = threading.Semaphore(max_in_flight)
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        for item in self.items:
+            start = time.perf_counter()
+            while not self._slots.acquire(timeout=BoundedFeed.POLL_SECONDS):
+                if self._closed.is_set():
+                    break
+            self.stats.blocked_seconds += time.perf_counter() - start
+            if self._closed.is_set():
+                return
+            yield item
+
+    def done(self):
+        self._slots.release()
+
+    def close(self):
+        self._closed.set()
+
+
+def write_all(results: typing.Iterable[AnalysisResult], writer: MetadataWriter, feed: BoundedFeed = None):
+    """ drains the workers' results into the writer """
+    stats = writer.stats
+    iterator = iter(results)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                result = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                stats.starved_seconds += time.perf_counter() - start
+            if feed is not None:
+                feed.done()
+            writer.add(result)
+        writer.flush()
+    finally:
+        if feed is not None:
+            feed.close()  # on errors too, so the pool can shut down
+    stats.log()
@@ -1,52 +1,125 @@
+import collections
 import configparser
 import os
+import re
 import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
 from pathlib import Path
 
+import gzip
+import lzma
 import typing
+
+import numpy as np
+from astropy.io import fits
 from astropy.io.fits import Header
+from logzero import logger
 
-from .util import find_header
+from .util import find_header, bin_image
 
 
 class ASTAPSolver:
     _tmp_dir: str
     _exe: str
     _log: bool
+    _timeout: typing.Optional[float]
 
-    def __init__(self, exe="astap"):
+    def __init__(self, exe="astap", timeout: float = None, tmp_dir: str = None, processes: int = None,
+                 binning: int = 1):
         self._exe = exe
-        self._tmp_dir = tempfile.gettempdir()
+        self._binning = binning  # > 1: solve a binned copy, see prepare_input
+        self._tmp_dir = tmp_dir if tmp_dir is not None else default_tmp_dir()
         self._log = True
+        self._timeout = timeout
+        self._processes = processes if processes is not None else os.cpu_count() or 1  # for solve_many
+        self._lock = threading.Lock()
+        self._running: typing.Set[subprocess.Popen] = set()
+        self._terminated: typing.Set[subprocess.Popen] = set()
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-    def solve(self, image_file: Path, hint: typing.Dict[str, str] = None) -> Header:
+    def solve(self, image_file: Path, hint: typing.Dict[str, str] = None, timeout: float = None) -> Header:
+        """ thread safe, every solve gets a private directory for the ASTAP output """
         if not image_file.is_file():
             raise Exception("path is not a file")
-        output_file = Path(self._tmp_dir, image_file.name)
+        with tempfile.TemporaryDirectory(prefix="astap-", dir=self._tmp_dir) as work_dir:
+            if self._binning > 1 or is_compressed(image_file):
+                (input_file, (width, height)) = prepare_input(image_file, Path(work_dir), self._binning)
+                header = rescale_wcs(self._solve(input_file, Path(work_dir, "solved.fits"), hint, timeout, image_file),
+                                     self._binning)
+                if "NAXIS1" in header:
+                    (header["NAXIS1"], header["NAXIS2"]) = (width, height)  # including what binning dropped
+                return header
+            return self._solve(image_file, Path(work_dir, image_file.name), hint, timeout, image_file)
+
+    def solve_many(self, image_files: typing.Iterable[Path], hint: typing.Dict[str, str] = None,
+                   timeout: float = None) -> typing.List[Future]:
+        """ solves the images with up to `processes` concurrent ASTAP processes, a future of the header per image """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._processes, thread_name_prefix="astap")
+            executor = self._executor
+        return [executor.submit(self.solve, image_file, hint, timeout) for image_file in image_files]
+
+    def close(self):
+        """ waits for the solves of solve_many to finish """
+        with self._lock:
+            (executor, self._executor) = (self._executor, None)
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _solve(self, input_file: Path, output_file: Path, hint: typing.Optional[typing.Dict[str, str]],
+               timeout: typing.Optional[float], image_file: Path) -> Header:
+        # no cleanup needed, the caller removes the whole directory
         wcs = output_file.with_suffix(".wcs")
         ini = output_file.with_suffix(".ini")
         log = output_file.with_suffix(".log")
-        try:
-            params = [self._exe, "-f", str(image_file), "-o", str(output_file)]
-            options = {"-r": "180", "-s": "100"}
-            if hint is not None:
-                options.update(hint)
-            params.extend([item for k in options for item in (k, options[k])])
-            if self._log:
-                params.append("-log")
+        params = [self._exe, "-f", str(input_file), "-o", str(output_file)]
+        options = {"-r": "180", "-s": "100"}
+        if hint is not None:
+            options.update(hint)
+        params.extend([item for k in options for item in (k, options[k])])
+        if self._log:
+            params.append("-log")
+
+        self._run(params, image_file, timeout if timeout is not None else self._timeout)
+        if not wcs.exists() and ini.exists():
+            self._raise_error(ini, log, image_file)
+        return self._read_wcs(wcs)
 
-            subprocess.run(params)
-            if not wcs.exists() and ini.exists():
-                self._raise_error(ini, log, image_file)
-            return self._read_wcs(wcs)
+    def terminate(self):
+        """ kills the ASTAP processes that are running, their solve calls raise SolverCancelled """
+        with self._lock:
+            for process in self._running:
+                self._terminated.add(process)
+                process.kill()
+
+    def _run(self, params, image_file, timeout):
+        with self._lock:
+            process = subprocess.Popen(params)
+            self._running.add(process)
+        try:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                raise SolverTimeout("Timed out solving image %s after %ss" % (image_file, timeout), None)
         finally:
-            if wcs.exists():
-                wcs.unlink()
-            if ini.exists():
-                ini.unlink()
-            if log.exists():
-                log.unlink()
+            with self._lock:
+                self._running.discard(process)
+                terminated = process in self._terminated
+                self._terminated.discard(process)
+        if terminated:
+            raise SolverCancelled("Cancelled solving image " + str(image_file))
 
     def _raise_error(self, ini_file, log_file, image_file):
         parser = configparser.ConfigParser()
@@ -69,6 +142,77 @@ class ASTAPSolver:
         return Header.fromtextfile(wcs_file, endcard=False)
 
 
+def is_compressed(image_file: Path) -> bool:
+    return image_file.suffix.lower() in (".xz", ".gz")
+
+
+def prepare_input(image_file: Path, work_dir: Path, binning: int) -> typing.Tuple[Path, typing.Tuple[int, int]]:
+    """ writes the image as a plain FITS file ASTAP can read, binned by the given factor. Color images become
+        mono, the average of the channels. Returns the file and the width and height of the original
+    """
+    suffix = image_file.suffix.lower()
+    opener = lzma.open if suffix == ".xz" else gzip.open if suffix == ".gz" else open
+    with opener(image_file, "rb") as fd:
+        with fits.open(fd, memmap=False) as hdul:
+            hdu = next((hdu for hdu in hdul if hdu.header.get("NAXIS", 0) >= 2), None)
+            if hdu is None:
+                raise SolverError("No image in " + str(image_file))
+            header = hdu.header.copy()
+            data = hdu.data
+    if data.ndim == 3:
+        data = data.mean(axis=0, dtype=np.float32)
+    binned = bin_image(data, binning)
+    if np.issubdtype(data.dtype, np.integer):
+        binned = np.rint(binned).astype(data.dtype)  # averages stay in range, half the size of float32
+    out_header = Header([card for card in header.cards if not _STRUCTURE_KEYWORD.match(card.keyword)])
+    for key in ("XPIXSZ", "YPIXSZ", "PIXSIZE1", "PIXSIZE2", "XBINNING", "YBINNING"):
+        if isinstance(out_header.get(key), (int, float)) and not isinstance(out_header.get(key), bool):
+            out_header[key] = out_header[key] * binning  # so ASTAP derives the right scale from the header
+    input_file = work_dir / ("binned.fits" if binning > 1 else "image.fits")
+    fits.PrimaryHDU(binned, out_header).writeto(input_file)
+    return input_file, (data.shape[1], data.shape[0])
+
+
+def rescale_wcs(header: Header, binning: int) -> Header:
+    """ the WCS of a binned image, as solved, for the full resolution image. Binned pixel p spans full pixels
+        (p - 1) * b + 1 to p * b, its center is full pixel (p - 0.5) * b + 0.5
+    """
+    if binning == 1:
+        return header
+    header = header.copy()
+    for axis in (1, 2):
+        if "CRPIX%d" % axis in header:
+            header["CRPIX%d" % axis] = (header["CRPIX%d" % axis] - 0.5) * binning + 0.5
+        if "CDELT%d" % axis in header:
+            header["CDELT%d" % axis] = header["CDELT%d" % axis] / binning
+        if "NAXIS%d" % axis in header:
+            header["NAXIS%d" % axis] = header["NAXIS%d" % axis] * binning
+        for j in (1, 2):
+            if "CD%d_%d" % (axis, j) in header:
+                header["CD%d_%d" % (axis, j)] = header["CD%d_%d" % (axis, j)] / binning
+    for card in list(header.cards):
+        # SIP: a coefficient of u^p v^q, with u and v in binned pixels, is one of b^(1-p-q) in full pixels
+        match = _SIP_KEYWORD.match(card.keyword)
+        if match is not None:
+            (p, q) = (int(match.group(2)), int(match.group(3)))
+            header[card.keyword] = card.value * binning ** (1 - p - q)
+    header["SOLVEBIN"] = (binning, "solved binned, WCS rescaled to full resolution")
+    return header
+
+
+_STRUCTURE_KEYWORD = re.compile(r"^(SIMPLE|BITPIX|NAXIS\d*|EXTEND|BZERO|BSCALE|BLANK|PCOUNT|GCOUNT|XTENSION|END|"
+                                r"CTYPE\d|CRVAL\d|CRPIX\d|CDELT\d|CROTA\d|CD\d_\d|PC\d_\d|[AB]P?_)")
+_SIP_KEYWORD = re.compile(r"^(A|B|AP|BP)_(\d+)_(\d+)$")
+
+
+def default_tmp_dir() -> str:
+    """ tmpfs when there is one, the ASTAP output never needs to touch a disk """
+    shm = "/dev/shm"
+    if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+        return shm
+    return tempfile.gettempdir()
+
+
 def create_hint(ra, dec, radius=None) -> typing.Dict[str, str]:
     hint = dict()
     if ra is not None and dec is not None:
@@ -97,6 +241,119 @@ def extract_hint(header: Header) -> typing.Dict[str, str]:
     return create_hint(ra, dec, radius)
 
 
+def solution_hint(header: Header) -> typing.Dict[str, str]:
+    """ a hint from a solved frame (an ASTAP .wcs), for frames of the same set """
+    height = find_header(header, "NAXIS2")
+    scale = find_header(header, "CDELT2")
+    return create_hint(find_header(header, "CRVAL1"), find_header(header, "CRVAL2"),
+                       abs(scale) * height if scale is not None and height is not None else None)
+
+
+class SolveJob:
+    """ an image to solve. The first frame of a set to solve provides the hint for the other frames of the set,
+        jobs without a set_key are solved on their own
+    """
+    PENDING = "P"
+    SOLVED = "S"
+    FAILED = "F"
+    CANCELLED = "C"
+
+    def __init__(self, image_file: Path, set_key: typing.Hashable = None, hint: typing.Dict[str, str] = None):
+        self.image_file = image_file
+        self.set_key = set_key
+        self.hint = hint  # used until a frame of the set solves
+        self.used_hint: typing.Optional[typing.Dict[str, str]] = None
+        self.state = SolveJob.PENDING
+        self.header: typing.Optional[Header] = None
+        self.error: typing.Optional[Exception] = None
+        self.seconds = 0.0
+
+    def __str__(self):
+        return "%s (%s)" % (self.image_file, self.state)
+
+
+class SolveScheduler:
+    """ solves jobs with up to `processes` concurrent ASTAP processes. Of a set that has no solved frame yet only
+        one frame runs at a time, the others wait for its solution to use as hint (or for it to fail, then the next
+        frame gets a turn). Meanwhile the free slots go to other sets.
+    """
+
+    def __init__(self, solver: ASTAPSolver = None, processes: int = 2, timeout: float = None):
+        self.solver = solver if solver is not None else ASTAPSolver()
+        self.processes = processes
+        self.timeout = timeout  # per job
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """ stops starting jobs and kills the running ones, run() then yields every unfinished job as cancelled """
+        self._cancelled.set()
+        self.solver.terminate()
+
+    def run(self, jobs: typing.Iterable[SolveJob]) -> typing.Iterator[SolveJob]:
+        """ yields the jobs as they finish """
+        pending: typing.Dict[typing.Hashable, typing.Deque[SolveJob]] = collections.OrderedDict()
+        for (i, job) in enumerate(jobs):
+            key = job.set_key if job.set_key is not None else ("job", i)
+            pending.setdefault(key, collections.deque()).append(job)
+        hints: typing.Dict[typing.Hashable, typing.Dict[str, str]] = dict()
+        leading: typing.Set[typing.Hashable] = set()  # sets with an unhinted frame running
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.processes) as executor:
+            while True:
+                while len(running) < self.processes and not self._cancelled.is_set():
+                    key = self._next_set(pending, hints, leading)
+                    if key is None:
+                        break
+                    job = pending[key].popleft()
+                    if not pending[key]:
+                        del pending[key]
+                    if key not in hints:
+                        leading.add(key)
+                    job.used_hint = hints.get(key, job.hint)
+                    running[executor.submit(self._solve, job)] = (key, job)
+                if not running:
+                    break
+                (done, _) = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (key, job) = running.pop(future)
+                    leading.discard(key)
+                    if job.state == SolveJob.SOLVED and key not in hints:
+                        hints[key] = solution_hint(job.header)
+                    yield job
+        for job in (job for queue in pending.values() for job in queue):
+            job.state = SolveJob.CANCELLED
+            job.error = SolverCancelled("Cancelled solving image " + str(job.image_file))
+            yield job
+
+    @staticmethod
+    def _next_set(pending, hints, leading) -> typing.Optional[typing.Hashable]:
+        # sets without a solution first, the sooner those solve the sooner their frames get a hint
+        for key in pending:
+            if key not in hints and key not in leading:
+                return key
+        for key in pending:
+            if key in hints:
+                return key
+        return None
+
+    def _solve(self, job: SolveJob) -> SolveJob:
+        start = time.perf_counter()
+        try:
+            if self._cancelled.is_set():  # cancelled while queued in the executor
+                raise SolverCancelled("Cancelled solving image " + str(job.image_file))
+            job.header = self.solver.solve(job.image_file, job.used_hint, self.timeout)
+            job.state = SolveJob.SOLVED
+        except SolverCancelled as ex:
+            job.error = ex
+            job.state = SolveJob.CANCELLED
+        except Exception as ex:
+            job.error = ex
+            job.state = SolveJob.FAILED
+        job.seconds = time.perf_counter() - start
+        logger.debug("%s in %.1fs", job, job.seconds)
+        return job
+
+
 class SolverError(Exception):
     pass
 
@@ -111,6 +368,14 @@ class SolverFailure(Exception):
         return self.message
 
 
+class SolverTimeout(SolverFailure):
+    pass
+
+
+class SolverCancelled(Exception):
+    pass
+
+
 def main():
     # f = r"C:\TEMP\M101_2020-03-28T025125_60sec_LP__-15C_frame20.bak"
     # f = r"E:\Astro_Archief\Deep Sky\ZWO_ASI294MC_Pro\2018-09-17\M33\L_2018-09-18_01-00-46_Bin1x1_240s__-15C.fit"
@@ -143,24 +408,14 @@ def main():
     image_dir = r"E:\Astro_Archief\Deep Sky\ZWO_ASI294MC_Pro\2018-10-04\IC 5146-Cocoon"
     image_dir = r"E:\Astro_Archief\Deep Sky\ZWO_ASI294MC_Pro\2018-09-26\NGC 6888-Cresent\set2"
 
-    solver = ASTAPSolver()
-    hint = None
-
-    f: os.DirEntry
-    for f in os.scandir(image_dir):
-        image = Path(f)
-        if image.name.startswith("F"):
+    jobs = [SolveJob(Path(f), set_key=image_dir) for f in os.scandir(image_dir) if not f.name.startswith("F")]
+    for job in SolveScheduler(ASTAPSolver(timeout=300), processes=2).run(jobs):
+        print(str(job.image_file.resolve()))
+        if job.error is not None:
+            print("E: failed to solve: " + str(job.error))
             continue
-        print(str(image.resolve()))
-
-        try:
-            headers = solver.solve(image, hint)
-            hint = extract_hint(headers)
-            for header in headers:
-                print(header + "\t" + str(headers[header]))
-        except Exception as ex:
-            print("E: failed to solve: " + str(ex))
-            raise ex
+        for header in job.header:
+            print(header + "\t" + str(job.header[header]))
         print("-----------------------------")
 
 
@@ -2,11 +2,18 @@ import gzip
 import hashlib
 import lzma
 import os
+import typing
 from pathlib import Path
 
-from astropy.io import fits
+import numpy as np
 from astropy.io.fits import Header, VerifyError
 
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+
+# a file handed to a worker process: (rowid, root path, path, name), builtins only to keep pickling cheap
+FileRef = typing.Tuple[int, str, str, str]
+
 
 # deprecated
 def walk_dir(cb, start):
@@ -104,8 +111,37 @@ def read_headers(file: str) -> Header:
             return open(file_name, mode='rb')
 
     with fopen(file) as fd:
-        with fits.open(fd, mode='readonly') as hdul:
-            return hdul[0].header  # support more than 1 HDU?
+        return read_primary_header(fd)
+
+
+def read_header_blocks(fd) -> bytes:
+    """ reads the primary header up to the block holding the END card. Nothing after that is read, so compressed
+        files are only decompressed as far as the header goes.
+    """
+    blocks = []
+    while True:
+        block = fd.read(FITS_BLOCK_SIZE)
+        if len(block) < FITS_BLOCK_SIZE:
+            raise OSError("FITS header is truncated or has no END card")
+        blocks.append(block)
+        if _has_end_card(block):
+            return b"".join(blocks)
+
+
+def _has_end_card(block: bytes) -> bool:
+    for offset in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+        if block[offset:offset + 8] == b"END     ":
+            return True
+    return False
+
+
+def read_primary_header(fd) -> Header:
+    return Header.fromstring(read_header_blocks(fd))
+
+
+def has_extensions(header: Header) -> bool:
+    """ a primary HDU without data that announces extensions keeps its image(s) in the extension HDUs """
+    return header.get("NAXIS", 0) == 0 and header.get("EXTEND", False) is True
 
 
 def find_header(headers: Header, *fieldnames):
@@ -131,3 +167,14 @@ def try_header(headers: Header, *fieldnames):
     except VerifyError:
         card._image = card._image.replace('\t', ' ')  # tabs, even if non-printable, are common in my FITS files
         return card.value
+
+
+def bin_image(data: np.ndarray, binning: int) -> np.ndarray:
+    """ the average of every binning x binning block, rows and columns that do not fill a block are dropped. This
+        keeps pixel (1, 1) in the same corner, see fitstools.platesolve.rescale_wcs
+    """
+    if binning == 1:
+        return data
+    (height, width) = (data.shape[0] // binning, data.shape[1] // binning)
+    blocks = data[:height * binning, :width * binning].reshape(height, binning, width, binning)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
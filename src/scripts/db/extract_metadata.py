@@ -1,32 +1,80 @@
 #!/usr/bin/env python3
+import argparse
 import multiprocessing
-import traceback
 from io import BytesIO
 
 import logzero
 from logzero import logger
 
+from fitstools.analysis.cardparser import parse_dict
 from fitstools.analysis.fileformat import FileFormatManager
-from fitstools.db.database_peewee import File, Image, Root, ImageMeta
+from fitstools.analysis.metadata import MetadataAnalyser
+from fitstools.db.database_peewee import File, ExtractJob, ImageInfo
 from fitstools.db.scanner import DataStorage
+from fitstools.db.writer import AnalysisResult, MetadataWriter, PipelineStats, BoundedFeed, write_all, \
+    from_file_ref, to_columns, JobQueue
+from fitstools.model import NormalizedImageMeta
+from fitstools.util import read_header_blocks, has_extensions, FileRef
 
 PROCESSES = multiprocessing.cpu_count() - 1
 CHUNKSIZE = 10
+WRITE_BATCH = 100  # files per transaction
+MAX_IN_FLIGHT = PROCESSES * CHUNKSIZE * 4  # files handed to the pool that have not been written yet
 
 
-def analyze(file: File):
-    file_format = FileFormatManager.get_format(file)
-    with file.fopen() as f:
-        # mainly for LZMA files, but also if we later add data analysis (gzip can do partial reads, but is faster with
-        # read-once. plain fits files have a slight penalty but not much)
-        data_bytes = BytesIO(f.read())
-    (images, meta) = file_format.import_file(file, data_bytes)
-    assert len(meta) > 0
-    logger.info("%s\t%d images with %d header fields" % (file.full_filename(), len(images), len(meta)))
-    return images, meta
+def analyze(file_ref: FileRef) -> AnalysisResult:
+    file = from_file_ref(file_ref)
+    try:
+        header_dicts = read_header_dicts(file)
+        # plain tuples, no models: pickling those back to the parent would drag along the File and Root
+        images = [to_columns(header_dict, normalize(header_dict, file)) for header_dict in header_dicts]
+    except Exception as ex:
+        # anything raised here would abort the whole run from inside the pool, record the file as failed instead
+        logger.error("%s\tfailed: %s" % (file.full_filename(), ex))
+        return file.rowid, [], "%s: %s" % (type(ex).__name__, ex)
+    fields = sum(len(header_dict) for header_dict in header_dicts)
+    logger.info("%s\t%d images with %d header fields" % (file.full_filename(), len(header_dicts), fields))
+    return file.rowid, images, None
+
+
+def normalize(header_dict, file: File):
+    # normalized here, in the worker, so grouping never has to parse the headers again
+    meta = MetadataAnalyser.normalize_dict(header_dict, file.full_filename())
+    return ImageInfo.to_row(meta if meta is not None else NormalizedImageMeta())
 
 
-def main(database="prod.db"):
+def read_header_dicts(file: File):
+    file_format = FileFormatManager.get_format(file)
+    with file.fopen() as f:
+        # only decompress as far as the primary header goes, the data of a single image file is never needed
+        header_dict = parse_dict(read_header_blocks(f))
+        if has_extensions(header_dict):
+            # the images live in the extension HDUs, read the whole file at once (mainly for LZMA files, gzip can do
+            # partial reads but is faster with read-once. plain fits files have a slight penalty but not much)
+            f.seek(0)
+            header_dicts = file_format.read_header_dicts(BytesIO(f.read()))
+        else:
+            header_dicts = [header_dict]
+    assert sum(len(header_dict) for header_dict in header_dicts) > 0
+    return header_dicts
+
+
+def select_jobs(resume=False, retry_failed=False, all_files=False):
+    """ a fresh run queues the files that are new since the last run, --resume only finishes what is still pending
+        and --retry-failed only runs the files that failed before. --all-files looks for files without a job
+        everywhere, not only among those added since the last run
+    """
+    if retry_failed:
+        logger.info("retrying %d failed files", JobQueue.count(ExtractJob.FAILED))
+        return JobQueue.file_refs(ExtractJob.FAILED)
+    if not resume:
+        JobQueue.enqueue_new(all_files)
+    logger.info("%d files to analyze, %d failed files skipped", JobQueue.count(ExtractJob.PENDING),
+                JobQueue.count(ExtractJob.FAILED))
+    return JobQueue.file_refs(ExtractJob.PENDING)
+
+
+def main(database="prod.db", resume=False, retry_failed=False, all_files=False):
     logzero.loglevel(logzero.INFO)
 
     data_storage = DataStorage()
@@ -35,20 +83,11 @@ def main(database="prod.db"):
     logger.info("analyzing files for metadata")
 
     try:
+        stats = PipelineStats()
+        writer = MetadataWriter(WRITE_BATCH, stats)
+        feed = BoundedFeed(select_jobs(resume, retry_failed, all_files), max(MAX_IN_FLIGHT, CHUNKSIZE), stats)
         with multiprocessing.Pool(processes=PROCESSES) as pool:
-            query = File.select(File, Root).join(Root) \
-                .where(File.rowid.not_in(Image.select(Image.file)))
-            for (images, metadata) in pool.imap_unordered(analyze, query, CHUNKSIZE):
-                try:
-                    data_storage.begin_tx()
-                    for image in images:
-                        image.save()
-                    ImageMeta.bulk_create(metadata, 60)
-                    data_storage.commit_tx()
-                except Exception:
-                    traceback.print_exc()
-                    data_storage.rollback()
-
+            write_all(pool.imap_unordered(analyze, feed, CHUNKSIZE), writer, feed)
     finally:
         data_storage.close()
     logger.info("done")
@@ -65,24 +104,26 @@ def main_serial():
     logger.info("analyzing files for metadata")
 
     try:
-        query = File.select(File, Root).join(Root) \
-            .where(File.rowid.not_in(Image.select(Image.file)))
-        data_storage.begin_tx()
-        try:
-            for file in query:
-                (images, metadata) = analyze(file)
-                for image in images:
-                    image.save()
-                ImageMeta.bulk_create(metadata, 60)
-            data_storage.commit_tx()
-        except Exception:
-            traceback.print_exc()
-            data_storage.rollback()
+        write_all(map(analyze, list(select_jobs())), MetadataWriter(WRITE_BATCH))
     finally:
         data_storage.close()
     logger.info("done")
 
 
+def get_args():
+    parser = argparse.ArgumentParser(description='Extract the metadata of all files that have not been analyzed yet')
+    parser.add_argument('database', nargs='?', default="prod.db")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true', default=False,
+                      help='only finish the files still pending from an interrupted run')
+    mode.add_argument('--retry-failed', action='store_true', default=False,
+                      help='only run the files that failed before')
+    parser.add_argument('--all-files', action='store_true', default=False,
+                        help='check every file for a missing job, not only the files added since the last run')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    main()
+    args = get_args()
+    main(args.database, args.resume, args.retry_failed, args.all_files)
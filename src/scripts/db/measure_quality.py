@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import argparse
+import multiprocessing
+import typing
+from io import BytesIO
+
+import logzero
+from logzero import logger
+
+from fitstools.analysis.quality import QualityAnalyser, QualityStore, FrameQuality
+from fitstools.db.database_peewee import Image
+from fitstools.db.scanner import DataStorage
+from fitstools.db.writer import from_file_ref
+from fitstools.model import ImageType
+from fitstools.util import FileRef
+
+PROCESSES = multiprocessing.cpu_count() - 1
+CHUNKSIZE = 4
+WRITE_BATCH = 100  # images per transaction
+
+
+def measure(job: typing.Tuple[int, FileRef, bool]) -> typing.Tuple[int, typing.Optional[FrameQuality],
+                                                                    typing.Optional[str]]:
+    """ (image rowid, quality, None) or, if it failed, (image rowid, None, error message) """
+    (image_id, file_ref, fast) = job
+    file = from_file_ref(file_ref)
+    try:
+        with file.fopen() as f:
+            # read at once, fits needs to seek and the compressed streams are slow at that
+            quality = QualityAnalyser.measure_file(BytesIO(f.read()), fast)
+    except Exception as ex:
+        logger.error("%s\tfailed: %s" % (file.full_filename(), ex))
+        return image_id, None, "%s: %s" % (type(ex).__name__, ex)
+    logger.info("%s\t%s" % (file.full_filename(), quality))
+    return image_id, quality, None
+
+
+def store(results: typing.List[typing.Tuple[int, FrameQuality]], failures: typing.List[typing.Tuple[int, str]],
+          fast: bool):
+    with Image._meta.database.atomic():
+        QualityStore.store(results, fast)
+        QualityStore.store_failures(failures, fast)
+    results.clear()
+    failures.clear()
+
+
+def main(database="prod.db", fast=True, img_types=(ImageType.LIGHT,), retry_failed=False):
+    logzero.loglevel(logzero.INFO)
+
+    data_storage = DataStorage()
+    data_storage.open(database)
+
+    logger.info("measuring star and background statistics")
+
+    count = 0
+    failed = 0
+    try:
+        # the image list is read up front, the writes would otherwise move the pages under the query
+        jobs = [(image_id, file_ref, fast) for (image_id, file_ref) in QualityStore.unmeasured(img_types, retry_failed)]
+        results = []
+        failures = []
+        with multiprocessing.Pool(processes=PROCESSES) as pool:
+            for (image_id, quality, error) in pool.imap_unordered(measure, jobs, CHUNKSIZE):
+                if error is not None:
+                    failures.append((image_id, error))
+                    failed += 1
+                else:
+                    results.append((image_id, quality))
+                    count += 1
+                if len(results) + len(failures) >= WRITE_BATCH:
+                    store(results, failures, fast)
+        store(results, failures, fast)
+    finally:
+        data_storage.close()
+    logger.info("done, measured %d images, %d failed" % (count, failed))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Measure FWHM, eccentricity, star count, background and noise of '
+                                                 'the images that have not been measured yet')
+    parser.add_argument('database', nargs='?', default="prod.db")
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='clip the background over all pixels and measure every star, slower')
+    parser.add_argument('--types', nargs='+', default=[ImageType.LIGHT.name],
+                        choices=[img_type.name for img_type in ImageType], help='image types to measure')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='only measure the images that failed before')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    args = get_args()
+    main(args.database, not args.full, [ImageType[name] for name in args.types], args.retry_failed)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import argparse
+
+import logzero
+from logzero import logger
+
+from fitstools.db import headerstore
+from fitstools.db.scanner import DataStorage
+
+
+def main(database="prod.db", keep_rows=False, vacuum=False):
+    logzero.loglevel(logzero.INFO)
+
+    data_storage = DataStorage()
+    data_storage.open(database)
+
+    logger.info("moving the ImageMeta rows into the compact header store")
+    try:
+        count = headerstore.migrate(keep_rows=keep_rows)
+        logger.info("migrated the headers of %d images, set Config.COMPACT_HEADERS to extract new files the same way"
+                    % count)
+        if vacuum:
+            logger.info("vacuuming the database")
+            data_storage.db.execute_sql("VACUUM")
+    finally:
+        data_storage.close()
+    logger.info("done")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Move the extracted headers from ImageMeta rows to ImageHeader blobs')
+    parser.add_argument('database', nargs='?', default="prod.db")
+    parser.add_argument('--keep-rows', action='store_true', default=False,
+                        help='leave the ImageMeta rows in place')
+    parser.add_argument('--vacuum', action='store_true', default=False,
+                        help='give the space of the deleted rows back to the file system afterwards')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    main(args.database, args.keep_rows, args.vacuum)
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
+import argparse
 
 import logzero
 from logzero import logger
 
 from fitstools.db.scanner import DataStorage, Importer
 
+SCAN_WORKERS = 8  # directory listings are I/O bound, mostly useful on network shares
+FLUSH_SIZE = 10000  # changes are written while walking in batches of this size
 
-def main(database="prod.db"):
+
+def main(database="prod.db", workers=SCAN_WORKERS, full=False):
     logzero.loglevel(logzero.INFO)
 
     data_storage = DataStorage()
@@ -14,10 +18,10 @@ def main(database="prod.db"):
 
     try:
         data_storage.begin_tx()
-        importer = Importer()
+        importer = Importer(workers, incremental=not full, flush_size=FLUSH_SIZE)
         for change_list in importer.import_files():
-            logger.info("%d new files, %d changed files, %d deleted files", len(change_list.new_files),
-                        len(change_list.changed_files), len(change_list.removed_files))
+            logger.info("%d new files, %d changed files, %d deleted files", change_list.new_count,
+                        change_list.changed_count, change_list.removed_count)
             logger.info("applying changes to database")
             change_list.apply_all()
             logger.info("done")
@@ -28,5 +32,15 @@ def main(database="prod.db"):
         data_storage.close()
 
 
+def get_args():
+    parser = argparse.ArgumentParser(description='Update the files of all library roots in the database')
+    parser.add_argument('database', nargs='?', default="prod.db")
+    parser.add_argument('--full', action='store_true', default=False,
+                        help='list every directory, also the ones that did not change since the last run')
+    parser.add_argument('--workers', type=int, default=SCAN_WORKERS)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    args = get_args()
+    main(args.database, args.workers, args.full)
@@ -0,0 +1,58 @@
+""" stands in for the astap executable in tests. The image "file" names the outcome: *fail* does not solve, *hang*
+    never finishes, anything else solves after BLIND_SECONDS, or HINTED_SECONDS when given a position hint.
+    Every image shows the same WIDTH x HEIGHT field, a FITS file of a smaller size is taken to be binned and gets
+    the WCS of the binned field
+"""
+import os
+import sys
+import time
+
+BLIND_SECONDS = 0.4
+HINTED_SECONDS = 0.1
+(WIDTH, HEIGHT) = (4144, 2822)
+(CRPIX1, CRPIX2) = (2072.5, 1411.5)
+CD = ((-3.5e-4, 1.0e-4), (1.0e-4, 3.5e-4))
+
+
+def image_width(image_file):
+    with open(image_file, "rb") as fd:
+        block = fd.read(2880)
+    for i in range(0, len(block), 80):
+        if block[i:i + 8] == b"NAXIS1  ":
+            return int(block[i + 10:i + 80].split(b"/")[0])
+    return WIDTH
+
+
+def card(key, value):
+    return ("%-8s= %20s" % (key, value)).ljust(80)
+
+
+def main(args):
+    options = dict(zip(args[1::2], args[2::2]))
+    image_file = options["-f"]
+    output_file = os.path.splitext(options["-o"])[0]
+    if "hang" in image_file:
+        time.sleep(3600)
+    time.sleep(HINTED_SECONDS if "-ra" in options else BLIND_SECONDS)
+    if "fail" in image_file:
+        with open(output_file + ".ini", "w") as ini:
+            ini.write("PLTSOLVD=F\n")
+        with open(output_file + ".log", "w") as log:
+            log.write("No solution found!\n")
+        return
+    binning = round(WIDTH / image_width(image_file))
+    cards = [card("NAXIS", 2), card("NAXIS1", WIDTH // binning), card("NAXIS2", HEIGHT // binning),
+             card("PLTSOLVD", "T"), card("CTYPE1", "'RA---TAN'"), card("CTYPE2", "'DEC--TAN'"),
+             card("CRVAL1", 283.3955), card("CRVAL2", 33.0341),
+             card("CRPIX1", (CRPIX1 - 0.5) / binning + 0.5), card("CRPIX2", (CRPIX2 - 0.5) / binning + 0.5),
+             card("CDELT1", -0.000366 * binning), card("CDELT2", 0.000366 * binning),
+             card("CD1_1", CD[0][0] * binning), card("CD1_2", CD[0][1] * binning),
+             card("CD2_1", CD[1][0] * binning), card("CD2_2", CD[1][1] * binning),
+             card("HINT_RA", options.get("-ra", "'none'")), card("OBJECT", "'%s'" % os.path.basename(image_file)[:60]),
+             card("FOLDER", "'%s'" % os.path.basename(os.path.dirname(image_file))[:60])]
+    with open(output_file + ".wcs", "w") as wcs:
+        wcs.write("\n".join(cards) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
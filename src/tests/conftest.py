@@ -0,0 +1,14 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture()
+def stub_astap(tmp_path):
+    """ the astap_stub module as an executable """
+    exe = tmp_path / "astap"
+    stub = Path(Path(__file__).parent, "astap_stub.py").read_text()
+    exe.write_text("#!" + sys.executable + "\n" + stub)
+    exe.chmod(0o755)
+    return str(exe)
@@ -0,0 +1,39 @@
+from astropy.io import fits
+from astropy.io.fits import Header
+
+from fitstools.analysis.metadata import MetadataAnalyser
+from fitstools.db.database_peewee import *
+from fitstools.db.writer import MetadataWriter, write_all, to_file_ref
+from scripts.db.extract_metadata import analyze
+
+
+def create_file(directory):
+    root = Root.create(name="night", last_path=str(directory))
+    (directory / "M57").mkdir()
+    fits.PrimaryHDU(header=Header({"OBJECT": "M57", "EXPTIME": 30.0, "IMAGETYP": "Light Frame"})) \
+        .writeto(directory / "M57" / "frame1.fits")
+    return File.create(root=root, path="M57", name="frame1.fits", size=0, mtime_millis=0)
+
+
+def test_analyze(database, tmp_path):
+    file = create_file(tmp_path)
+    (rowid, images, error) = analyze(to_file_ref(file))
+    assert (rowid, error) == (file.rowid, None)
+    ((keys, values, info_row),) = images
+    assert dict(zip(keys, values))["OBJECT"] == "M57"
+    assert info_row is not None
+
+
+def test_analyze_normalization_fails(database, tmp_path, monkeypatch):
+    file = create_file(tmp_path)
+
+    def broken(header_dict, file):
+        raise KeyError("EXPTIME")
+
+    monkeypatch.setattr(MetadataAnalyser, "normalize_dict", broken)
+    result = analyze(to_file_ref(file))
+    assert result == (file.rowid, [], "KeyError: 'EXPTIME'")
+    write_all([result], MetadataWriter())
+    job = ExtractJob.get_by_id(file.rowid)
+    assert (job.state, job.error) == (ExtractJob.FAILED, "KeyError: 'EXPTIME'")
+    assert Image.select().count() == 0
@@ -0,0 +1,101 @@
+import pytest
+
+from fitstools.analysis.setbuilder import SetBuilder
+from fitstools.db.database_peewee import *
+from fitstools.db.headerstore import KeyIds, write_compact, read_header_dicts, migrate
+from fitstools.db.writer import MetadataWriter, write_all, to_columns
+
+HEADER = {"SIMPLE": True, "BITPIX": 16, "NAXIS": 2, "IMAGETYP": "LIGHT", "OBJECT": "M 31", "EXPOSURE": 300.0,
+          "GAIN": 139, "SET-TEMP": -10.0, "COMMENT": "a comment", "EMPTY": None, "FILTER": True}
+EAV_HEADER = {key: value for (key, value) in HEADER.items() if value is not None}  # ImageMeta.value is not null
+
+
+def create_images(count):
+    root = Root.create(name="dummy", last_path=r'C:\TEMP')
+    images = []
+    for i in range(count):
+        file = File.create(root=root, path="subdir", name="image%02d.fits" % i, size=0, mtime_millis=0)
+        images.append(Image.create(file=file))
+    return images
+
+
+def test_round_trip(database):
+    (image,) = create_images(1)
+    write_compact([(image.rowid, tuple(HEADER.keys()), tuple(HEADER.values()))], KeyIds())
+    header_dict = read_header_dicts([image.rowid])[image.rowid]
+    assert list(header_dict.items()) == list(HEADER.items())  # same order, same types
+    assert type(header_dict["EXPOSURE"]) == float and type(header_dict["GAIN"]) == int
+
+    compact = ImageHeader.get()
+    assert (compact.imagetyp, compact.object, compact.exposure) == ("LIGHT", "M 31", 300.0)  # promoted
+    assert compact.filter is None  # a bool stays in the blob
+    assert ImageHeader.select().where(ImageHeader.object == "M 31").count() == 1
+
+    header = image.get_header()
+    assert header["OBJECT"] == "M 31"
+    assert header["GAIN"] == 139
+    assert header["FILTER"] is True
+
+
+def test_decoded_once(database, monkeypatch):
+    images = create_images(3)
+    write_compact([(image.rowid, tuple(HEADER.keys()), tuple(HEADER.values())) for image in images], KeyIds())
+    decoded = []
+    cards = ImageHeader.cards
+
+    def counting_cards(self):
+        decoded.append(self.image_id)
+        return cards(self)
+
+    monkeypatch.setattr(ImageHeader, "cards", counting_cards)
+    headers = read_header_dicts([image.rowid for image in images])
+    assert all(headers[image.rowid]["OBJECT"] == "M 31" for image in images)
+    assert sorted(decoded) == [image.rowid for image in images]
+    decoded.clear()
+    assert images[0].get_header()["GAIN"] == 139
+    assert decoded == [images[0].rowid]
+
+
+def test_both_layouts(database):
+    (old, new) = create_images(2)
+    for (key, value) in EAV_HEADER.items():
+        ImageMeta.create(image=old, key=key, value=value)
+    write_compact([(new.rowid, tuple(HEADER.keys()), tuple(HEADER.values()))], KeyIds())
+    headers = read_header_dicts([old.rowid, new.rowid], keys=["OBJECT", "GAIN"])
+    assert headers == {old.rowid: {"OBJECT": "M 31", "GAIN": "139"}, new.rowid: {"OBJECT": "M 31", "GAIN": 139}}
+    assert old.get_header()["GAIN"] == "139"
+    assert new.get_header()["GAIN"] == 139
+
+
+def test_key_ids(database):
+    key_ids = KeyIds()
+    ids = dict(key_ids.ids(["OBJECT", "GAIN"]))
+    assert KeyIds().ids(["GAIN", "OBJECT", "FILTER"])["GAIN"] == ids["GAIN"]  # shared between caches
+    assert HeaderKey.select().count() == 3
+    assert KeyIds().names([ids["OBJECT"]])[ids["OBJECT"]] == "OBJECT"
+
+
+@pytest.mark.parametrize("keep_rows", [False, True])
+def test_migrate(database, keep_rows):
+    images = create_images(5)
+    for image in images:
+        for (key, value) in EAV_HEADER.items():
+            ImageMeta.create(image=image, key=key, value=value)
+    expected = {image.rowid: dict(image.get_header()) for image in images}
+
+    assert migrate(page_size=2, keep_rows=keep_rows) == 5
+    assert migrate(page_size=2, keep_rows=keep_rows) == 0
+    assert ImageHeader.select().count() == 5
+    assert ImageMeta.select().count() == (5 * len(EAV_HEADER) if keep_rows else 0)
+    assert {image.rowid: dict(image.get_header()) for image in images} == expected
+
+
+def test_compact_writer(database):
+    files = [image.file for image in create_images(2)]
+    Image.delete().execute()
+    write_all([(file.rowid, [to_columns(HEADER)], None) for file in files], MetadataWriter(compact_headers=True))
+    assert ImageMeta.select().count() == 0
+    assert ImageHeader.select().count() == 2
+    assert [header["OBJECT"] for (image, header) in SetBuilder.find_unmatched_images()] == ["M 31", "M 31"]
+    image = Image.select().where(Image.file == files[0]).get()
+    assert image.get_header()["EXPOSURE"] == 300.0
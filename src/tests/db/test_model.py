@@ -66,3 +66,8 @@ class TestFOpen:
     def test_xz_fits_file(self):
         file = self.make_file(self.get_tests_dir(), "test-data", "test_image.fits.xz")
         self.check_fits_contents(file)
+
+    def test_xz_read_header(self):
+        file = self.make_file(self.get_tests_dir(), "test-data", "test_image.fits.xz")
+        header = file.read_header()
+        assert header["NAXIS1"] == 10
@@ -0,0 +1,57 @@
+from fitstools.analysis.quality import QualityStore, FrameQuality
+from fitstools.db.database_peewee import *
+from scripts.db.measure_quality import measure, store
+
+
+def create_images(root, count, img_type="LIGHT"):
+    ids = []
+    for i in range(count):
+        file = File.create(root=root, path="M57", name="%s%d.fit" % (img_type, i), size=0, mtime_millis=1000)
+        image = Image.create(file=file)
+        ImageInfo.create(image=image, img_type=img_type)
+        ids.append(image.rowid)
+    return ids
+
+
+def test_store_quality(database):
+    root = Root.create(name="night", last_path="/data")
+    lights = create_images(root, 5)
+    create_images(root, 2, "DARK")
+    unmeasured = list(QualityStore.unmeasured(page_size=2))
+    assert [image_id for (image_id, file_ref) in unmeasured] == lights
+    assert unmeasured[0][1][1:] == ("/data", "M57", "LIGHT0.fit")
+
+    QualityStore.store([(lights[0], FrameQuality(2.5, 0.4, 120, 1000.0, 10.0)),
+                        (lights[1], FrameQuality(star_count=0, background=900.0, noise=9.0))])
+    assert [image_id for (image_id, _) in QualityStore.unmeasured()] == lights[2:]
+    assert Image.get_by_id(lights[0]).quality.get().star_count == 120
+    quality = QualityStore.get(lights[1])
+    assert (quality.median_fwhm, quality.star_count, quality.background) == (None, 0, 900.0)
+    assert QualityStore.get(lights[2]) is None
+
+    # measured again
+    QualityStore.store([(lights[0], FrameQuality(3.0, 0.5, 100, 1000.0, 10.0))], fast=False)
+    row = ImageQuality.get_by_id(lights[0])
+    assert (row.median_fwhm, row.fast) == (3.0, False)
+    assert ImageQuality.select().count() == 2
+
+
+def test_failures_not_retried(database, tmp_path):
+    root = Root.create(name="night", last_path=str(tmp_path))
+    (tmp_path / "M57").mkdir()
+    (tmp_path / "M57" / "LIGHT0.fit").write_bytes(b"not a FITS file")
+    (broken,) = create_images(root, 1)
+    (image_id, quality, error) = measure((broken, next(QualityStore.unmeasured())[1], True))
+    assert (image_id, quality) == (broken, None)
+    store([], [(image_id, error)], True)
+
+    row = ImageQuality.get_by_id(broken)
+    assert (row.star_count, row.median_fwhm) == (None, None)
+    assert row.error.startswith("OSError")
+    assert QualityStore.get(broken) is None
+    assert list(QualityStore.unmeasured()) == []
+    assert [image_id for (image_id, _) in QualityStore.unmeasured(retry_failed=True)] == [broken]
+
+    QualityStore.store([(broken, FrameQuality(2.5, 0.4, 120, 1000.0, 10.0))])  # fixed
+    assert ImageQuality.get_by_id(broken).error is None
+    assert list(QualityStore.unmeasured(retry_failed=True)) == []
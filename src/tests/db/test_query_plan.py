@@ -0,0 +1,103 @@
+import datetime
+
+import pytest
+
+from fitstools.analysis.setbuilder import SetBuilder
+from fitstools.db.database_peewee import *
+from fitstools.db.scanner import Importer, explain_query_plan, explain_sql, full_scans
+from fitstools.db.headerstore import KeyIds, write_compact, read_header_dicts, migrate
+from fitstools.db.writer import JobQueue
+from fitstools.model import NormalizedImageMeta, ImageType
+
+
+class QueryRecorder:
+    """ records the statements a piece of code runs, to explain them afterwards """
+
+    def __init__(self, database, monkeypatch):
+        self.database = database
+        self.statements = []
+        execute_sql = database.execute_sql
+
+        def recording_execute_sql(sql, params=None, *args, **kwargs):
+            statement = sql.lstrip().upper()
+            if statement.startswith(("SELECT", "UPDATE", "DELETE")) or \
+                    (statement.startswith("INSERT") and " SELECT " in statement):
+                self.statements.append((sql, params))
+            return execute_sql(sql, params, *args, **kwargs)
+
+        monkeypatch.setattr(database, "execute_sql", recording_execute_sql)
+        self.monkeypatch = monkeypatch
+
+    def assert_no_full_scans(self):
+        self.monkeypatch.undo()
+        assert len(self.statements) > 0
+        for (sql, params) in self.statements:
+            plan = explain_sql(self.database, sql, params)
+            assert full_scans(plan) == [], "%s\n%s" % (sql, "\n".join(plan))
+
+
+@pytest.fixture
+def recorder(database, monkeypatch):
+    return QueryRecorder(database, monkeypatch)
+
+
+def test_full_scans(database):
+    assert len(full_scans(explain_query_plan(File.select().where(File.size > 0)))) == 1
+    assert full_scans(explain_query_plan(File.select().where(File.rowid == 1))) == []
+
+
+@pytest.mark.parametrize("preload_root", [False, True])
+def test_importer(database, filesystem, recorder, preload_root):
+    root = Root.create(name="test", last_path="mem://")
+    Importer(preload_root=preload_root, incremental=True).import_files_from(filesystem, root).apply_all()
+    filesystem.remove("test/2021-12-26/Darks/image06.fits")
+    filesystem.appendbytes("test/2021-12-25/Crab Nebula/Flats/image05.fits", bytes("MORE", "UTF-8"))
+    Importer(preload_root=preload_root, incremental=True).import_files_from(filesystem, root).apply_all()
+    recorder.assert_no_full_scans()
+
+
+def test_job_queue(database, recorder):
+    JobQueue.enqueue_new()
+    assert any(sql.startswith("INSERT") for (sql, params) in recorder.statements)
+    list(JobQueue.file_refs(ExtractJob.PENDING))
+    JobQueue.count(ExtractJob.FAILED)
+    recorder.assert_no_full_scans()
+
+
+@pytest.mark.parametrize("set_temperature", [-10.0, None])
+def test_find_matching_set(database, recorder, set_temperature):
+    root = Root.create(name="test", last_path="mem://")
+    image_meta = NormalizedImageMeta()
+    image_meta.img_type = ImageType.DARK
+    image_meta.exposure = 120.0
+    image_meta.set_temperature = set_temperature
+    image_meta.datetime_local = datetime.datetime(2021, 12, 25, 22, 0)
+    SetBuilder.find_matching_set(image_meta, "darks", root.rowid)
+    recorder.assert_no_full_scans()
+    (sql, params) = recorder.statements[0]
+    # not just the root foreign key
+    assert "imageset_root_id_path_capture_date" in explain_sql(database, sql, params)[0]
+
+
+def test_find_unmatched_images(database, recorder):
+    root = Root.create(name="test", last_path="mem://")
+    file = File.create(root=root, path="lights", name="image01.fits", size=1, mtime_millis=0)
+    image = Image.create(file=file)
+    ImageMeta.create(image=image, key="IMAGETYP", value="LIGHT")
+    assert [header["IMAGETYP"] for (image, header) in SetBuilder.find_unmatched_images()] == ["LIGHT"]
+    assert [header["IMAGETYP"] for (image, header) in SetBuilder.find_unnormalized_images()] == ["LIGHT"]
+    SetBuilder.normalize_missing()
+    assert [meta.img_type for (image, meta) in SetBuilder.find_unmatched_infos()] == [ImageType.LIGHT]
+    recorder.assert_no_full_scans()
+
+
+def test_header_store(database, recorder):
+    root = Root.create(name="test", last_path="mem://")
+    images = [Image.create(file=File.create(root=root, path="lights", name="image%d.fits" % i, size=1, mtime_millis=0))
+              for i in range(2)]
+    ImageMeta.create(image=images[0], key="IMAGETYP", value="LIGHT")
+    write_compact([(images[1].rowid, ("IMAGETYP",), ("LIGHT",))], KeyIds())
+    read_header_dicts([image.rowid for image in images], keys=["IMAGETYP"])
+    images[1].get_header()
+    migrate()
+    recorder.assert_no_full_scans()
@@ -1,7 +1,11 @@
 import logging
 
+import pytest
+
 from fitstools.db.database_peewee import *
-from fitstools.db.scanner import Importer
+from fs.memoryfs import MemoryFS
+
+from fitstools.db.scanner import Importer, ChangeList, _ParallelLister
 
 NUM_FILES = 6  # 8 images, 2 bad, 1 csv ignored
 
@@ -59,11 +63,156 @@ def test_changed_file(filesystem, database):
     (root, importer) = initial_import(filesystem)
     file = File.select().where(File.name == "image06.fits").get()
     Image.create(file=file)
+    ExtractJob.create(file=file, state=ExtractJob.FAILED, attempts=1, error="OSError")
     assert Image.select().count() == 1
     # if the file has been changed, we need to re-analyse it
     filesystem.touch("test/2021-12-26/Darks/image06.fits")
     importer.import_files_from(filesystem, root).apply_all()
     assert File.select().count() == NUM_FILES
     assert Image.select().count() == 0
+    job = ExtractJob.get()
+    assert (job.file_id, job.state, job.attempts, job.error) == (file.rowid, ExtractJob.PENDING, 0, None)
+    assert File.select().where(File.name == "image06.fits").get().rowid == file.rowid
+
+
+def test_apply_batches(filesystem, database, monkeypatch):
+    monkeypatch.setattr(ChangeList, "INSERT_BATCH", 2)
+    monkeypatch.setattr(ChangeList, "DELETE_BATCH", 2)
+    (root, importer) = initial_import(filesystem)
+    assert File.select().count() == NUM_FILES
+    filesystem.removetree("test/2021-12-25")
+    importer.import_files_from(filesystem, root).apply_all()
+    assert File.select().count() == 3
+
+def test_streaming_import(filesystem, database):
+    root = Root.create(name="dummy", last_path=r'C:\TEMP')
+    change_list = Importer(flush_size=2).import_files_from(filesystem, root)
+    assert change_list.pending() < 2
+    assert File.select().count() >= NUM_FILES - 1  # flushed during the walk
+    change_list.apply_all()
+    assert File.select().count() == NUM_FILES
+    assert change_list.new_count == NUM_FILES
+
+    filesystem.removetree("test/2021-12-25")
+    change_list = Importer(flush_size=2).import_files_from(filesystem, root)
+    change_list.apply_all()
+    assert change_list.removed_count == 3
+    assert File.select().count() == 3
+
+
+def test_parallel_matches_serial(filesystem, database):
+    (root, importer) = initial_import(filesystem)
+    filesystem.remove("image01.fits")
+    filesystem.removetree("test/2021-12-25/Crab Nebula/Flats")
+    filesystem.touch("test/2021-12-26/Darks/image06.fits")
+    filesystem.appendbytes("test/2021-12-26/Darks/image09.fits", bytes("DUMMY CONTENT", "UTF-8"))
+
+    serial = importer.import_files_from(filesystem, root)
+    parallel = Importer(workers=4).import_files_from(filesystem, root)
+    assert summarize(parallel) == summarize(serial)
+    assert parallel.scan_stats.dirs == serial.scan_stats.dirs == 7
+    assert parallel.scan_stats.entries == serial.scan_stats.entries
+
+
+def test_parallel_lookahead_bounded(database, monkeypatch):
+    wide_fs = MemoryFS()
+    for night in range(30):
+        for target in range(10):
+            wide_fs.makedirs("2021-12-%02d/target%d" % (night, target))
+            wide_fs.writebytes("2021-12-%02d/target%d/image.fits" % (night, target), b"DUMMY")
+    root = Root.create(name="wide", last_path=r'C:\TEMP')
+    outstanding = []
+    fill = _ParallelLister._fill
+
+    def recording_fill(self):
+        fill(self)
+        outstanding.append(len(self.pending))
+
+    monkeypatch.setattr(_ParallelLister, "_fill", recording_fill)
+    change_list = Importer(workers=2).import_files_from(wide_fs, root)
+    assert len(change_list.new_files) == 300
+    assert change_list.scan_stats.dirs == 331
+    assert max(outstanding) == 2 * _ParallelLister.LOOKAHEAD
+
+
+def test_preload_root_matches_directory_snapshot(filesystem, database):
+    (root, importer) = initial_import(filesystem)
+    filesystem.remove("image01.fits")
+    filesystem.removetree("test/2021-12-25/Crab Nebula/Flats")
+    filesystem.touch("test/2021-12-26/Darks/image06.fits")
+
+    per_directory = importer.import_files_from(filesystem, root)
+    preloaded = Importer(preload_root=True).import_files_from(filesystem, root)
+    assert summarize(preloaded) == summarize(per_directory)
+    assert len(preloaded.removed_files) == 2
+    assert len(preloaded.changed_files) == 1
+
+
+def test_aborted_streaming_import(filesystem, database, monkeypatch):
+    root = Root.create(name="dummy", last_path=r'C:\TEMP')
+    imported = []
+    import_file = Importer._import_file
+
+    def failing_import_file(self, *args):
+        if len(imported) == 3:
+            raise OSError("file system went away")
+        imported.append(args[0].name)
+        import_file(self, *args)
+
+    monkeypatch.setattr(Importer, "_import_file", failing_import_file)
+    with pytest.raises(OSError):
+        Importer(flush_size=1, incremental=True).import_files_from(filesystem, root)
+    assert File.select().count() == 3  # flushed before the walk failed
+    assert DirStamp.select().count() == 0
+    monkeypatch.undo()
+
+    Importer(flush_size=1, incremental=True).import_files_from(filesystem, root).apply_all()
+    assert File.select().count() == NUM_FILES
+    assert DirStamp.select().count() == 8
+
+
+def test_dir_stamps_recorded(filesystem, database):
+    initial_import(filesystem)
+    assert DirStamp.select().count() == 8  # all dirs except BAD
+    stamp = DirStamp.get(DirStamp.path == "test/2021-12-26/Darks")
+    assert stamp.entries == 3
+
+
+def test_incremental_skips_unchanged_dirs(filesystem, database):
+    (root, importer) = initial_import(filesystem)
+    # the memory file system does not touch the directory when a file is added
+    filesystem.appendbytes("test/2021-12-26/Darks/image09.fits", bytes("DUMMY CONTENT", "UTF-8"))
+
+    change_list = Importer(incremental=True).import_files_from(filesystem, root)
+    assert change_list.scan_stats.dirs == 0
+    assert change_list.scan_stats.skipped_dirs == 8
+    assert len(change_list.new_files) == len(change_list.removed_files) == 0
+
+    filesystem.setinfo("test/2021-12-26/Darks", {"details": {"modified": 1640995200}})
+    change_list = Importer(incremental=True, preload_root=True).import_files_from(filesystem, root)
+    assert change_list.scan_stats.dirs == 1
+    assert [f.name for f in change_list.new_files] == ["image09.fits"]
+    change_list.apply_all()
+    assert DirStamp.get(DirStamp.path == "test/2021-12-26/Darks").mtime_millis == 1640995200000
+
+    filesystem.appendbytes("image10.fits", bytes("DUMMY CONTENT", "UTF-8"))
+    change_list = importer.import_files_from(filesystem, root)  # full scan
+    assert [f.name for f in change_list.new_files] == ["image10.fits"]
+
+
+def test_incremental_delete_dirs(filesystem, database):
+    (root, importer) = initial_import(filesystem)
+    filesystem.removetree("test/2021-12-25")
+    filesystem.setinfo("test", {"details": {"modified": 1640995200}})
+    Importer(incremental=True).import_files_from(filesystem, root).apply_all()
+    assert File.select().count() == 3
+    assert DirStamp.select().count() == 4
+
+
+def summarize(change_list):
+    return ([(f.path, f.name) for f in change_list.new_files],
+            [(f.path, f.name) for f in change_list.changed_files],
+            list(change_list.changed_ids),
+            [f.rowid for f in change_list.removed_files])
 
 #TODO: detect moved files, detect compressed files
\ No newline at end of file
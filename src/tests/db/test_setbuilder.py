@@ -1,7 +1,11 @@
 from fitstools.analysis.setbuilder import SetBuilder
 from fitstools.db.database_peewee import *
+from fitstools.db.writer import insert_image_info
+from fitstools.model import NormalizedImageMeta, ImageType
 
+import datetime
 import logging
+import os
 
 logger = logging.getLogger('peewee')
 logger.addHandler(logging.StreamHandler())
@@ -33,6 +37,102 @@ def test_combine(database):
     assert SetBuilder.combine() == (3, 2)
 
 
+def test_combine_existing_sets(database):
+    root = Root.create(last_path=r"/dummy/does/not/exist", name="dropbox")
+    headers = {
+        "IMAGETYP": "DARK",
+        "INSTRUME": "ZWO ASI294MC Pro",
+        "EXPOSURE": "120",
+        "SET-TEMP": "-10",
+        "XBINNING": "1",
+        "YBINNING": "1",
+        "GAIN": "120",
+        "OFFSET": "30",
+        "DATE-LOC": "2020-05-30T02:22:49.0968820"
+    }
+    create_image_with_meta(root, "dark1.fit", "darks", headers)
+    create_image_with_meta(root, "dark2.fit", "darks", {**headers, "SET-TEMP": "-20"})
+    assert SetBuilder.combine() == (2, 2)
+    assert SetBuilder.combine() == (0, 0)
+
+    # a later run matches the sets stored by the first one, within the temperature tolerance
+    create_image_with_meta(root, "dark3.fit", "darks", {**headers, "SET-TEMP": "-10.4"})
+    create_image_with_meta(root, "dark4.fit", "darks", {**headers, "SET-TEMP": "-19.6"})
+    create_image_with_meta(root, "dark5.fit", "darks", {**headers, "SET-TEMP": "-15"})
+    create_image_with_meta(root, "dark6.fit", "darks", {**headers, "SET-TEMP": "-15.2"})
+    assert SetBuilder.combine() == (4, 1)
+
+    sets = {image.file.name: image.image_set.set_temperature for image in Image.select()}
+    assert sets == {"dark1.fit": -10, "dark2.fit": -20, "dark3.fit": -10, "dark4.fit": -20,
+                    "dark5.fit": -15, "dark6.fit": -15}
+
+
+def test_combine_batches(database, monkeypatch):
+    monkeypatch.setattr(SetBuilder, "UPDATE_BATCH", 2)
+    root = Root.create(last_path=r"/dummy/does/not/exist", name="dropbox")
+    headers = {"IMAGETYP": "BIAS", "INSTRUME": "ZWO ASI294MC Pro", "EXPOSURE": "0",
+               "DATE-LOC": "2020-05-30T02:22:49.0968820"}
+    for i in range(5):
+        create_image_with_meta(root, "bias%d.fit" % i, "bias", headers)
+    assert SetBuilder.combine() == (5, 1)
+    assert Image.select().where(Image.image_set.is_null()).count() == 0
+
+
+def test_find_unmatched_images(database):
+    root = Root.create(last_path=r"/dummy/does/not/exist", name="dropbox")
+    headers = {"IMAGETYP": "BIAS", "INSTRUME": "ZWO ASI294MC Pro", "EXPOSURE": "0", "NAXIS1": "4144",
+               "DATE-LOC": "2020-05-30T02:22:49.0968820"}
+    for i in range(5):
+        create_image_with_meta(root, "bias%d.fit" % i, "bias", headers)
+    grouped = Image.get(Image.rowid == 3)
+    grouped.image_set = ImageSet.create(root=root, path="bias", img_type="BIAS", exposure=0.0,
+                                        capture_date=datetime.date(2020, 5, 29))
+    grouped.save()
+
+    unmatched = list(SetBuilder.find_unmatched_images(page_size=2))
+    assert [image.file.name for (image, header) in unmatched] == ["bias0.fit", "bias1.fit", "bias3.fit", "bias4.fit"]
+    (image, header) = unmatched[0]
+    assert image.file.root_id == root.rowid
+    assert image.file.full_filename() == os.path.join(r"/dummy/does/not/exist", "bias", "bias0.fit")
+    # only the keywords normalization needs
+    assert dict(header) == {key: value for (key, value) in headers.items() if key != "NAXIS1"}
+
+
+def test_normalize_missing(database):
+    root = Root.create(last_path=r"/dummy/does/not/exist", name="dropbox")
+    headers = {"IMAGETYP": "FLAT", "FILTER": "Ha", "EXPOSURE": "1.5", "SET-TEMP": "-10",
+               "DATE-OBS": "2020-05-30T02:22:49Z"}
+    create_image_with_meta(root, "flat1.fit", "flats", headers)
+    create_image_with_meta(root, "flat2.fit", "flats", {**headers, "DATE-OBS": "garbage"})
+    assert SetBuilder.normalize_missing() == 2
+    assert SetBuilder.normalize_missing() == 0
+
+    (flat1, flat2) = ImageInfo.select().order_by(ImageInfo.image)
+    assert (flat1.img_type, flat1.filter, flat1.exposure, flat1.set_temperature) == ("FLAT", "Ha", 1.5, -10.0)
+    assert flat1.datetime_utc == datetime.datetime(2020, 5, 30, 2, 22, 49)
+    assert flat1.session_date == datetime.date(2020, 5, 29)
+    assert flat2.img_type == "UNKNOWN"  # normalization failed
+
+
+def test_combine_image_info(database):
+    # extracted with the normalized metadata, no need to look at the header
+    root = Root.create(last_path=r"/dummy/does/not/exist", name="dropbox")
+    meta = NormalizedImageMeta()
+    meta.img_type = ImageType.DARK
+    meta.exposure = 300.0
+    meta.datetime_local = datetime.datetime(2020, 5, 30, 2, 22, 49)
+    for i in range(3):
+        file = File.create(name="dark%d.fit" % i, path="darks", root=root, size=123456, mtime_millis=0)
+        image = Image.create(file=file)
+        insert_image_info([(image.rowid,) + ImageInfo.to_row(meta)])
+    assert [image.file.name for (image, image_meta) in SetBuilder.find_unmatched_infos(page_size=2)] == \
+           ["dark0.fit", "dark1.fit", "dark2.fit"]
+    assert SetBuilder.combine() == (3, 1)
+    image_set = ImageSet.get()
+    assert (image_set.img_type, image_set.exposure) == ("DARK", 300.0)
+    assert image_set.capture_date == datetime.date(2020, 5, 29)
+
+
 def create_image_with_meta(root, name, path, meta):
     file = File.create(name=name, path=path, root=root, size=123456, mtime_millis=0)
     image = Image.create(file=file)
@@ -0,0 +1,62 @@
+import pytest
+
+from fitstools.db.database_peewee import *
+from fitstools.db.solutions import SolutionCache
+from fitstools.platesolve import ASTAPSolver, SolveScheduler, SolverFailure, SolverTimeout
+
+
+def create_files(directory, names):
+    root = Root.create(name="night", last_path=str(directory))
+    (directory / "M57").mkdir()
+    files = []
+    for name in names:
+        (directory / "M57" / name).write_bytes(b"")
+        files.append(File.create(root=root, path="M57", name=name, size=0, mtime_millis=1000))
+    return files
+
+
+def test_solve_cached(database, tmp_path, stub_astap):
+    (frame, failing) = create_files(tmp_path, ["frame1.fit", "fail.fit"])
+    solver = ASTAPSolver(stub_astap)
+    header = SolutionCache.solve(solver, frame)
+    assert header["PLTSOLVD"] == True
+    with pytest.raises(SolverFailure):
+        SolutionCache.solve(solver, failing)
+    assert {(s.file_id, s.state) for s in Solution.select()} == {(frame.rowid, Solution.SOLVED),
+                                                                  (failing.rowid, Solution.FAILED)}
+
+    missing = ASTAPSolver(str(tmp_path / "no_astap"))  # fails if it gets to run
+    cached = SolutionCache.solve(missing, frame)
+    assert cached["CRVAL1"] == header["CRVAL1"]
+    assert cached["OBJECT"] == "frame1.fit"
+    with pytest.raises(SolverFailure) as excinfo:
+        SolutionCache.solve(missing, failing)
+    assert "Failed to solve image" in str(excinfo.value)
+    with pytest.raises(FileNotFoundError):
+        SolutionCache.solve(missing, failing, retry_failed=True)
+
+    # changed since it was solved
+    File.update(mtime_millis=2000).where(File.rowid == frame.rowid).execute()
+    assert SolutionCache.lookup([frame]) == dict()
+    assert SolutionCache.solve(solver, File.get_by_id(frame.rowid))["PLTSOLVD"] == True
+    assert Solution.get_by_id(frame.rowid).mtime_millis == 2000
+
+
+def test_solve_all(database, tmp_path, stub_astap):
+    files = create_files(tmp_path, ["frame1.fit", "frame2.fit", "fail.fit", "hang.fit"])
+    SolutionCache.store(files[0], Header({"CRVAL1": 1.0, "CRVAL2": 2.0, "NAXIS2": 10, "CDELT2": 0.1}))
+    scheduler = SolveScheduler(ASTAPSolver(stub_astap), processes=2, timeout=1)
+    results = list(SolutionCache.solve_all(scheduler, files))
+    assert results[0][0] == files[0]  # cached, first
+    assert results[0][1]["CRVAL1"] == 1.0
+    by_name = {file.name: (header, error) for (file, header, error) in results}
+    assert by_name["frame2.fit"][1] is None
+    assert isinstance(by_name["fail.fit"][1], SolverFailure)
+    assert isinstance(by_name["hang.fit"][1], SolverTimeout)
+    states = {s.file.name: s.state for s in Solution.select(Solution, File).join(File)}
+    assert states == {"frame1.fit": Solution.SOLVED, "frame2.fit": Solution.SOLVED, "fail.fit": Solution.FAILED}
+
+    # only the timed out frame runs again
+    results = list(SolutionCache.solve_all(SolveScheduler(ASTAPSolver(stub_astap), timeout=1), files))
+    assert [file.name for (file, _, error) in results if isinstance(error, SolverTimeout)] == ["hang.fit"]
+    assert [file.name for (file, _, _) in results][:3] == ["frame1.fit", "frame2.fit", "fail.fit"]
@@ -0,0 +1,141 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from fitstools.db.database_peewee import *
+from fitstools.db.headerstore import read_header_dicts
+from fitstools.db.writer import MetadataWriter, BoundedFeed, PipelineStats, write_all, to_columns, to_file_ref, \
+    from_file_ref, JobQueue
+from fitstools.model import NormalizedImageMeta, ImageType
+
+
+def create_files(count, root_name="dummy"):
+    root = Root.create(name=root_name, last_path=r'C:\TEMP')
+    return [File.create(root=root, path="subdir", name="image%02d.fits" % i, size=0, mtime_millis=0)
+            for i in range(count)]
+
+
+def test_write_batches(database):
+    files = create_files(5)
+    writer = MetadataWriter(batch_size=2)
+    write_all([(file.rowid, [to_columns({"OBJECT": "M57", "EXPOSURE": 30.0})], None) for file in files], writer)
+    assert writer.stats.files == 5
+    assert writer.stats.transactions == 3
+    assert Image.select().count() == 5
+    assert ImageMeta.select().count() == 10
+    image = Image.select().where(Image.file == files[0]).get()
+    assert image.get_header()["OBJECT"] == "M57"
+
+
+def test_write_image_info(database):
+    (file,) = create_files(1)
+    meta = NormalizedImageMeta()
+    meta.img_type = ImageType.LIGHT
+    meta.exposure = 30.0
+    meta.object_name = "M57"
+    meta.datetime_utc = datetime.datetime(2021, 12, 26, 1, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+    write_all([(file.rowid, [to_columns({"OBJECT": "M57", "EXPOSURE": 30.0}, ImageInfo.to_row(meta))], None)],
+              MetadataWriter())
+    info = ImageInfo.select().join(Image).where(Image.file == file).get()
+    assert (info.img_type, info.exposure, info.object_name) == ("LIGHT", 30.0, "M57")
+    assert info.datetime_utc == datetime.datetime(2021, 12, 26, 0, 30)  # stored as naive UTC
+    assert info.session_date == meta.session_date()
+    assert info.to_meta().session_date() == meta.session_date()
+
+
+def test_write_isolates_failures(database):
+    files = create_files(2)
+    writer = MetadataWriter(batch_size=10)
+    results = [(files[0].rowid, [(("OBJECT",), ("M57",), None)], None), (9999, [(("OBJECT",), ("M57",), None)], None),  # no file
+               (files[1].rowid, [(("OBJECT",), ("M57",), None)], None)]
+    write_all(results, writer)
+    assert writer.stats.files == 2
+    assert writer.stats.failed == 1
+    assert Image.select().count() == 2
+    assert ExtractJob.select().where(ExtractJob.state == ExtractJob.DONE).count() == 2
+
+
+def test_write_isolates_failures_compact(database):
+    (file,) = create_files(1)
+    writer = MetadataWriter(batch_size=10, compact_headers=True)
+    # the new key is inserted in the batch transaction that rolls back, then again when the file is retried
+    results = [(file.rowid, [to_columns({"OBJECT": "M57", "NEWKEY": 1})], None), (9999, [], "OSError: gone")]
+    write_all(results, writer)
+    assert writer.stats.files == 1
+    image = Image.get(Image.file == file)
+    assert read_header_dicts([image.rowid])[image.rowid] == {"OBJECT": "M57", "NEWKEY": 1}
+    assert image.get_header()["NEWKEY"] == 1
+
+
+def test_job_states(database):
+    files = create_files(3)
+    Image.create(file=files[0])  # analysed before jobs were tracked
+    assert JobQueue.enqueue_new() == 2
+    assert ExtractJob.get_by_id(files[0].rowid).state == ExtractJob.DONE
+    assert [ref[0] for ref in JobQueue.file_refs(ExtractJob.PENDING)] == [files[1].rowid, files[2].rowid]
+
+    write_all([(files[1].rowid, [], "OSError: FITS header is truncated or has no END card"),
+               (files[2].rowid, [(("OBJECT",), ("M57",), None)], None)], MetadataWriter())
+    failed = ExtractJob.get_by_id(files[1].rowid)
+    assert failed.state == ExtractJob.FAILED
+    assert failed.attempts == 1
+    assert "truncated" in failed.error
+    assert JobQueue.enqueue_new() == 0  # failures are not queued again
+
+    (new_file,) = create_files(1, "new")
+    Image.create(file=new_file)
+    assert JobQueue.enqueue_new() == 0
+    assert ExtractJob.get_by_id(new_file.rowid).state == ExtractJob.DONE
+    ExtractJob.delete().where(ExtractJob.file == files[2].rowid).execute()  # before the last job
+    JobQueue.enqueue_new()
+    assert ExtractJob.get_or_none(ExtractJob.file == files[2].rowid) is None
+    JobQueue.enqueue_new(all_files=True)
+    assert ExtractJob.get_by_id(files[2].rowid).state == ExtractJob.DONE
+
+    write_all([(files[1].rowid, [(("OBJECT",), ("M57",), None)], None)], MetadataWriter())  # retried
+    retried = ExtractJob.get_by_id(files[1].rowid)
+    assert retried.state == ExtractJob.DONE
+    assert retried.attempts == 2
+    assert retried.error is None
+
+
+def test_bounded_feed():
+    stats = PipelineStats()
+    feed = BoundedFeed(range(10), 3, stats)
+    produced = iter(feed)
+    assert [next(produced) for _ in range(3)] == [0, 1, 2]
+    feed.done()  # one result consumed, one more slot
+    assert next(produced) == 3
+    assert feed._slots.acquire(blocking=False) is False  # all slots taken
+
+
+def test_bounded_feed_closed_on_error(database):
+    # the producer runs in its own thread, like the pool's task handler, and must not block when the consumer fails
+    stats = PipelineStats()
+    feed = BoundedFeed(range(100), 2, stats)
+    produced = []
+    producer = threading.Thread(target=lambda: produced.extend(feed))
+    producer.start()
+
+    def results():
+        while len(produced) < 2:
+            time.sleep(0.01)
+        yield 9999, [], None
+        raise RuntimeError("worker died")
+
+    with pytest.raises(RuntimeError):
+        write_all(results(), MetadataWriter(), feed)
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+    assert produced[:2] == [0, 1] and len(produced) <= 3  # the slot freed by the first result may be used
+
+
+def test_file_ref():
+    root = Root(name="dummy", last_path=r'C:\TEMP')
+    file = File(rowid=12, root=root, path="subdir", name="image01.fits.xz", size=0, mtime_millis=0)
+    copy = from_file_ref(to_file_ref(file))
+    assert copy.rowid == 12
+    assert copy.full_filename() == file.full_filename()
+    assert copy.get_file_exts() == ["fits", "xz"]
@@ -0,0 +1,66 @@
+import lzma
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy import wcs
+from astropy.io import fits
+
+from fitstools.platesolve import ASTAPSolver, prepare_input
+
+# the frames of test_platesolve, solved at full resolution and binned
+FRAMES = ["M100_2019-05-02T231819_120sec_LP__-25C_frame9.fit",
+          "L_2018-10-23_20-58-50_Bin1x1_240s__-20C.fit",
+          "Sadr Area_2020-05-28T011655_60sec_HaOIII__-15C_frame18.fit",
+          "M57_2020-05-30T022249_30sec_HaOIII_COLD_-17C_frame19.fit"]
+TEST_DATA = Path(__file__).parent.parent / "test-data"
+
+
+def synthetic_frame(path: Path, width=5496, height=3672):
+    """ an ASI183 sized sub: noise and a few thousand stars, xz compressed like the archive """
+    rng = np.random.default_rng(7)
+    data = rng.normal(1000, 30, (height, width)).astype(np.uint16)
+    (ys, xs) = (rng.integers(2, height - 2, 3000), rng.integers(2, width - 2, 3000))
+    for (dy, dx, level) in [(0, 0, 8000), (-1, 0, 3000), (1, 0, 3000), (0, -1, 3000), (0, 1, 3000)]:
+        data[ys + dy, xs + dx] += level
+    content = BytesIO()
+    fits.PrimaryHDU(data).writeto(content)
+    with lzma.open(path, "wb", preset=0) as fd:
+        fd.write(content.getvalue())
+    return path
+
+
+def test_prepare_input_benchmark(tmp_path):
+    frame = synthetic_frame(tmp_path / "frame.fits.xz")
+    print()
+    for binning in (1, 2, 3):
+        work_dir = Path(tempfile.mkdtemp(dir=tmp_path))
+        start = time.perf_counter()
+        (input_file, _) = prepare_input(frame, work_dir, binning)
+        print("bin %d: decompress, bin and write %.2fs, %.1f MB for ASTAP" %
+              (binning, time.perf_counter() - start, input_file.stat().st_size / 1e6))
+
+
+@pytest.mark.skipif(shutil.which("astap") is None, reason="needs astap")
+@pytest.mark.parametrize("frame", FRAMES)
+def test_binned_solve_benchmark(frame):
+    image_file = TEST_DATA / frame
+    timings = dict()
+    headers = dict()
+    for binning in (1, 2, 3):
+        start = time.perf_counter()
+        headers[binning] = ASTAPSolver(binning=binning).solve(image_file)
+        timings[binning] = time.perf_counter() - start
+    full = wcs.WCS(headers[1])
+    (width, height) = (headers[1]["NAXIS1"], headers[1]["NAXIS2"])
+    pixels = np.array([[1, 1], [width, 1], [1, height], [width, height], [(width + 1) / 2, (height + 1) / 2]])
+    reference = full.pixel_to_world(pixels[:, 0] - 1, pixels[:, 1] - 1)
+    print("\n%s: full %.1fs" % (frame, timings[1]))
+    for binning in (2, 3):
+        binned = wcs.WCS(headers[binning]).pixel_to_world(pixels[:, 0] - 1, pixels[:, 1] - 1)
+        print("  bin %d: %.1fs, corners and center within %.1f arcsec of the full resolution solution" %
+              (binning, timings[binning], reference.separation(binned).arcsec.max()))
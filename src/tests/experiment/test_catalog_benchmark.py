@@ -0,0 +1,43 @@
+import time
+
+import logzero
+import numpy as np
+from astropy.io.fits import Header
+
+from fitstools.catalog import Catalogs
+from .. import sample_headers
+
+IMAGES = 1000
+TARGETS = 20
+
+
+def synthetic_headers():
+    """ a night of dithered subs spread over a few targets, solved at random rotations """
+    base = Header.fromstring(sample_headers.header_sgp_fixed_wcs, "\n")
+    rng = np.random.default_rng(42)
+    targets = rng.uniform([0, -60], [360, 80], (TARGETS, 2))
+    headers = []
+    for i in range(IMAGES):
+        header = base.copy()
+        (ra, dec) = targets[i % TARGETS]
+        header["CRVAL1"] = (ra + rng.normal(0, 0.05)) % 360
+        header["CRVAL2"] = dec + rng.normal(0, 0.05)
+        header["CROTA2"] = rng.uniform(0, 360)
+        headers.append(header)
+    return headers
+
+
+def test_find_objects_many_benchmark(tmp_path):
+    catalog = Catalogs(str(tmp_path / "index"))
+    headers = synthetic_headers()
+    logzero.loglevel(logzero.WARNING)
+    start = time.perf_counter()
+    one_by_one = [catalog.find_objects(header) for header in headers]
+    loop_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    many = catalog.find_objects_many(headers)
+    many_seconds = time.perf_counter() - start
+    logzero.loglevel(logzero.INFO)
+    print("\n%d images, %d objects: find_objects %.2fs, find_objects_many %.2fs" %
+          (IMAGES, sum(map(len, many)), loop_seconds, many_seconds))
+    assert [sorted(objects) for objects in many] == [sorted(objects) for objects in one_by_one]
@@ -0,0 +1,63 @@
+import os
+import time
+
+from astropy.io.fits import Header
+from peewee import SqliteDatabase
+
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.analysis.metadata import MetadataAnalyser
+from fitstools.db.database_peewee import CORE_MODELS, Root, File, Image
+from fitstools.db.headerstore import read_header_dicts
+from fitstools.db.writer import MetadataWriter, write_all, to_columns
+from .. import sample_headers
+
+IMAGES = 2000
+GET_HEADER = 200  # Image.get_header() calls, one image at a time
+
+
+def header_dicts():
+    names = ["header_sgp_fixed_wcs", "header_maximdl", "header_apt", "header_sharpcap", "header_nina"]
+    return [FitsFileFormat.safe_dict(Header.fromstring(getattr(sample_headers, name), "\n")) for name in names]
+
+
+def measure(path, compact):
+    db = SqliteDatabase(path, pragmas={'foreign_keys': 1})
+    db.bind(CORE_MODELS, bind_refs=False, bind_backrefs=False)
+    db.connect()
+    db.create_tables(CORE_MODELS)
+    try:
+        root = Root.create(name="bench", last_path="mem://")
+        with db.atomic():
+            File.insert_many([(root.rowid, "lights", "image%05d.fits" % i, 0, 0) for i in range(IMAGES)],
+                             fields=[File.root, File.path, File.name, File.size, File.mtime_millis]).execute()
+        headers = header_dicts()
+        results = [(rowid, [to_columns(headers[rowid % len(headers)])], None)
+                   for (rowid,) in File.select(File.rowid).tuples()]
+
+        start = time.perf_counter()
+        write_all(results, MetadataWriter(batch_size=100, compact_headers=compact))
+        write = time.perf_counter() - start
+
+        image_ids = [rowid for (rowid,) in Image.select(Image.rowid).tuples()]
+        start = time.perf_counter()
+        for image in Image.select().limit(GET_HEADER):
+            image.get_header()
+        get_header = (time.perf_counter() - start) / GET_HEADER
+
+        keys = MetadataAnalyser.header_keys()
+        start = time.perf_counter()
+        selected = read_header_dicts(image_ids, keys)
+        read_keys = time.perf_counter() - start
+        assert len(selected) == IMAGES
+    finally:
+        db.close()
+    return os.path.getsize(path), write, get_header, read_keys
+
+
+def test_header_store_benchmark(tmp_path):
+    cards = sum(len(header) for header in header_dicts()) / 5
+    print("\n%d images, %.0f cards per header on average" % (IMAGES, cards))
+    for (name, compact) in (("ImageMeta", False), ("ImageHeader", True)):
+        (size, write, get_header, read_keys) = measure(str(tmp_path / ("%s.db" % name)), compact)
+        print("%-12s %6.1f MB (%5.0f bytes/image), write %.2fs, get_header %.2fms, normalization keys of all "
+              "images %.2fs" % (name, size / 1e6, size / IMAGES, write, get_header * 1e3, read_keys))
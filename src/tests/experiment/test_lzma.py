@@ -1,5 +1,6 @@
 import gzip
 import lzma
+import time
 from io import BytesIO
 from pathlib import Path
 
@@ -7,6 +8,8 @@ import numpy
 from astropy.io import fits
 from astropy.io.fits import HDUList
 
+from fitstools.util import read_primary_header
+
 
 def test_read_lzma_header_buffer():
     filename = r'E:\TEMP\IC 342_2019-12-02T022653_60sec_LP__-15C_frame6.fit.xz'
@@ -122,6 +125,38 @@ def test_read_uncompressed_all_buffer():
     print("data median %d" % numpy.median(hdul[0].data))
 
 
+def test_header_only_benchmark(tmp_path):
+    """ full read-once buffering (what extract_metadata used to do) versus reading up to the END card """
+    rng = numpy.random.default_rng(42)
+    data = (1000 + rng.normal(0, 50, (1024, 2048))).astype(numpy.int16)  # noisy, so it compresses like a real sub
+    plain = tmp_path / "bench.fit"
+    fits.PrimaryHDU(data).writeto(plain)
+    raw = plain.read_bytes()
+    with gzip.open(tmp_path / "bench.fit.gz", mode="wb") as f:
+        f.write(raw)
+    with lzma.open(tmp_path / "bench.fit.xz", mode="wb", preset=1) as f:
+        f.write(raw)
+
+    openers = {"plain": (plain, open), "gz": (tmp_path / "bench.fit.gz", gzip.open),
+               "xz": (tmp_path / "bench.fit.xz", lzma.open)}
+    print("\n%d byte file" % len(raw))
+    for (name, (path, fopen)) in openers.items():
+        start = time.perf_counter()
+        with fopen(path, mode="rb") as f:
+            buffer = BytesIO(f.read())
+        with fits.open(buffer) as hdul:
+            full_header = hdul[0].header
+        full = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with fopen(path, mode="rb") as f:
+            header = read_primary_header(f)
+        header_only = time.perf_counter() - start
+
+        assert list(header.items()) == list(full_header.items())
+        print("%s\tfull read %.4fs\theader only %.4fs\t%.0fx" % (name, full, header_only, full / header_only))
+
+
 def resolve_test_data(file):
     root = Path(__file__).parent
     path = Path(root, "../test-data", file)
@@ -0,0 +1,49 @@
+import time
+from pathlib import Path
+
+import logzero
+from astropy.io.fits import Header
+
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.analysis.metadata import MetadataAnalyser
+from .. import sample_headers
+
+ROUNDS = 1000
+NAMES = ["header_sgp_fixed_wcs", "header_maximdl", "header_apt", "header_sharpcap", "header_nina"]
+
+
+def timed(normalize, header):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        normalize(header, Path("dummyFile.fit"))
+    return (time.perf_counter() - start) / ROUNDS * 1e6
+
+
+def test_normalization_benchmark():
+    logzero.loglevel(logzero.INFO)  # as in the scripts
+    print()
+    for name in NAMES:
+        header = Header.fromstring(getattr(sample_headers, name), "\n")
+        header_dict = FitsFileFormat.safe_dict(header)
+        print("%-22s Header %6.1fus, dict %6.1fus" % (name, timed(MetadataAnalyser.normalize, header),
+                                                      timed(MetadataAnalyser.normalize_dict, header_dict)))
+
+
+def test_normalize_many_benchmark():
+    logzero.loglevel(logzero.INFO)
+    header_dicts = [FitsFileFormat.safe_dict(Header.fromstring(getattr(sample_headers, name), "\n")) for name in NAMES]
+    many = []
+    for i in range(10000):  # distinct dates, like real subs
+        header_dict = dict(header_dicts[i % len(header_dicts)])
+        header_dict["DATE-OBS"] = "2021-%02d-%02dT%02d:%02d:%02d.%03d" % (i % 12 + 1, i % 28 + 1, i % 24, i % 60,
+                                                                         i % 59, i % 1000)
+        many.append(header_dict)
+
+    start = time.perf_counter()
+    metas = [MetadataAnalyser.normalize_dict(header_dict, Path("dummyFile.fit")) for header_dict in many]
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    frame = MetadataAnalyser.normalize_many(many)
+    columnar = time.perf_counter() - start
+    assert len(frame) == len(metas)
+    print("\n%d headers: normalize_dict loop %.3fs, normalize_many %.3fs" % (len(many), loop, columnar))
@@ -0,0 +1,37 @@
+import math
+import time
+
+import numpy as np
+from astropy.stats import gaussian_fwhm_to_sigma
+
+from fitstools.analysis.quality import QualityAnalyser
+
+SHAPE = (3520, 5496)  # 20MP, IMX183
+STARS = 800
+FWHM = 3.3
+
+
+def synthetic_frame():
+    """ slightly elongated gaussian stars on a noisy background, as uint16 """
+    rng = np.random.default_rng(7)
+    sigma_x = FWHM * gaussian_fwhm_to_sigma * 1.15
+    sigma_y = FWHM * gaussian_fwhm_to_sigma / 1.15
+    data = rng.normal(1000, 10, SHAPE).astype(np.float32)
+    (y, x) = np.mgrid[-10:11, -10:11]
+    for (cy, cx, peak) in zip(rng.uniform(20, SHAPE[0] - 20, STARS), rng.uniform(20, SHAPE[1] - 20, STARS),
+                              rng.uniform(300, 3000, STARS)):
+        (iy, ix) = (int(cy), int(cx))
+        data[iy - 10:iy + 11, ix - 10:ix + 11] += peak * np.exp(-(x - (cx - ix)) ** 2 / (2 * sigma_x ** 2)
+                                                                 - (y - (cy - iy)) ** 2 / (2 * sigma_y ** 2))
+    return np.clip(np.rint(data), 0, 65535).astype(np.uint16)
+
+
+def test_quality_benchmark():
+    data = synthetic_frame()
+    true_fwhm = FWHM * math.sqrt((1.15 ** 2 + 1.15 ** -2) / 2)
+    print()
+    for fast in (True, False):
+        start = time.perf_counter()
+        quality = QualityAnalyser.measure(data, fast)
+        print("fast=%s %.2fs %s (true fwhm %.3f)" % (fast, time.perf_counter() - start, quality, true_fwhm))
+        assert abs(quality.median_fwhm - true_fwhm) < 0.05 * true_fwhm
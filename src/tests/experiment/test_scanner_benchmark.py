@@ -0,0 +1,53 @@
+import time
+
+from fs.memoryfs import MemoryFS
+from peewee import SqliteDatabase
+
+from fitstools.db.database_peewee import CORE_MODELS, Root, File
+from fitstools.db.scanner import Importer
+
+NIGHTS = 100
+TARGETS = 4
+FILES = 25
+
+
+def make_tree():
+    dummy_bytes = bytes("DUMMY CONTENT", "UTF-8")
+    mem_fs = MemoryFS()
+    for night in range(NIGHTS):
+        for target in range(TARGETS):
+            path = "2021-%03d/target%d/Light" % (night, target)
+            mem_fs.makedirs(path)
+            for i in range(FILES):
+                mem_fs.writebytes("%s/image%02d.fits" % (path, i), dummy_bytes)
+    return mem_fs
+
+
+def timed_rescan(mem_fs, root, importer):
+    start = time.perf_counter()
+    change_list = importer.import_files_from(mem_fs, root)
+    return time.perf_counter() - start, change_list
+
+
+def test_snapshot_strategies():
+    db = SqliteDatabase(':memory:', pragmas={'foreign_keys': 1})
+    db.bind(CORE_MODELS, bind_refs=False, bind_backrefs=False)
+    db.connect()
+    db.create_tables(CORE_MODELS)
+    mem_fs = make_tree()
+    try:
+        root = Root.create(name="bench", last_path="mem://")
+        Importer().import_files_from(mem_fs, root).apply_all()
+        total = NIGHTS * TARGETS * FILES
+        assert File.select().count() == total
+
+        (per_dir, per_dir_changes) = timed_rescan(mem_fs, root, Importer())
+        (per_root, per_root_changes) = timed_rescan(mem_fs, root, Importer(preload_root=True))
+        for changes in (per_dir_changes, per_root_changes):
+            assert len(changes.new_files) + len(changes.changed_files) + len(changes.removed_files) == 0
+
+        print("\nrescan of %d files: per directory %.3fs (%.0f files/s), per root %.3fs (%.0f files/s)"
+              % (total, per_dir, total / per_dir, per_root, total / per_root))
+    finally:
+        mem_fs.close()
+        db.close()
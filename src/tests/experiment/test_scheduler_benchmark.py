@@ -0,0 +1,24 @@
+import time
+from pathlib import Path
+
+from fitstools.platesolve import ASTAPSolver, SolveJob, SolveScheduler
+
+
+def stub_frames(directory: Path, count: int):
+    directory.mkdir(parents=True, exist_ok=True)
+    frames = [directory / ("frame%d.fit" % i) for i in range(count)]
+    for frame in frames:
+        frame.write_bytes(b"")
+    return frames
+
+
+def test_scheduler_frames_per_minute(stub_astap, tmp_path):
+    """ throughput of the solve scheduler against the stub astap, one process versus four """
+    frames = [frame for target in ["M31", "M33", "M57"] for frame in stub_frames(tmp_path / target, 8)]
+    for processes in (1, 4):
+        jobs = [SolveJob(frame, set_key=frame.parent.name) for frame in frames]
+        start = time.perf_counter()
+        done = list(SolveScheduler(ASTAPSolver(stub_astap), processes=processes).run(jobs))
+        elapsed = time.perf_counter() - start
+        assert all(job.state == SolveJob.SOLVED for job in done)
+        print("stub astap, %d process(es): %.0f frames/min" % (processes, len(done) / elapsed * 60))
@@ -0,0 +1,74 @@
+import time
+
+from peewee import SqliteDatabase
+
+from fitstools.analysis.metadata import MetadataAnalyser
+from fitstools.analysis.setbuilder import SetBuilder
+from fitstools.db.database_peewee import CORE_MODELS, Root, File, Image, ImageMeta, ImageSet
+from fitstools.model import ImageType
+
+NIGHTS = 20
+FILTERS = ["L", "R", "G", "B"]
+FILES = 25
+
+
+def make_database():
+    db = SqliteDatabase(':memory:', pragmas={'foreign_keys': 1})
+    db.bind(CORE_MODELS, bind_refs=False, bind_backrefs=False)
+    db.connect()
+    db.create_tables(CORE_MODELS)
+    root = Root.create(name="bench", last_path="mem://")
+    with db.atomic():
+        for night in range(NIGHTS):
+            for filter_name in FILTERS:
+                for i in range(FILES):
+                    file = File.create(root=root, path="2021-%03d/Light" % night, name="%s_%02d.fits" % (filter_name, i),
+                                       size=123456, mtime_millis=0)
+                    image = Image.create(file=file)
+                    headers = {"IMAGETYP": "LIGHT", "FILTER": filter_name, "INSTRUME": "ZWO ASI1600MM Pro",
+                               "EXPOSURE": "300", "SET-TEMP": "-20", "CCD-TEMP": "-19.8", "OBJECT": "M 31",
+                               "XBINNING": "1", "YBINNING": "1", "GAIN": "139", "OFFSET": "21",
+                               "DATE-LOC": "2021-01-%02dT22:%02d:00" % (night % 28 + 1, i)}
+                    ImageMeta.insert_many([(image, key, value) for (key, value) in headers.items()],
+                                          fields=[ImageMeta.image, ImageMeta.key, ImageMeta.value]).execute()
+    return db
+
+
+def combine_per_image():
+    """ the set matching as it was before the in-memory set index: a query and an update per image """
+    combinable = [ImageType.LIGHT, ImageType.DARK, ImageType.BIAS, ImageType.FLAT]
+    for (image, header) in SetBuilder.find_unmatched_images():
+        image_meta = MetadataAnalyser.normalize(header, image.file.full_filename())
+        if image_meta is not None and image_meta.img_type in combinable:
+            matching_set = SetBuilder.find_matching_set(image_meta, image.file.path, image.file.root.get_id())
+            if matching_set is None:
+                matching_set = SetBuilder.create_set(image_meta, image.file.path, image.file.root.get_id())
+            Image.update(image_set=matching_set.get_id()).where(Image.rowid == image.rowid).execute()
+
+
+def timed(db, combine):
+    start = time.perf_counter()
+    with db.atomic():
+        combine()
+    elapsed = time.perf_counter() - start
+    assignments = [(image.file.name, image.file.path, image.image_set.filter) for image in Image.select()]
+    return elapsed, ImageSet.select().count(), sorted(assignments)
+
+
+def test_combine_benchmark():
+    total = NIGHTS * len(FILTERS) * FILES
+    db = make_database()
+    try:
+        (before, before_sets, before_assignments) = timed(db, combine_per_image)
+    finally:
+        db.close()
+    db = make_database()
+    try:
+        (after, after_sets, after_assignments) = timed(db, SetBuilder.combine)
+    finally:
+        db.close()
+    assert before_sets == after_sets == NIGHTS * len(FILTERS)
+    assert before_assignments == after_assignments
+
+    print("\ncombine of %d images into %d sets: per image %.3fs (%.0f images/s), set index %.3fs (%.0f images/s)"
+          % (total, after_sets, before, total / before, after, total / after))
@@ -0,0 +1,44 @@
+import pickle
+import time
+
+from astropy.io.fits import Header
+
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.db.database_peewee import Root, File
+from fitstools.db.writer import to_columns
+from .. import sample_headers
+
+CHUNK = 10  # extract_metadata.CHUNKSIZE, results are pickled a chunk at a time
+ROUNDS = 200
+
+
+def model_result(index, header_dict):
+    """ what analyze() used to send back: Image and ImageMeta models, with the File and Root attached """
+    root = Root(rowid=1, name="archive", last_path=r"Z:\Deep Sky\Raw")
+    file = File(rowid=index, root=root, path="ZWO_ASI294MC_Pro/2020-05-29/M57", name="M57_%04d.fit" % index,
+                size=16542720, mtime_millis=1590798169000)
+    return FitsFileFormat.import_header_dict(file, dict(header_dict))
+
+
+def tuple_result(index, header_dict):
+    return index, [to_columns(dict(header_dict))], None
+
+
+def measure(make_result, header_dict):
+    chunk = [make_result(i, header_dict) for i in range(CHUNK)]
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        data = pickle.dumps(chunk)
+        pickle.loads(data)
+    seconds = time.perf_counter() - start
+    return len(data) / CHUNK, seconds / (ROUNDS * CHUNK) * 1e6
+
+
+def test_serialization_overhead():
+    header = Header.fromstring(sample_headers.header_sgp_fixed_wcs, "\n")
+    header_dict = FitsFileFormat.safe_dict(header)
+    (model_bytes, model_us) = measure(model_result, header_dict)
+    (tuple_bytes, tuple_us) = measure(tuple_result, header_dict)
+    print("\nper file, %d header fields: models %.0f bytes %.1fus, tuples %.0f bytes %.1fus"
+          % (len(header_dict), model_bytes, model_us, tuple_bytes, tuple_us))
+    assert tuple_bytes < model_bytes
@@ -0,0 +1,50 @@
+import pytest
+from astropy.io.fits import Header
+
+from fitstools.analysis.cardparser import parse_cards, parse_dict
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.util import FITS_BLOCK_SIZE
+
+from . import sample_headers
+
+
+def to_blocks(*cards: str) -> bytes:
+    data = "".join(card.ljust(80) for card in cards).encode("ascii")
+    padding = -len(data) % FITS_BLOCK_SIZE
+    return data + b" " * padding
+
+
+@pytest.mark.parametrize("name", ["header_sgp_fixed_wcs", "header_maximdl", "header_apt", "header_sharpcap",
+                                  "header_nina"])
+def test_same_as_astropy(name):
+    data = to_blocks(*getattr(sample_headers, name).split("\n"))
+    expected = FitsFileFormat.safe_dict(Header.fromstring(data))
+    result = parse_dict(data)
+    assert list(result.keys()) == list(expected.keys())
+    for key, value in expected.items():
+        assert result[key] == value
+        assert type(result[key]) == type(value)
+
+
+def test_value_types():
+    data = to_blocks("SIMPLE  =                    T", "EXTEND  =                    F / no extensions",
+                     "NAXIS   =                   +2", "EXPTIME =   3.00000000000D+002",
+                     "PEDESTAL=                  -1.", "NOTES   = '        '", "QUOTE   = 'it''s / ok' / comment",
+                     "HISTORY  Flat-Bias", "END")
+    assert parse_cards(data) == [("SIMPLE", True), ("EXTEND", False), ("NAXIS", 2), ("EXPTIME", 300.0),
+                                 ("PEDESTAL", -1.0), ("NOTES", ""), ("QUOTE", "it's / ok"),
+                                 ("HISTORY", " Flat-Bias")]
+
+
+def test_tabs_in_object():
+    data = to_blocks("OBJECT  = 'M57\tRing'           / Object name", "END")
+    assert parse_dict(data) == {"OBJECT": "M57 Ring"}
+
+
+def test_astropy_fallback():
+    data = to_blocks("HIERARCH iTelescope = 'iTelescope 33'", "LONGSTR = 'first part &'",
+                     "CONTINUE  'second part'", "BLANK   =", "END")
+    result = parse_dict(data)
+    assert result["iTelescope"] == "iTelescope 33"
+    assert result["LONGSTR"] == "first part second part"
+    assert "BLANK" in result
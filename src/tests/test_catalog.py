@@ -1,5 +1,7 @@
 import csv
+import multiprocessing
 import os
+import sys
 from pathlib import Path
 
 import numpy as np
@@ -14,7 +16,8 @@ from astropy_healpix import HEALPix
 from logzero import logger
 from . import sample_headers
 
-from src.fitstools.catalog import Catalogs
+import src.fitstools.catalog as catalog_module
+from src.fitstools.catalog import Catalogs, CatalogIndex, load_csv
 from src.fitstools.util import read_headers
 
 our_path = os.path.dirname(__file__)
@@ -60,8 +63,8 @@ def test_pandas_reader():
     logger.info("groupby - " + str(len(df)))
 
 @pytest.fixture()
-def catalog():
-    catalog = Catalogs()
+def catalog(tmp_path):
+    catalog = Catalogs(str(tmp_path / "index"))
     return catalog
 
 
@@ -71,7 +74,99 @@ def test_find_objects(catalog):
     logger.info(objects)
     names = map(lambda t: t[2], objects)
     assert "M57/NGC6720/Ring_Nebula" in names
-    assert "IC1296" in names
+    assert "IC1296/PGC62532" in names
+
+
+def test_find_objects_many(catalog):
+    header = Header.fromstring(sample_headers.header_sgp_fixed_wcs, "\n")
+    headers = [header]
+    for (d_ra, d_dec, rotation) in [(0.1, 0.0, 0.0), (0.3, -0.2, 45.0), (-120.0, 20.0, 200.0)]:
+        shifted = header.copy()
+        shifted["CRVAL1"] = (header["CRVAL1"] + d_ra) % 360
+        shifted["CRVAL2"] = header["CRVAL2"] + d_dec
+        shifted["CROTA2"] = rotation
+        headers.append(shifted)
+    headers.append(Header.fromstring(sample_headers.header_maximdl, "\n"))  # not solved
+    many = catalog.find_objects_many(headers)
+    assert len(many) == len(headers)
+    for (header, objects) in zip(headers[:-1], many):
+        assert sorted(objects) == sorted(catalog.find_objects(header))
+    assert "M57/NGC6720/Ring_Nebula" in [t[2] for t in many[0]]
+    assert many[-1] == []
+
+
+def index_memory(directory: str):
+    """ resident, shared and private kB of this process' maps of the index files """
+    totals = dict(Rss=0, Shared_Clean=0, Shared_Dirty=0, Private_Clean=0, Private_Dirty=0)
+    in_index = False
+    with open("/proc/self/smaps", encoding="utf-8") as fh:
+        for line in fh:
+            fields = line.split()
+            if "-" in fields[0]:  # a new mapping: address range, perms, offset, dev, inode, path
+                in_index = len(fields) > 5 and fields[5].startswith(directory)
+            elif in_index and fields[0].rstrip(":") in totals:
+                totals[fields[0].rstrip(":")] += int(fields[1])
+    return totals
+
+
+def worker_memory(header_string: str):
+    catalog = catalog_module.shared_catalogs()
+    index = catalog._index
+    checksum = float(index.ra.sum() + index.dec.sum()) + int(index.name.view(np.uint8).sum())  # touch every page
+    objects = catalog.find_objects_many([Header.fromstring(header_string, "\n")])[0]
+    memory = index_memory(catalog_module.Config.CATALOG_INDEX_DIR)
+    return os.getpid(), id(catalog), checksum, [t[2] for t in objects], memory
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads /proc/self/smaps")
+def test_shared_catalogs(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog_module.Config, "CATALOG_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(catalog_module, "_shared", None)
+    shared = catalog_module.shared_catalogs()
+    assert catalog_module.shared_catalogs() is shared
+    (_, parent_id, parent_checksum, _, parent_memory) = worker_memory(sample_headers.header_sgp_fixed_wcs)
+    assert parent_memory["Rss"] > 0
+
+    with multiprocessing.get_context("fork").Pool(2) as pool:
+        results = pool.map(worker_memory, [sample_headers.header_sgp_fixed_wcs] * 4, chunksize=1)
+    for (pid, catalog_id, checksum, names, memory) in results:
+        logger.info("worker %d: index %s kB" % (pid, memory))
+        assert catalog_id == parent_id  # inherited, not loaded again
+        assert checksum == parent_checksum
+        assert "M57/NGC6720/Ring_Nebula" in names
+        assert memory["Rss"] == parent_memory["Rss"]
+        # every page shared with the parent (dirty: a freshly built index may not be written back yet)
+        assert memory["Shared_Clean"] + memory["Shared_Dirty"] == memory["Rss"]
+        assert memory["Private_Clean"] + memory["Private_Dirty"] == 0
+
+
+def test_catalog_index(tmp_path):
+    source = tmp_path / "small.csv"
+    with open(deep_sky_file, encoding="utf-8") as fh:
+        source.write_text("".join(fh.readlines()[:1000]), encoding="utf-8")
+    index_dir = str(tmp_path / "index")
+    index = CatalogIndex.open([str(source)], index_dir, 16)
+    entries = len(load_csv(str(source)))
+    assert len(index) == entries
+    assert isinstance(index.ra, np.memmap)
+    hp = HEALPix(nside=16, frame='icrs')
+    assert index.offsets[-1] == len(index)
+    for pix in hp.lonlat_to_healpix(index.ra[:50] * u.deg, index.dec[:50] * u.deg):
+        (ra, dec, names) = index.pixel(pix)
+        assert (hp.lonlat_to_healpix(ra * u.deg, dec * u.deg) == pix).all()
+    assert b"M57/NGC6720/Ring_Nebula" in index.name
+
+    # unchanged sources: mapped as is
+    stamp = os.stat(os.path.join(index_dir, "ra.npy")).st_mtime_ns
+    assert len(CatalogIndex.open([str(source)], index_dir, 16)) == entries
+    assert os.stat(os.path.join(index_dir, "ra.npy")).st_mtime_ns == stamp
+
+    # a changed source is indexed again
+    with open(source, "a", encoding="utf-8") as fh:
+        fh.write("0,0,Origin\n")
+    index = CatalogIndex.open([str(source)], index_dir, 16)
+    assert len(index) == entries + 1
+    assert b"Origin" in index.name
 
 
 def test_wcs_astap():
@@ -1,8 +1,14 @@
 import lzma
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
+import pytest
 from astropy.io import fits
-from astropy.io.fits import HDUList
+from astropy.io.fits import HDUList, Header
+
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.util import read_primary_header, read_header_blocks, has_extensions, FITS_BLOCK_SIZE
 
 
 def test_read_lzma_header():
@@ -13,6 +19,43 @@ def test_read_lzma_header():
         print(repr(hdul[0].header))
 
 
+def test_read_primary_header_only():
+    filename = resolve_test_data('test_image.fits.xz')
+    with lzma.open(filename) as f:
+        header = read_primary_header(f)
+        assert f.tell() == FITS_BLOCK_SIZE  # the data block was never decompressed
+    with lzma.open(filename) as f:
+        expected = fits.open(f)[0].header
+    assert list(header.items()) == list(expected.items())
+    assert not has_extensions(header)
+
+
+def test_read_header_blocks_truncated():
+    with pytest.raises(OSError):
+        read_header_blocks(BytesIO(bytes("DUMMY CONTENT", "UTF-8")))
+
+
+def test_has_extensions():
+    assert has_extensions(Header({"SIMPLE": True, "NAXIS": 0, "EXTEND": True}))
+    assert not has_extensions(Header({"SIMPLE": True, "NAXIS": 2, "EXTEND": True}))
+
+
+def test_read_extension_headers():
+    data = np.zeros((4, 6), dtype=np.uint16)
+    primary = fits.PrimaryHDU(header=Header({"TELESCOP": "C9.25", "OBJECT": "M57"}))
+    inheriting = fits.ImageHDU(data, Header({"INHERIT": True, "FILTER": "Ha"}))
+    compressed = fits.CompImageHDU(data, Header({"FILTER": "OIII"}))
+    table = fits.BinTableHDU.from_columns([fits.Column(name="x", format="E", array=np.zeros(3))])
+    buffer = BytesIO()
+    HDUList([primary, inheriting, table, compressed]).writeto(buffer)
+    buffer.seek(0)
+    (first, second) = FitsFileFormat().read_header_dicts(buffer)
+    assert (first["FILTER"], first["TELESCOP"], first["NAXIS1"]) == ("Ha", "C9.25", 6)
+    assert "SIMPLE" not in first and first["XTENSION"] == "IMAGE"
+    assert (second["FILTER"], second["NAXIS1"]) == ("OIII", 6)
+    assert "TELESCOP" not in second
+
+
 def resolve_test_data(file):
     root = Path(__file__).parent
     path = Path(root, "test-data", file)
@@ -1,10 +1,13 @@
 import datetime
 from pathlib import Path
 from dateutil import parser
+import pandas
 import pytest
 from astropy.io.fits import Header
 
-from fitstools.analysis.metadata import MetadataAnalyser
+from fitstools.analysis.fileformat import FitsFileFormat
+from fitstools.analysis.metadata import MetadataAnalyser, Support, GenericSupport, NinaSupport, SGPSupport, \
+    _parse_datetime, _resolve_support
 from fitstools.model import ImageType
 
 from . import sample_headers
@@ -95,3 +98,64 @@ def test_no_meta():
     assert results.img_type == ImageType.UNKNOWN
     assert results.camera_name is None
     assert results.session_date() is None
+
+
+@pytest.mark.parametrize("value", ["2020-05-30T02:22:49.0968820", "2020-05-30T00:22:49.0968820Z", "2018-07-04T14:03:03",
+                                   "2021-03-02T21:19:00.455", "2021-03-02 21:19:00", "2021-03-02T21:19:00+01:00",
+                                   "2021-03-02", "04/07/18"])
+def test_parse_datetime(value):
+    assert _parse_datetime(value) == parser.parse(value)
+    assert _parse_datetime(value).tzinfo == parser.parse(value).tzinfo
+
+
+@pytest.mark.parametrize("name", ["header_sgp_fixed_wcs", "header_maximdl", "header_apt", "header_sharpcap",
+                                  "header_nina"])
+def test_normalize_dict(name):
+    header = Header.fromstring(getattr(sample_headers, name), "\n")
+    from_header = MetadataAnalyser.normalize(header, Path("dummyFile.fit"))
+    from_dict = MetadataAnalyser.normalize_dict(FitsFileFormat.safe_dict(header), Path("dummyFile.fit"))
+    assert vars(from_header) == vars(from_dict)
+    keys = MetadataAnalyser.header_keys()
+    only_keys = MetadataAnalyser.normalize(Header([card for card in header.cards if card.keyword in keys]),
+                                           Path("dummyFile.fit"))
+    assert vars(only_keys) == vars(from_header)
+
+
+def test_support_cache():
+    header = Header.fromstring(sample_headers.header_nina, "\n")
+    assert isinstance(Support.find(header, Path("dummyFile.fit")), NinaSupport)
+    hits = _resolve_support.cache_info().hits
+    header["OBJECT"] = "M 42"
+    assert isinstance(Support.find(header, Path("dummyFile.fit")), NinaSupport)
+    assert _resolve_support.cache_info().hits == hits + 1
+    assert isinstance(Support.find({"SWCREATE": "SharpCap"}, Path("dummyFile.fit")), GenericSupport)
+    assert isinstance(Support.find({"CREATOR": "Sequence Generator Pro v3"}, Path("dummyFile.fit")), SGPSupport)
+
+
+def test_normalize_many():
+    names = ["header_sgp_fixed_wcs", "header_maximdl", "header_apt", "header_sharpcap", "header_nina"]
+    header_dicts = [FitsFileFormat.safe_dict(Header.fromstring(getattr(sample_headers, name), "\n")) for name in names]
+    header_dicts.append({"IMAGETYP": "DARK", "DATE-OBS": "04/07/18", "DATE-LOC": "2021-03-02T21:19:00+01:00"})
+    header_dicts.append({})
+    frame = MetadataAnalyser.normalize_many(header_dicts)
+    assert len(frame) == len(header_dicts)
+    for (row, header_dict) in zip(frame.itertuples(), header_dicts):
+        meta = MetadataAnalyser.normalize_dict(header_dict, Path("dummyFile.fit"))
+        assert row.img_type == meta.img_type.name
+        for field in ["camera_name", "object_name", "filter", "telescope"]:
+            assert getattr(row, field) == getattr(meta, field)
+        for field in ["exposure", "actual_temperature", "set_temperature", "xbin", "ybin", "gain", "offset"]:
+            expected = getattr(meta, field)
+            assert pandas.isna(getattr(row, field)) if expected is None else getattr(row, field) == expected
+        expected_utc = meta.datetime_utc.replace(tzinfo=None) if meta.datetime_utc is not None else None
+        expected_local = meta.datetime_local.replace(tzinfo=None) if meta.datetime_local is not None else None
+        assert (row.datetime_utc if not pandas.isna(row.datetime_utc) else None) == expected_utc
+        assert (row.datetime_local if not pandas.isna(row.datetime_local) else None) == expected_local
+        session_date = row.session_date.date() if not pandas.isna(row.session_date) else None
+        assert session_date == meta.session_date()
+
+
+def test_normalize_many_invalid():
+    frame = MetadataAnalyser.normalize_many([{"EXPOSURE": "30", "GAIN": "unity"}, {"EXPOSURE": "n/a", "GAIN": 139.5}])
+    assert frame.exposure[0] == 30.0 and pandas.isna(frame.exposure[1])
+    assert pandas.isna(frame.gain[0]) and frame.gain[1] == 140  # rounds half to even, like round()
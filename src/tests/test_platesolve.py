@@ -1,9 +1,18 @@
+import gzip
+import lzma
+import threading
+import time
+from io import BytesIO
 from pathlib import Path
 
+import numpy as np
 import pytest
+from astropy import wcs
+from astropy.io import fits
 from astropy.io.fits import Header
 
-from src.fitstools.platesolve import ASTAPSolver, create_hint, SolverError, SolverFailure, extract_hint
+from src.fitstools.platesolve import ASTAPSolver, create_hint, SolverError, SolverFailure, extract_hint, SolveJob, \
+    SolveScheduler, SolverTimeout, SolverCancelled, solution_hint, prepare_input, rescale_wcs
 
 
 def test_solve_asi183mm():
@@ -75,3 +84,166 @@ def solve_testFile(file, hint=None):
     assert image_file.is_file()
     headers = solver.solve(image_file, hint)
     return headers
+
+
+def stub_frames(directory: Path, names):
+    directory.mkdir(parents=True, exist_ok=True)
+    frames = []
+    for name in names:
+        frame = directory / name
+        frame.write_bytes(b"")
+        frames.append(frame)
+    return frames
+
+
+def test_stub_solver(stub_astap, tmp_path):
+    (frame, failing) = stub_frames(tmp_path / "night", ["frame1.fit", "fail.fit"])
+    solver = ASTAPSolver(stub_astap)
+    headers = solver.solve(frame, create_hint(283.4, 33.0))
+    assert headers["PLTSOLVD"] == True
+    assert headers["HINT_RA"] == pytest.approx(283.4 / 15)
+    with pytest.raises(SolverFailure) as excinfo:
+        solver.solve(failing)
+    assert "No solution found!" in excinfo.value.log[-1]
+
+
+def test_scheduler_hints(stub_astap, tmp_path):
+    jobs = [SolveJob(frame, set_key="M57") for frame in
+            stub_frames(tmp_path / "M57", ["fail1.fit", "frame1.fit", "frame2.fit", "frame3.fit", "frame4.fit"])]
+    jobs.append(SolveJob(stub_frames(tmp_path / "single", ["frame1.fit"])[0]))
+    done = list(SolveScheduler(ASTAPSolver(stub_astap), processes=3).run(jobs))
+    assert sorted(map(id, done)) == sorted(map(id, jobs))
+    assert jobs[0].state == SolveJob.FAILED
+    assert jobs[1].state == SolveJob.SOLVED
+    assert jobs[1].used_hint is None  # the first frame of the set to solve, blind
+    assert jobs[1].header["HINT_RA"] == "none"
+    for job in jobs[2:5]:
+        assert job.state == SolveJob.SOLVED
+        assert job.used_hint == solution_hint(jobs[1].header)
+        assert job.header["HINT_RA"] == pytest.approx(283.3955 / 15)
+    assert jobs[5].state == SolveJob.SOLVED  # no set, solved on its own
+
+
+def test_scheduler_timeout(stub_astap, tmp_path):
+    jobs = [SolveJob(frame) for frame in stub_frames(tmp_path, ["hang.fit", "frame1.fit"])]
+    start = time.perf_counter()
+    done = list(SolveScheduler(ASTAPSolver(stub_astap), processes=2, timeout=1).run(jobs))
+    assert time.perf_counter() - start < 10
+    assert [job.state for job in jobs] == [SolveJob.FAILED, SolveJob.SOLVED]
+    assert isinstance(jobs[0].error, SolverTimeout)
+    assert done[0] is jobs[1]
+
+
+def test_scheduler_cancel(stub_astap, tmp_path):
+    jobs = [SolveJob(frame) for frame in stub_frames(tmp_path, ["hang1.fit", "hang2.fit", "frame1.fit"])]
+    scheduler = SolveScheduler(ASTAPSolver(stub_astap), processes=2)
+    threading.Timer(0.5, scheduler.cancel).start()
+    start = time.perf_counter()
+    done = list(scheduler.run(jobs))
+    assert time.perf_counter() - start < 10
+    assert len(done) == 3
+    assert all(job.state == SolveJob.CANCELLED for job in jobs)
+    assert all(isinstance(job.error, SolverCancelled) for job in jobs)
+
+
+def test_scheduler_many_sets(stub_astap, tmp_path):
+    sets = {target: [SolveJob(frame, set_key=target) for frame in
+                     stub_frames(tmp_path / target, ["frame%d.fit" % i for i in range(8)])]
+            for target in ["M31", "M33", "M57"]}
+    jobs = [job for target_jobs in sets.values() for job in target_jobs]
+    done = list(SolveScheduler(ASTAPSolver(stub_astap), processes=4).run(jobs))
+    assert sorted(map(id, done)) == sorted(map(id, jobs))
+    assert all(job.state == SolveJob.SOLVED for job in done)
+    for target_jobs in sets.values():
+        blind = [job for job in target_jobs if job.used_hint is None]
+        assert len(blind) == 1  # one blind solve per set, the others reuse its solution
+        for job in target_jobs:
+            if job is not blind[0]:
+                assert job.used_hint == solution_hint(blind[0].header)
+
+
+def test_solve_many(stub_astap, tmp_path):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    folders = ["night%d" % i for i in range(6)]
+    frames = [frame for folder in folders for frame in stub_frames(tmp_path / folder, ["frame1.fit", "fail.fit"])]
+    with ASTAPSolver(stub_astap, tmp_dir=str(work_dir), processes=4) as solver:
+        futures = solver.solve_many(frames, create_hint(283.4, 33.0))
+        for (frame, future) in zip(frames, futures):
+            if frame.name == "fail.fit":
+                with pytest.raises(SolverFailure):
+                    future.result()
+            else:
+                assert future.result()["FOLDER"] == frame.parent.name  # same names, no collisions
+        timed_out = solver.solve_many(stub_frames(tmp_path / "hang", ["hang.fit"]), timeout=0.5)[0]
+        with pytest.raises(SolverTimeout):
+            timed_out.result()
+    assert list(work_dir.iterdir()) == []  # every private directory removed
+
+
+def write_frame(path: Path, width=4144, height=2822, compress=None):
+    """ a blank frame of the size the stub expects, optionally compressed like our archives """
+    data = np.zeros((height, width), dtype=np.uint16)
+    data[::97, ::89] = 4000  # something to bin
+    content = BytesIO()
+    fits.PrimaryHDU(data, Header({"XPIXSZ": 4.63, "YPIXSZ": 4.63, "FOCALLEN": 540})).writeto(content)
+    opener = lzma.open if compress == "xz" else gzip.open if compress == "gz" else open
+    with opener(path, "wb") as fd:
+        fd.write(content.getvalue())
+    return path
+
+
+def corners(header):
+    world = wcs.WCS(header)
+    pixels = np.array([[1, 1], [4144, 1], [1, 2822], [4144, 2822], [2072.5, 1411.5]])
+    return world.all_pix2world(pixels, 1)
+
+
+@pytest.mark.parametrize("binning", [2, 3])
+def test_binned_solve(stub_astap, tmp_path, binning):
+    frame = write_frame(tmp_path / "frame1.fit")
+    full = ASTAPSolver(stub_astap).solve(frame)
+    binned = ASTAPSolver(stub_astap, binning=binning).solve(write_frame(tmp_path / "frame2.fit.xz", compress="xz"))
+    assert binned["SOLVEBIN"] == binning
+    assert (binned["NAXIS1"], binned["NAXIS2"]) == (4144, 2822)
+    assert binned["CRPIX1"] == pytest.approx(full["CRPIX1"])
+    assert binned["CD1_2"] == pytest.approx(full["CD1_2"])
+    assert np.abs(corners(binned) - corners(full)).max() * 3600 < 0.01  # arcsec
+
+
+def test_compressed_input(stub_astap, tmp_path):
+    header = ASTAPSolver(stub_astap).solve(write_frame(tmp_path / "frame1.fits.gz", compress="gz"))
+    assert "SOLVEBIN" not in header
+    assert header["CRPIX1"] == 2072.5
+
+
+def test_prepare_input(tmp_path):
+    frame = write_frame(tmp_path / "frame1.fit", width=100, height=61)
+    (input_file, size) = prepare_input(frame, tmp_path, 3)
+    assert size == (100, 61)
+    with fits.open(input_file) as hdul:
+        assert hdul[0].data.shape == (20, 33)
+        assert hdul[0].header["XPIXSZ"] == pytest.approx(3 * 4.63)
+        assert hdul[0].data[0, 0] == round(4000 / 9)
+
+
+def test_rescale_wcs_sip():
+    binning = 2
+    full = Header({"CTYPE1": "RA---TAN-SIP", "CTYPE2": "DEC--TAN-SIP", "CRVAL1": 10.0, "CRVAL2": 40.0,
+                   "CRPIX1": 1000.5, "CRPIX2": 700.5, "CD1_1": -3e-4, "CD1_2": 1e-5, "CD2_1": 1e-5, "CD2_2": 3e-4,
+                   "A_ORDER": 2, "A_2_0": 2e-7, "A_1_1": -1e-7, "B_ORDER": 2, "B_0_2": 3e-7, "B_1_1": 1e-7})
+    binned = full.copy()  # what a solve of the binned image gives
+    for axis in (1, 2):
+        binned["CRPIX%d" % axis] = (full["CRPIX%d" % axis] - 0.5) / binning + 0.5
+    for key in ("CD1_1", "CD1_2", "CD2_1", "CD2_2"):
+        binned[key] = full[key] * binning
+    for key in ("A_2_0", "A_1_1", "B_0_2", "B_1_1"):
+        binned[key] = full[key] * binning  # b^(p+q-1)
+    full_pixels = np.array([[1.0, 1.0], [1999.5, 3.5], [600.5, 1399.5]])
+    binned_pixels = (full_pixels - 0.5) / binning + 0.5
+    assert np.allclose(wcs.WCS(binned).all_pix2world(binned_pixels, 1),
+                       wcs.WCS(full).all_pix2world(full_pixels, 1), atol=1e-9)
+
+    rescaled = rescale_wcs(binned, binning)
+    for key in ("CRPIX1", "CRPIX2", "CD1_1", "CD2_2", "A_2_0", "A_1_1", "B_0_2", "B_1_1"):
+        assert rescaled[key] == pytest.approx(full[key])
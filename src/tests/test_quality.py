@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.stats import gaussian_fwhm_to_sigma
+
+from src.fitstools.analysis.quality import QualityAnalyser, interpolate_mesh
+
+SHAPE = (1000, 1500)
+FWHM = 3.5
+ECCENTRICITY = 0.6
+
+
+def synthetic_frame(stars=200, fwhm=FWHM, eccentricity=ECCENTRICITY, background=1000.0, noise=10.0, seed=42):
+    """ gaussian stars with their major axis along x, on a noisy background, as uint16 """
+    rng = np.random.default_rng(seed)
+    sigma_x = fwhm * gaussian_fwhm_to_sigma * math.sqrt(math.sqrt(1 / (1 - eccentricity ** 2)))
+    sigma_y = sigma_x * math.sqrt(1 - eccentricity ** 2)
+    data = rng.normal(background, noise, SHAPE)
+    ys = rng.uniform(20, SHAPE[0] - 20, stars)
+    xs = rng.uniform(20, SHAPE[1] - 20, stars)
+    peaks = rng.uniform(30, 300, stars) * noise
+    (y, x) = np.mgrid[-10:11, -10:11]
+    for (cy, cx, peak) in zip(ys, xs, peaks):
+        (iy, ix) = (int(cy), int(cx))
+        (dy, dx) = (y - (cy - iy), x - (cx - ix))
+        data[iy - 10:iy + 11, ix - 10:ix + 11] += peak * np.exp(-dx ** 2 / (2 * sigma_x ** 2)
+                                                                 - dy ** 2 / (2 * sigma_y ** 2))
+    return np.clip(np.rint(data), 0, 65535).astype(np.uint16)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_measure(fast):
+    quality = QualityAnalyser.measure(synthetic_frame(), fast)
+    assert quality.median_fwhm == pytest.approx(FWHM, rel=0.03)
+    assert quality.eccentricity == pytest.approx(ECCENTRICITY, abs=0.03)
+    assert quality.background == pytest.approx(1000, abs=1)
+    assert quality.noise == pytest.approx(10, rel=0.05)
+    assert 190 <= quality.star_count <= 200  # some overlap
+
+
+def test_measure_round():
+    quality = QualityAnalyser.measure(synthetic_frame(fwhm=2.5, eccentricity=0.0))
+    assert quality.median_fwhm == pytest.approx(2.5, rel=0.03)
+    assert quality.eccentricity < 0.3  # noise and pixels alone make a few percent difference in the axes
+
+
+def test_hot_pixels_and_saturation():
+    data = synthetic_frame(stars=0)
+    data[100, 100] = 60000  # hot pixel
+    data[200:202, 300] = 40000  # pair of hot pixels
+    data[490:540, 490:540] = np.maximum(data[490:540, 490:540], 20000)
+    data[500:530, 500:530] = 65535  # saturated star
+    quality = QualityAnalyser.measure(data)
+    assert quality.star_count == 1  # counted, not measured
+    assert quality.median_fwhm is None
+    assert quality.background == pytest.approx(1000, abs=1)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_vignetting(fast):
+    # a sky that falls off by 10% towards the corners, 10 times the noise: with a single level the center of the
+    # frame would be detected as one big source
+    (y, x) = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    falloff = 100 * (((y - SHAPE[0] / 2) ** 2 + (x - SHAPE[1] / 2) ** 2) / (SHAPE[1] / 2) ** 2)
+    data = (synthetic_frame() - falloff).astype(np.uint16)
+    quality = QualityAnalyser.measure(data, fast)
+    assert quality.median_fwhm == pytest.approx(FWHM, rel=0.03)
+    assert quality.noise == pytest.approx(10, rel=0.1)
+    assert 190 <= quality.star_count <= 200
+
+
+def test_not_finite():
+    data = synthetic_frame().astype(np.float32)
+    data[300, 400] = np.nan
+    data[0:10, :] = np.inf
+    quality = QualityAnalyser.measure(data)
+    assert quality.background == pytest.approx(1000, abs=1)
+    assert quality.median_fwhm == pytest.approx(FWHM, rel=0.03)
+    with pytest.raises(ValueError):
+        QualityAnalyser.measure(np.full((100, 100), np.nan, dtype=np.float32))
+
+
+def test_interpolate_mesh():
+    (y, x) = np.mgrid[0:4, 0:6]
+    mesh = 10.0 * y + x  # linear, so exact everywhere, the edges beyond the outer cell centers included
+    full = interpolate_mesh(mesh, 8, (32, 48))
+    (rows, columns) = np.mgrid[0:32, 0:48]
+    expected = 10.0 * ((rows + 0.5) / 8 - 0.5) + ((columns + 0.5) / 8 - 0.5)
+    assert full.shape == (32, 48)
+    assert np.allclose(full, expected, atol=1e-4)
+    assert np.all(interpolate_mesh(np.array([[3.0]]), 8, (8, 16)) == 3.0)
+
+
+def test_measure_file_bayer(tmp_path):
+    # a mosaic of the same sky in every channel, its 2x2 superpixels have twice the pixel size
+    data = synthetic_frame(fwhm=FWHM / 2)
+    mosaic = np.repeat(np.repeat(data, 2, axis=0), 2, axis=1)
+    fits.PrimaryHDU(mosaic, fits.Header({"BAYERPAT": "RGGB"})).writeto(tmp_path / "osc.fits")
+    quality = QualityAnalyser.measure_file(tmp_path / "osc.fits")
+    assert quality.median_fwhm == pytest.approx(FWHM, rel=0.05)
+    assert quality.eccentricity == pytest.approx(ECCENTRICITY, abs=0.05)
+
+
+def test_measure_color():
+    data = synthetic_frame()
+    quality = QualityAnalyser.measure(np.stack([data, data, data]))
+    assert quality.median_fwhm == pytest.approx(FWHM, rel=0.03)